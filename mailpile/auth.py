@@ -252,6 +252,11 @@ class DeAuthenticate(Command):
             try:
                 self.session.ui.debug('Logging out %s' % session_id)
                 del SESSION_CACHE[session_id]
+
+                # Do not leave authenticated connections lying around
+                from mailpile.conn_brokers import Master as ConnBroker
+                ConnBroker.pool.close_idle()
+
                 return self._success(_('Goodbye!'))
             except KeyError:
                 pass
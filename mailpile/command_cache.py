@@ -36,13 +36,46 @@ class CommandCache(object):
     #    - The app configuration: '!config'
     #
 
-    def __init__(self, debug=None):
+    # To find the entries affected by a change quickly, we keep an inverted
+    # index of requirements (requirement -> fingerprints). Entries marked
+    # dirty stay dirty until they are refreshed, no matter how many times
+    # they are marked, so each is refreshed at most once per cycle.
+    #
+    MAX_ENTRIES = 250
+
+    def __init__(self, debug=None, max_entries=None):
         self.debug = debug or (lambda s: None)
         self.lock = UiRLock()
         self._lag = 0.1
+        self.max_entries = max_entries or self.MAX_ENTRIES
         self.cache = {}       # id -> [exp, req, ss, cmd_obj, res_obj, added]
-        self.dirty = []       # (ts, req): Requirements that changed & when
-        self._dirty_ttl = 10
+        self.by_req = {}      # req -> set of ids: Inverted requirement index
+        self.dirty = {}       # id -> ts: Entries which changed & when
+        self.costs = {}       # id -> [refreshes, seconds spent refreshing]
+
+    def _index(self, fprint, req):
+        for r in req:
+            self.by_req.setdefault(r, set()).add(fprint)
+
+    def _unindex(self, fprint, req):
+        for r in req:
+            fprints = self.by_req.get(r)
+            if fprints is not None:
+                fprints.discard(fprint)
+                if not fprints:
+                    del self.by_req[r]
+
+    def _forget(self, fprint):
+        self._unindex(fprint, self.cache.pop(fprint)[1])
+        self.dirty.pop(fprint, None)
+        self.costs.pop(fprint, None)
+
+    def _evict(self):
+        if len(self.cache) > self.max_entries:
+            # Evict whatever expires soonest
+            doomed = sorted(self.cache, key=lambda f: self.cache[f][0])
+            for fprint in doomed[:len(self.cache) - self.max_entries]:
+                self._forget(fprint)
 
     def cache_result(self, fprint, expires, req, cmd_obj, result_obj):
         with self.lock:
@@ -54,39 +87,70 @@ class CommandCache(object):
             # Note: We cache this even if the requirements are "dirty",
             #       as mere presence in the cache makes this a candidate
             #       for refreshing.
-            self.cache[str(fprint)] = [expires, req, ss, cmd_obj, result_obj,
-                                       time.time()]
+            fprint = str(fprint)
+            if fprint in self.cache:
+                self._unindex(fprint, self.cache[fprint][1])
+            self.cache[fprint] = [expires, req, ss, cmd_obj, result_obj,
+                                  time.time()]
+            self._index(fprint, req)
+            self.dirty.pop(fprint, None)
+            self._evict()
             self.debug('Cached %s, req=%s' % (fprint, sorted(list(req))))
 
     def get_result(self, fprint, dirty_check=True, extend=300):
         with self.lock:
             exp, req, ss, co, result_obj, a = match = self.cache[fprint]
+            dirty = (fprint in self.dirty)
         if dirty_check:
             recent = (a > time.time() - self._lag)
-            dirty = (req & self.dirty_set(after=a))
             if recent or dirty:
                 # If item is too new, or requirements are dirty, pretend this
                 # item does not exist.
                 self.debug('Suppressing cache result %s, recent=%s dirty=%s'
-                           % (fprint, recent, sorted(list(dirty))))
+                           % (fprint, recent, dirty))
                 raise KeyError(fprint)
         match[0] = time.time() + extend
         co.session = result_obj.session = ss
         self.debug('Returning cached result for %s' % fprint)
         return result_obj
 
-    def dirty_set(self, after=0):
-        dirty = set(['!timedout'])
+    def dirty_set(self):
+        """Return the fingerprints of all entries needing a refresh."""
         with self.lock:
-            for ts, req in self.dirty:
-                if (after == 0) or (ts > after):
-                    dirty |= req
-        return dirty
+            return set(self.dirty.keys())
 
     def mark_dirty(self, requirements):
+        now = time.time()
         with self.lock:
-            self.dirty.append((time.time(), set(requirements)))
-        self.debug('Marked dirty: %s' % sorted(list(requirements)))
+            by_req = self.by_req
+            if len(requirements) > len(by_req):
+                # Huge keyword sets: walk the (smaller) index instead
+                requirements = set(requirements)
+                hits = [by_req[r] for r in by_req if r in requirements]
+            else:
+                hits = [by_req[r] for r in requirements if r in by_req]
+            marked = set()
+            for fprints in hits:
+                marked |= fprints
+            for fprint in marked:
+                self.dirty[fprint] = now
+        if marked:
+            self.debug('Marked dirty: %s' % sorted(list(marked)))
+
+    def stats(self):
+        """Return per-entry refresh counts and costs (seconds)."""
+        with self.lock:
+            return {
+                'entries': len(self.cache),
+                'max_entries': self.max_entries,
+                'requirements': len(self.by_req),
+                'dirty': len(self.dirty),
+                'costs': dict((fp, {'refreshes': c[0], 'seconds': c[1]})
+                              for fp, c in self.costs.iteritems())}
+
+    def _refresh_cost(self, fprint):
+        count, seconds = self.costs.get(fprint, (0, 0))
+        return (seconds / count) if count else 0
 
     def refresh(self, extend=0, runtime=5, event_log=None):
         if mailpile.util.LIVE_USER_ACTIVITIES > 0:
@@ -98,46 +162,44 @@ class CommandCache(object):
             # Expire things from the cache
             expired = set([f for f in self.cache if self.cache[f][0] < now])
             for fp in expired:
-                del self.cache[fp]
-
-            # Expire things from the dirty set
-            self.dirty = [(ts, req) for ts, req in self.dirty
-                          if ts >= (now - self._dirty_ttl)]
+                self._forget(fp)
 
             # Decide which fingerprints to look at this time around
-            fingerprints = list(self.cache.keys())
+            fingerprints = [fp for fp in self.dirty if fp in self.cache]
 
         refreshed = []
         fingerprints.sort(key=lambda k: -self.cache[k][0])
         for fprint in fingerprints:
-            req = None
             try:
-                e, req, ss, co, ro, a = self.cache[fprint]
+                with self.lock:
+                    e, req, ss, co, ro, a = self.cache[fprint]
+                    marked = self.dirty[fprint]
                 now = time.time()
-                dirty = (req & self.dirty_set(after=a))
-                if (a + self._lag < now) and dirty:
-                    if now < started + runtime:
-                        play_nice_with_threads()
-                        co.session = ro.session = ss
-                        ro = co.refresh()
-                        if extend > 0:
-                            e = min(e + extend, now + 5*extend)
-                        if '!timedout' in req:
-                            req.remove('!timedout')
-                        with self.lock:
-                            # Make sure we do not overwrite new results from
-                            # elsewhere at this time.
-                            if self.cache[fprint][-1] == a:
-                                e = max(e, self.cache[fprint][0])  # Clobber?
-                                self.cache[fprint] = [e, req, ss, co, ro, now]
-                            refreshed.append(fprint)
-                    else:
-                        # Out of time, mark as dirty.
-                        req.add('!timedout')
-            except (ValueError, IndexError, TypeError):
-                # Treat broken things as if they had timed out
-                if req:
-                    req.add('!timedout')
+                if a + self._lag >= now:
+                    continue  # Too recent, leave it for next time
+                if now + self._refresh_cost(fprint) > started + runtime:
+                    continue  # Out of time; it stays dirty
+                play_nice_with_threads()
+                co.session = ro.session = ss
+                ro = co.refresh()
+                done = time.time()
+                if extend > 0:
+                    e = min(e + extend, now + 5*extend)
+                with self.lock:
+                    cost = self.costs.setdefault(fprint, [0, 0])
+                    cost[0] += 1
+                    cost[1] += done - now
+                    # Make sure we do not overwrite new results from
+                    # elsewhere at this time.
+                    if self.cache.get(fprint, [None])[-1] == a:
+                        e = max(e, self.cache[fprint][0])  # Clobber?
+                        self.cache[fprint] = [e, req, ss, co, ro, done]
+                        if self.dirty.get(fprint) == marked:
+                            del self.dirty[fprint]
+                    refreshed.append(fprint)
+            except (KeyError, ValueError, IndexError, TypeError):
+                # Broken things stay dirty, we will try again later
+                pass
 
         if refreshed and event_log:
             event_log.log(message=_('New results are available'),
@@ -153,6 +215,7 @@ class Cached(Command):
     ORDER = ('Internals', 7)
     HTTP_QUERY_VARS = {'id': 'Cache ID of command to redisplay'}
     IS_USER_ACTIVITY = False
+    IS_POLLING_ACTIVITY = True
     LOG_NOTHING = True
 
     def max_age(self):
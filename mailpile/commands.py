@@ -35,6 +35,7 @@ class Command(object):
     UI_CONTEXT = None
     IS_USER_ACTIVITY = False
     IS_HANGING_ACTIVITY = False
+    IS_POLLING_ACTIVITY = False  # The web UI calls this in the background
     IS_INTERACTIVE = False
     CONFIG_REQUIRED = True
 
@@ -40,8 +40,23 @@ CONFIG_RULES = {
         'http_port':     p(_('Listening port for web UI'), int,         33411),
         'http_path':     p(_('HTTP path of web UI'), 'webroot',            ''),
         'http_no_auth':  X(_('Disable HTTP authentication'),      bool, False),
+        'http_workers':   (_('HTTP worker threads (0 = one per client)'),
+                                                                       int, 0),
         'ajax_timeout':   (_('AJAX Request timeout'), int,              10000),
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
+        'index_columnar': (_('Keep a columnar snapshot of the index'),
+                                                                   bool, False),
+        'index_segments': (_('Store search terms in merged segments'),
+                                                                   bool, False),
+        'index_mapped':   (_('Memory-map the metadata index'), bool,   False),
+        'metadata_cache_kb': (_('Memory for cached message metadata (KB)'),
+                                                                   int, 4096),
+        'parse_cache_kb': (_('Memory for cached parsed messages (KB)'),
+                                                                  int, 16384),
+        'scan_processes': (_('Processes used to parse new mail'), int,      0),
+        'scan_crypto_threads': (_('Threads checking signatures in new mail'),
+                                                                       int, 4),
+        'vcard_threads':  (_('Threads used to load contacts'), int,          4),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     275),
         'debug':         p(_('Debugging flags'), str,                      ''),
@@ -52,6 +67,8 @@ CONFIG_RULES = {
                            'dir', None),
         'gpg_binary':    p(_('Override the default GPG binary path'),
                            'file', None),
+        'gpg_coprocesses': (_('Spare GnuPG processes (0 = start on demand)'),
+                                                                       int, 0),
         'local_mailbox_id': (_('Local read/write Maildir'), 'b36',         ''),
         'mailindex_file':   (_('Metadata index file'), 'file',             ''),
         'postinglist_dir': (_('Search index directory'), 'dir',            ''),
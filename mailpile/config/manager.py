@@ -31,6 +31,7 @@ from mailpile.eventlog import EventLog, Event, GetThreadEvent
 from mailpile.httpd import HttpWorker
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.search import CachedSearchResultSet
 from mailpile.mailboxes import OpenMailbox, NoSuchMailboxError, wervd
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN
 from mailpile.search import MailIndex
@@ -598,6 +599,9 @@ class ConfigManager(ConfigDict):
         # Invalidate command cache contents that depend on the config
         self.command_cache.mark_dirty([u'!config'])
 
+        # Tag definitions may have changed, so cached searches may be stale
+        CachedSearchResultSet.DropCaches()
+
     def _find_mail_source(self, mbx_id, path=None):
         if path:
             path = FilePath(path).raw_fp
@@ -1485,6 +1489,8 @@ class ConfigManager(ConfigDict):
 
         from mailpile.postinglist import PLC_CACHE_FlushAndClean
         PLC_CACHE_FlushAndClean(config.background, keep=0)
+        from mailpile.conn_brokers import Master as ConnBroker
+        ConnBroker.pool.close_idle()
         config.search_history.save(config)
         save_worker.quit(join=True)
 
@@ -628,6 +628,198 @@ class AutoPop3StartTLSConnBroker(BaseConnectionBrokerProxy):
     pass
 
 
+class ConnectionPool(object):
+    """
+    A pool of idle, already established (and authenticated) connections,
+    so protocol clients can skip the connect, TLS handshake and login
+    when they talk to the same server again soon.
+
+    Connections are checked in under a key describing everything that
+    went into making them (protocol, host, port, credentials...), and
+    checked out again by whoever asks for the same key. Connections which
+    sit idle for too long are closed, and a connection is only handed out
+    again if its health check (if any) says it is still usable.
+
+    >>> pool = ConnectionPool()
+    >>> closed = []
+    >>> pool.checkin('k', 'conn1', close=lambda: closed.append('conn1'))
+    >>> pool.checkin('k', 'conn2', check=lambda: False,
+    ...              close=lambda: closed.append('conn2'))
+    >>> pool.checkout('k'), closed
+    ('conn1', ['conn2'])
+    >>> pool.checkout('k') is None, pool.checkout('other') is None
+    (True, True)
+    >>> s = pool.stats()
+    >>> (s['checked_in'], s['reused'], s['unhealthy'], s['idle'])
+    (2, 1, 1, 0)
+
+    Expired connections are closed by prune(), which gets called
+    periodically, so they do not linger until the pool is next used:
+    >>> pool.checkin('k', 'conn3', close=lambda: closed.append('conn3'))
+    >>> pool.prune(now=time.time() + pool.IDLE_TIMEOUT), closed
+    (1, ['conn2', 'conn3'])
+    """
+    IDLE_TIMEOUT = 60
+    MAX_IDLE = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.counters = {'checked_in': 0, 'reused': 0, 'expired': 0,
+                         'unhealthy': 0, 'discarded': 0}
+
+    def _close(self, entry):
+        expires, conn, check, close = entry
+        try:
+            if close is not None:
+                close()
+        except (IOError, OSError, socket.error, EOFError):
+            pass
+
+    def _prune(self, now):
+        # Called with the lock held; returns entries for the caller to
+        # close once the lock has been released.
+        expired = []
+        for key, entries in self.idle.items():
+            fresh = [e for e in entries if e[0] > now]
+            expired.extend(e for e in entries if e[0] <= now)
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+        self.counters['expired'] += len(expired)
+        return expired
+
+    def checkin(self, key, conn, check=None, close=None):
+        """Make an idle connection available for reuse."""
+        with self.lock:
+            doomed = self._prune(time.time())
+            entries = self.idle.get(key, [])
+            entries.append((time.time() + self.IDLE_TIMEOUT,
+                            conn, check, close))
+            while len(entries) > self.MAX_IDLE:
+                doomed.append(entries.pop(0))
+                self.counters['discarded'] += 1
+            self.idle[key] = entries
+            self.counters['checked_in'] += 1
+        for entry in doomed:
+            self._close(entry)
+
+    def checkout(self, key):
+        """Return a healthy idle connection for key, or None."""
+        while True:
+            with self.lock:
+                doomed = self._prune(time.time())
+                entries = self.idle.get(key)
+                entry = entries.pop(-1) if entries else None
+                if entries is not None and not entries:
+                    del self.idle[key]
+            for e in doomed:
+                self._close(e)
+            if entry is None:
+                return None
+
+            expires, conn, check, close = entry
+            try:
+                healthy = (check is None) or check()
+            except Exception:
+                # Health checks are protocol specific and so are their
+                # errors (smtplib.SMTPServerDisconnected, imaplib.abort...);
+                # whatever went wrong, this connection is not usable.
+                healthy = False
+            with self.lock:
+                self.counters['reused' if healthy else 'unhealthy'] += 1
+            if healthy:
+                return conn
+            self._close(entry)
+
+    def prune(self, now=None):
+        """Close expired idle connections, returning how many."""
+        with self.lock:
+            doomed = self._prune(now or time.time())
+        for entry in doomed:
+            self._close(entry)
+        return len(doomed)
+
+    def close_idle(self):
+        """Close all idle connections (on shutdown or logout)."""
+        with self.lock:
+            doomed = [e for entries in self.idle.values() for e in entries]
+            self.idle = {}
+        for entry in doomed:
+            self._close(entry)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle'] = sum(len(e) for e in self.idle.values())
+        return stats
+
+
+class LatencyStats(object):
+    """
+    Keep track of how long it takes to connect to (and negotiate TLS
+    with) each server we talk to.
+
+    >>> ls = LatencyStats()
+    >>> ls.record('connect', ('example.com', 25), 0.25)
+    >>> ls.record('connect', ('example.com', 25), 0.75)
+    >>> ls.record('connect', ('example.com', 25), 5.0, failed=True)
+    >>> ls.record('handshake', ('example.com', 25), 0.1)
+    >>> s = ls.stats()['example.com:25']['connect']
+    >>> (s['count'], s['failed'], s['avg'], s['min'], s['max'], s['last'])
+    (2, 1, 0.5, 0.25, 0.75, 0.75)
+    """
+    MAX_HOSTS = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def timer(self, what, address):
+        t0 = time.time()
+        return lambda failed=False: self.record(
+            what, address, time.time() - t0, failed=failed)
+
+    def record(self, what, address, elapsed, failed=False):
+        try:
+            host = '%s:%s' % tuple(address[:2])
+        except (TypeError, ValueError):
+            host = '%s' % (address, )
+        with self.lock:
+            if host not in self.hosts and len(self.hosts) >= self.MAX_HOSTS:
+                oldest = min(self.hosts, key=lambda h: self.hosts[h][0])
+                del self.hosts[oldest]
+            info = self.hosts.get(host, [0, {}])
+            info[0] = time.time()
+            s = info[1].get(what, {'count': 0, 'failed': 0, 'total': 0.0,
+                                   'min': None, 'max': None, 'last': None})
+            if failed:
+                s['failed'] += 1
+            else:
+                s['count'] += 1
+                s['total'] += elapsed
+                s['last'] = elapsed
+                if s['min'] is None or elapsed < s['min']:
+                    s['min'] = elapsed
+                if s['max'] is None or elapsed > s['max']:
+                    s['max'] = elapsed
+            info[1][what] = s
+            self.hosts[host] = info
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for host, (ts, info) in self.hosts.iteritems():
+                result[host] = {}
+                for what, s in info.iteritems():
+                    s = dict(s)
+                    s['avg'] = (s['total'] / s['count']) if s['count'] else None
+                    del s['total']
+                    result[host][what] = s
+            return result
+
+
 class MasterBroker(BaseConnectionBroker):
     """
     This is the master broker. It implements a prioritised list of
@@ -640,6 +832,8 @@ class MasterBroker(BaseConnectionBroker):
         BaseConnectionBroker.__init__(self, *args, **kwargs)
         self.brokers = []
         self.history = []
+        self.pool = ConnectionPool()
+        self.latency = LatencyStats()
         self._debug = self._debugger
         self.debug_callback = None
 
@@ -680,12 +874,28 @@ class MasterBroker(BaseConnectionBroker):
             self.history = self.history[-50:]
             self.history.append(history_event)
             kwargs['_history_event'] = history_event
+            done = self.latency.timer('connect', address)
         else:
             history_event[-1] = context
+            done = None
 
         if context.address is None:
             context.address = address
 
+        try:
+            conn = self._create_conn_with_caps(
+                history_event, address, context, need, reject,
+                *args, **kwargs)
+        except:
+            if done is not None:
+                done(failed=True)
+            raise
+        if done is not None:
+            done()
+        return conn
+
+    def _create_conn_with_caps(self, history_event, address, context,
+                               need, reject, *args, **kwargs):
         et = v = t = None
         for prio, cb in self.brokers:
             try:
@@ -745,6 +955,36 @@ class NetworkHistory(Command):
                              result=Master.history)
 
 
+class NetworkStats(Command):
+    """Show connection latency and reuse statistics"""
+    SYNOPSIS = (None, 'logs/network/stats', 'logs/network/stats', None)
+    ORDER = ('Internals', 6)
+    CONFIG_REQUIRED = False
+    IS_USER_ACTIVITY = False
+
+    class CommandResult(Command.CommandResult):
+        def as_text(self):
+            if not self.result:
+                return _('No network statistics recorded')
+            def fmt(s):
+                return '%d ok, %d failed, avg %s ms, max %s ms' % (
+                    s['count'], s['failed'],
+                    '-' if s['avg'] is None else int(1000 * s['avg']),
+                    '-' if s['max'] is None else int(1000 * s['max']))
+            lines = []
+            for host, info in sorted(self.result['latency'].iteritems()):
+                for what, s in sorted(info.iteritems()):
+                    lines.append('%-40s %-10s %s' % (host, what, fmt(s)))
+            lines.append('Idle pool: %s' % ', '.join(
+                '%s=%s' % kv for kv in sorted(self.result['pool'].items())))
+            return '\n'.join(lines)
+
+    def command(self):
+        return self._success(_('Listed network statistics'), result={
+            'latency': Master.latency.stats(),
+            'pool': Master.pool.stats()})
+
+
 class GetTlsCertificate(Command):
     """Fetch and parse a server's TLS certificate"""
     SYNOPSIS = (None, 'crypto/tls/getcert', 'crypto/tls/getcert', '[--tofu-save|--tofu-clear]')
@@ -995,14 +1235,29 @@ def SslWrapOnlyOnce(org_sslwrap, sock, *args, **kwargs):
     """
     if not isinstance(sock, ssl.SSLSocket):
         ctx = Master.get_fd_context(sock.fileno())
+        # We get called again from within org_sslwrap (ssl.wrap_socket
+        # goes via. SSLContext.wrap_socket); only time the outermost call.
+        outermost = not getattr(monkey_thread_local, 'wrapping', False)
+        done = None
+        if outermost:
+            monkey_thread_local.wrapping = True
+            if ctx.address:
+                done = Master.latency.timer('handshake', ctx.address)
         try:
             if 'server_hostname' not in kwargs:
                 kwargs['server_hostname'] = ctx.address[0]
             sock = org_sslwrap(sock, *args, **kwargs)
             ctx.encryption = _explain_encryption(sock)
+            if done is not None:
+                done()
         except (socket.error, IOError, ssl.SSLError, ssl.CertificateError) as e:
             ctx.error = '%s' % e
+            if done is not None:
+                done(failed=True)
             raise
+        finally:
+            if outermost:
+                monkey_thread_local.wrapping = False
     return sock
 
 
@@ -1040,7 +1295,11 @@ if __name__ != "__main__":
 
     from mailpile.plugins import PluginManager
     _plugins = PluginManager(builtin=__file__)
-    _plugins.register_commands(NetworkHistory, GetTlsCertificate)
+    _plugins.register_commands(NetworkHistory, NetworkStats,
+                               GetTlsCertificate)
+    _plugins.register_fast_periodic_job(
+        'conn_pool', ConnectionPool.IDLE_TIMEOUT // 4,
+        lambda session: Master.pool.prune())
 
 else:
     import doctest
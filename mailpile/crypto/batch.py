@@ -0,0 +1,151 @@
+"""
+Check the signatures of many messages at once.
+
+While scanning, messages are parsed one at a time and each signature is
+checked as it is found, so every check waits for a gpg process of its
+own. A CryptoBatch instead collects the signed data of a whole batch of
+messages up front and checks it on a few threads at once; the work
+happens in GnuPG, so the threads do not get in each other's way.
+
+The results land in the GnuPG result memo (see GNUPG_RESULTS in
+mailpile.crypto.gpgi), where the scanner finds them when it parses the
+messages for real. The memo is keyed by a digest of the signed data and
+the signature, so re-indexing or re-rendering a message does not check
+its signatures again either.
+
+Only signatures are checked ahead of time: decrypting may require asking
+the user for a passphrase, which has to happen in the context of the
+operation which needs it. Decrypted messages are memoized all the same,
+once the scanner has decrypted them.
+
+>>> msg = email.parser.Parser().parsestr(SIGNED_MESSAGE)
+>>> [(data.split()[-1], sig) for data, sig in PendingVerifications(msg)]
+[('Hello', 'SIG'), ('SIGNATURE-----', None)]
+
+>>> checked = []
+>>> class FakeCrypto(object):
+...     def verify(self, data, signature=None):
+...         checked.append(signature)
+>>> batch = CryptoBatch(FakeCrypto, 2)
+>>> batch.verify([msg, msg])
+2
+>>> batch.close()
+>>> sorted(checked)
+[None, 'SIG']
+"""
+from __future__ import print_function
+import email.parser
+from multiprocessing.pool import ThreadPool
+
+from mailpile.crypto.gpgi import GnuPG
+from mailpile.crypto.mime import SignedPayload
+
+
+def LooksSigned(data):
+    """Cheaply check whether raw message data might contain signatures."""
+    return ('multipart/signed' in data.lower() or
+            GnuPG.ARMOR_BEGIN_SIGNED in data)
+
+
+def PendingVerifications(message):
+    """
+    Yield the (signed data, signature) pairs UnwrapMimeCrypto would check
+    when unwrapping a message, as far as can be told without decrypting.
+    Inline signatures have a signature of None.
+    """
+    for part in message.walk():
+        mimetype = part.get_content_type() or 'text/plain'
+        disposition = part['content-disposition'] or ''
+        if part.is_multipart() and mimetype == 'multipart/signed':
+            try:
+                payload, data, signature = SignedPayload(part)
+                yield data, signature
+            except (ValueError, IndexError, KeyError, TypeError):
+                pass
+        elif (mimetype == 'text/plain' and
+                not disposition.startswith('attachment')):
+            payload = (part.get_payload(None, True) or '').strip()
+            if (payload.startswith(GnuPG.ARMOR_BEGIN_SIGNED) and
+                    payload.endswith(GnuPG.ARMOR_END_SIGNED)):
+                yield payload, None
+
+
+class CryptoBatch(object):
+    """
+    Check the signatures of batches of parsed messages, using a pool of
+    threads. Failures are ignored; the scanner will run into them again
+    and report them as usual.
+    """
+    BATCH_PER_THREAD = 8
+
+    def __init__(self, make_crypto, threads):
+        self.make_crypto = make_crypto
+        self.threads = threads
+        self.pool = None
+
+    def batch_size(self):
+        return self.threads * self.BATCH_PER_THREAD
+
+    def _verify(self, job):
+        try:
+            self.make_crypto().verify(*job)
+        except (IOError, OSError, ValueError, IndexError, KeyError):
+            pass
+
+    def verify(self, messages):
+        """Check the signatures in messages, returning how many we found."""
+        jobs, seen = [], set()
+        for message in messages:
+            for job in PendingVerifications(message):
+                if job not in seen:
+                    seen.add(job)
+                    jobs.append(job)
+        if len(jobs) > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.threads)
+            self.pool.map(self._verify, jobs)
+        elif jobs:
+            self._verify(jobs[0])
+        return len(jobs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+SIGNED_MESSAGE = '\r\n'.join([
+    'Content-Type: multipart/mixed; boundary="outer"',
+    '',
+    '--outer',
+    'Content-Type: multipart/signed; boundary="inner";'
+    ' protocol="application/pgp-signature"',
+    '',
+    '--inner',
+    'Content-Type: text/plain',
+    '',
+    'Hello',
+    '--inner',
+    'Content-Type: application/pgp-signature',
+    '',
+    'SIG',
+    '--inner--',
+    '--outer',
+    'Content-Type: text/plain',
+    '',
+    GnuPG.ARMOR_BEGIN_SIGNED,
+    '...',
+    GnuPG.ARMOR_END_SIGNED,
+    '--outer--',
+    ''])
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
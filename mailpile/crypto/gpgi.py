@@ -1,5 +1,8 @@
 #coding:utf-8
 from __future__ import print_function
+import atexit
+import copy
+import hashlib
 import os
 import string
 import sys
@@ -25,6 +28,7 @@ from mailpile.i18n import gettext
 from mailpile.i18n import ngettext as _n
 from mailpile.crypto.state import *
 from mailpile.crypto.mime import MimeSigningWrapper, MimeEncryptingWrapper
+from mailpile.lru_cache import LRUCache
 from mailpile.safe_popen import Popen, PIPE, Safe_Pipe
 
 
@@ -497,6 +501,332 @@ class StreamWriter(Thread):
             fd.close()
 
 
+class GnuPGCoprocessPool(object):
+    """
+    A pool of GnuPG processes, started ahead of time.
+
+    GnuPG cannot verify or decrypt more than one message per process, so
+    we cannot reuse processes; instead we hide the cost of starting them.
+    For each argument list used recently, the pool keeps a few spare gpg
+    processes running, blocked waiting for input. A caller takes one and
+    a background thread starts a replacement while the caller works.
+
+    Pooled processes report status on a pipe (--status-fd), since naming
+    a temporary status file would make every argument list unique. If an
+    argument is SIG_FD, it is replaced by a pipe for a detached signature
+    (this requires --enable-special-filenames).
+    """
+    SIG_FD = '-&SIGFD'
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, spares=2):
+        self.spares = spares
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pool = {}      # args -> list of (ts, proc, status_fd, sig_fd)
+        self.last_used = {} # args -> ts
+        self.stats = {'taken': 0, 'started': 0, 'expired': 0}
+        self.keep_running = True
+        self.thread = None
+
+    def _start(self, args):
+        status_r, status_w = os.pipe()
+        keep_open = [status_w]
+        sig_r = sig_w = None
+        if self.SIG_FD in args:
+            sig_r, sig_w = os.pipe()
+            keep_open.append(sig_r)
+            args = [('-&%d' % sig_r) if (a == self.SIG_FD) else a
+                    for a in args]
+        args = args[:1] + ['--status-fd=%d' % status_w] + args[1:]
+        try:
+            proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                         bufsize=0, keep_open=keep_open)
+        except:
+            for fd in (status_r, sig_w):
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            for fd in (status_w, sig_r):
+                if fd is not None:
+                    os.close(fd)
+        with self.lock:
+            self.stats['started'] += 1
+        return (time.time(), proc,
+                os.fdopen(status_r, 'rb', 0),
+                os.fdopen(sig_w, 'wb', 0) if (sig_w is not None) else None)
+
+    def _discard(self, entry):
+        ts, proc, status_fd, sig_fd = entry
+        for fd in (proc.stdin, sig_fd):
+            if fd is not None:
+                fd.close()
+        proc.wait()
+        for fd in (proc.stdout, proc.stderr, status_fd):
+            fd.close()
+
+    def take(self, args):
+        """
+        Returns a running (proc, status_fd, sig_fd) tuple for these args,
+        a spare if we have one, otherwise a freshly started process.
+        """
+        key = tuple(args)
+        with self.lock:
+            self.last_used[key] = time.time()
+            self.stats['taken'] += 1
+            spares = self.pool.get(key, [])
+            while spares:
+                entry = spares.pop(0)
+                if entry[1].poll() is None:
+                    self.wakeup.notify()
+                    return entry[1:]
+            self.wakeup.notify()
+            if self.thread is None and self.keep_running:
+                self.thread = threading.Thread(target=self._refill_loop,
+                                               name='GnuPGCoprocessPool')
+                self.thread.daemon = True
+                self.thread.start()
+        return self._start(list(args))[1:]
+
+    def _refill_loop(self):
+        while self.keep_running:
+            with self.lock:
+                self.wakeup.wait(self.IDLE_TIMEOUT / 4)
+            self.refill()
+
+    def refill(self):
+        now = time.time()
+        with self.lock:
+            doomed, wanted = [], []
+            for key, ts in self.last_used.items():
+                spares = self.pool.get(key, [])
+                if ts < now - self.IDLE_TIMEOUT or not self.keep_running:
+                    del self.last_used[key]
+                    doomed.extend(self.pool.pop(key, []))
+                else:
+                    wanted.append((key, self.spares - len(spares)))
+            for key, spares in self.pool.items():
+                if key not in self.last_used:
+                    doomed.extend(self.pool.pop(key))
+            self.stats['expired'] += len(doomed)
+        for entry in doomed:
+            self._discard(entry)
+        for key, count in wanted:
+            for i in range(0, count):
+                try:
+                    entry = self._start(list(key))
+                except (OSError, IOError):
+                    break
+                with self.lock:
+                    if self.keep_running:
+                        self.pool.setdefault(key, []).append(entry)
+                        entry = None
+                if entry is not None:
+                    self._discard(entry)
+
+    def close(self):
+        """Shut down all the spare processes."""
+        with self.lock:
+            self.keep_running = False
+            self.wakeup.notify()
+        self.refill()
+
+
+# Created on demand, if sys.gpg_coprocesses is set
+GNUPG_COPROCESSES = None
+
+
+def GnuPGCoprocesses(spares):
+    global GNUPG_COPROCESSES
+    if GNUPG_COPROCESSES is None:
+        GNUPG_COPROCESSES = GnuPGCoprocessPool(spares)
+        atexit.register(GNUPG_COPROCESSES.close)
+    GNUPG_COPROCESSES.spares = spares
+    return GNUPG_COPROCESSES
+
+
+class GnuPGKeyringCache(object):
+    """
+    Cached key listings for a GnuPG home directory.
+
+    Listings stay valid as long as the keyring files look unchanged (same
+    mtimes and sizes). When keys are imported or deleted through GnuPG,
+    the affected keys are updated in place instead of starting over.
+
+    Keys also expire without the keyring changing, so listings are
+    refreshed once the first key (or subkey) in them expires. The
+    keyring state (which the result memo depends on too) also changes
+    every MAX_AGE seconds, so nothing is trusted for longer than that.
+    """
+    KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'secring.gpg',
+                     'trustdb.gpg', 'private-keys-v1.d')
+    MAX_AGE = 3600
+    CACHES = {}
+    CACHES_LOCK = threading.Lock()
+
+    def __init__(self, homedir):
+        self.homedir = homedir
+        self.lock = threading.Lock()
+        self.state = None
+        self.listings = {}  # (kind, selectors) -> parsed listing
+        self.stale_at = {}  # (kind, selectors) -> when a key expires
+        self.hits = self.misses = 0
+
+    @classmethod
+    def For(cls, gnupg):
+        homedir = (gnupg.homedir or os.getenv('GNUPGHOME') or '~/.gnupg')
+        key = (gnupg.gpgbinary, os.path.abspath(os.path.expanduser(homedir)))
+        with cls.CACHES_LOCK:
+            if key not in cls.CACHES:
+                cls.CACHES[key] = cls(key[1])
+            return cls.CACHES[key]
+
+    def keyring_state(self):
+        state = []
+        for fn in self.KEYRING_FILES:
+            try:
+                st = os.stat(os.path.join(self.homedir, fn))
+                state.append((fn, st.st_mtime, st.st_size))
+            except OSError:
+                pass
+        state.append(int(time.time() // self.MAX_AGE))
+        return tuple(state)
+
+    @classmethod
+    def next_expiry(cls, listing, now):
+        """Return when the first key or subkey in a listing expires."""
+        expiry = None
+        for info in listing.values():
+            if not isinstance(info, dict):
+                continue
+            for k in [info] + list(info.get('subkeys') or []):
+                try:
+                    ts = int(k.get('expiration_date_ts') or 0)
+                except ValueError:
+                    continue
+                if ts > now and (expiry is None or ts < expiry):
+                    expiry = ts
+        return expiry
+
+    def get(self, kind, selectors, lister):
+        """
+        Return a copy of a cached listing, running lister() if needed.
+        """
+        key = (kind, tuple(sorted(set(selectors or []))))
+        with self.lock:
+            state = self.keyring_state()
+            if state != self.state:
+                self.listings = {}
+                self.stale_at = {}
+            now = time.time()
+            listing = self.listings.get(key)
+            if listing is not None and now >= self.stale_at.get(key, now+1):
+                listing = None
+            if listing is None:
+                self.misses += 1
+                listing = lister()
+                # If the keyring changed while we were listing (GnuPG may
+                # update the trustdb), our other listings may be stale.
+                self.state = self.keyring_state()
+                if self.state != state:
+                    self.listings = {}
+                    self.stale_at = {}
+                self.listings[key] = listing
+                self.stale_at.pop(key, None)
+                if isinstance(listing, dict):
+                    expiry = self.next_expiry(listing, now)
+                    if expiry is not None:
+                        self.stale_at[key] = expiry
+            else:
+                self.hits += 1
+            return copy.deepcopy(listing)
+
+    def changed(self, before, fingerprints, refresh=None):
+        """
+        Update our listings after we changed some keys. The keyring state
+        before the change tells us whether our listings were up to date.
+        If refresh is None the keys were deleted, otherwise refresh(fprs)
+        must return a fresh public key listing for them.
+        """
+        fingerprints = set(fingerprints)
+        with self.lock:
+            if before != self.state or not fingerprints:
+                self.listings = {}
+                self.stale_at = {}
+                self.state = None
+                return
+
+            fresh = refresh(list(fingerprints)) if refresh else {}
+            for key, listing in self.listings.items():
+                kind, selectors = key
+                if refresh is None:
+                    for fprint in fingerprints:
+                        listing.pop(fprint, None)
+                elif kind == 'public' and not selectors:
+                    listing.update(fresh)
+                    for fprint in fingerprints - set(fresh):
+                        listing.pop(fprint, None)
+                else:
+                    # We cannot tell whether these should change; they will
+                    # be listed again when needed.
+                    del self.listings[key]
+                    self.stale_at.pop(key, None)
+                    continue
+                expiry = self.next_expiry(listing, time.time())
+                if expiry is not None:
+                    self.stale_at[key] = min(expiry,
+                                             self.stale_at.get(key, expiry))
+            self.state = self.keyring_state()
+
+    def stats(self):
+        with self.lock:
+            return {'homedir': self.homedir,
+                    'listings': len(self.listings),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class GnuPGResultMemo(object):
+    """
+    Remembers the results of checking signatures and decrypting, keyed by
+    a digest of the data, so the same blob is never processed twice.
+
+    Results are only reused while the keyring looks unchanged, since new
+    keys (or trust) can change what a signature check says. Only
+    successful decryptions are remembered, as a missing passphrase or key
+    may turn up later. Plaintext is only ever kept in memory.
+    """
+    def __init__(self, max_entries=5000, max_bytes=32 * 1024 * 1024):
+        self.cache = LRUCache('gnupg-results',
+                              max_entries=max_entries, max_bytes=max_bytes)
+
+    def key(self, keyring, op, *args):
+        digest = hashlib.sha256()
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode('utf-8')
+            arg = arg or ''
+            digest.update('%d:' % len(arg))
+            digest.update(arg)
+        return (keyring.homedir, op, digest.digest())
+
+    def get(self, key, state):
+        found = self.cache.get(key)
+        if found is None or found[0] != state:
+            return None
+        return copy.deepcopy(found[1])
+
+    def put(self, key, state, result, size=0):
+        self.cache.put(key, (state, copy.deepcopy(result)), size=size + 512)
+
+    def clear(self):
+        self.cache.clear()
+
+
+GNUPG_RESULTS = GnuPGResultMemo()
+
+
 DEBUG_GNUPG = False
 
 class GnuPG:
@@ -548,6 +878,9 @@ class GnuPG:
         self.dry_run = dry_run
         self.debug = (self._debug_all if (debug or DEBUG_GNUPG)
                       else self._debug_none)
+        self.coprocesses = (self.config and self.config.sys.gpg_coprocesses
+                            and GnuPGCoprocesses(
+                                self.config.sys.gpg_coprocesses)) or None
 
     def prepare_passphrase(self, keyid, signing=False, decrypting=False):
         """Query the Mailpile secrets for a usable passphrase."""
@@ -620,7 +953,7 @@ class GnuPG:
     def common_args(self,
                     args=None, version=None,
                     will_send_passphrase=False,
-                    interactive=False):
+                    interactive=False, status_file=True):
         if args is None:
             args = []
         if version is None:
@@ -639,13 +972,15 @@ class GnuPG:
             args.insert(1, "--homedir=%s" % self.homedir)
 
         if version > (2, 1, 11):
-            binaries = mailpile.platforms.DetectBinaries()
+            # Note: We ask for one binary at a time, as those lookups are
+            #       cached. Detecting all of them runs a bunch of processes.
             for which, setting in (('GnuPG_dirmngr', 'dirmngr-program'),
                                    ('GnuPG_agent',   'agent-program')):
-                if which in binaries:
-                    args.insert(1, "--%s=%s" % (setting, binaries[which]))
+                binary = mailpile.platforms.DetectBinaries(which=which)
+                if binary:
+                    args.insert(1, "--%s=%s" % (setting, binary))
                 else:
-                    print('wtf: %s not in %s' % (which, binaries))
+                    print('wtf: %s not found' % which)
 
         if (not self.use_agent) or will_send_passphrase:
             if version < (1, 5):
@@ -660,7 +995,7 @@ class GnuPG:
             args.insert(1, "--verbose")
             args.insert(1, "--batch")
             args.insert(1, "--enable-progress-filter")
-            if self.status_filenames:
+            if self.status_filenames and status_file:
                 args.insert(1, "--status-file=%s" % self.status_filenames[-1])
             if will_send_passphrase:
                 args.insert(2, "--passphrase-fd=0")
@@ -670,7 +1005,15 @@ class GnuPG:
 
         return args
 
+    def pooled(self):
+        """Should we use pre-started GnuPG processes?"""
+        return bool(self.coprocesses and not self.dry_run)
+
     def run(self, *args, **kwargs):
+        # Pooled processes report their status on a pipe instead.
+        if kwargs.get('pooled'):
+            return self.run_without_status(*args, **kwargs)
+
         # This wrapper handles temporary status files. Since we may recursively
         # invoke ourselves, we keep a stack of tempfiles and push/pop from the
         # list.
@@ -684,7 +1027,8 @@ class GnuPG:
 
     def run_without_status(self,
             args=None, gpg_input=None, outputfd=None, partial_read_ok=False,
-            send_passphrase=False, _raise=None, novercheck=False):
+            send_passphrase=False, _raise=None, novercheck=False,
+            pooled=False, signature=None):
         if novercheck:
             version = (1, 4)
         else:
@@ -693,12 +1037,13 @@ class GnuPG:
         args = self.common_args(
             args=list(args if args else []),
             version=version,
-            will_send_passphrase=(self.passphrase and send_passphrase))
+            will_send_passphrase=(self.passphrase and send_passphrase),
+            status_file=not pooled)
 
         self.outputbuffers = dict([(x, []) for x in self.outputfds])
         self.threads = {}
         gpg_retcode = -1
-        proc = None
+        proc = status_fd = sig_fd = None
         try:
             if send_passphrase and (self.passphrase is None):
                 self.debug('Running WITHOUT PASSPHRASE %s' % ' '.join(args))
@@ -708,7 +1053,11 @@ class GnuPG:
 
             # Here we go!
             self.event.update_args(args)
-            proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0)
+            if pooled:
+                proc, status_fd, sig_fd = self.coprocesses.take(args)
+            else:
+                proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                             bufsize=0)
 
             # GnuPG is a bit crazy, and requires that the passphrase
             # be sent and the filehandle closed before anything else
@@ -728,6 +1077,13 @@ class GnuPG:
                                        proc.stderr, self.parse_stderr)
             }
 
+            if status_fd:
+                self.threads["status"] = StreamReader(
+                    'gpgi-status(%s)' % wtf, status_fd, self.parse_status)
+            if sig_fd:
+                self.threads["signature"] = StreamWriter(
+                    'gpgi-signature(%s)' % wtf, sig_fd, signature or '')
+
             if outputfd:
                 self.threads["stdout"] = StreamReader(
                     'gpgi-stdout-to-fd(%s)' % wtf,
@@ -751,7 +1107,7 @@ class GnuPG:
             gpg_retcode = proc.wait()
 
             # Consume the contents of the status file
-            if self.status_filenames:
+            if self.status_filenames and not pooled:
                 with open(self.status_filenames[-1], 'r') as status_fd:
                     for line in iter(status_fd.readline, b''):
                         self.parse_status(line)
@@ -805,12 +1161,19 @@ class GnuPG:
         rlp = GnuPGRecordParser()
         return rlp.parse(keylist)
 
+    def keyring_cache(self):
+        return GnuPGKeyringCache.For(self)
+
     def list_keys(self, selectors=None):
         """
         >>> g = GnuPG(None)
         >>> g.list_keys()[0]
         0
         """
+        return self.keyring_cache().get('public', selectors,
+                                        lambda: self._list_keys(selectors))
+
+    def _list_keys(self, selectors=None):
         list_keys = ["--fingerprint"]
         for sel in set(selectors or []):
             list_keys += ["--list-keys", sel]
@@ -822,6 +1185,10 @@ class GnuPG:
         return self.parse_keylist(retvals[1]["stdout"])
 
     def list_secret_keys(self, selectors=None):
+        return self.keyring_cache().get(
+            'secret', selectors, lambda: self._list_secret_keys(selectors))
+
+    def _list_secret_keys(self, selectors=None):
         #
         # Note: The selectors that are passed by default work around a bug
         #       in GnuPG < 2.1, where --list-secret-keys does not list
@@ -886,8 +1253,15 @@ class GnuPG:
             cmd[1:1] = ['--import-filter', 'keep-uid=%s' % expr]
         for opt in import_options:
             cmd[1:1] = ['--import-options', opt]
+        before = self.keyring_cache().keyring_state()
         retvals = self.run(cmd, gpg_input=key_data)
-        return self._parse_import(retvals[1]["status"])
+        return self._imported(before, self._parse_import(retvals[1]["status"]))
+
+    def _imported(self, before, results):
+        self.keyring_cache().changed(before,
+            [k['fingerprint'] for k in results['imported'] + results['updated']],
+            refresh=self._list_keys)
+        return results
 
     def _parse_import(self, output):
         res = {"imported": [], "updated": [], "failed": []}
@@ -955,6 +1329,15 @@ class GnuPG:
         >>> g.decrypt(ct)["text"]
         'Hello, World'
         """
+        memo = (outputfd is None and not as_lines)
+        if memo:
+            memo_state = self.keyring_cache().keyring_state()
+            memo_key = GNUPG_RESULTS.key(self.keyring_cache(), 'decrypt',
+                                         data, str(require_MDC))
+            found = GNUPG_RESULTS.get(memo_key, memo_state)
+            if found is not None:
+                return found
+
         if passphrase is not None:
             self.passphrase = passphrase.get_reader()
         elif GnuPG.LAST_KEY_USED:
@@ -968,7 +1351,8 @@ class GnuPG:
         for tries in (1, 2):
             retvals = self.run(["--decrypt"], gpg_input=data,
                                               outputfd=outputfd,
-                                              send_passphrase=True)
+                                              send_passphrase=True,
+                                              pooled=self.pooled())
             if tries == 1:
                 keyid = None
                 for msg in reversed(retvals[1]['status']):
@@ -995,8 +1379,12 @@ class GnuPG:
 
         rp = GnuPGResultParser(decrypt_requires_MDC=require_MDC,
                                debug=self.debug).parse(retvals)
-        return (rp.signature_info, rp.encryption_info,
-                as_lines or rp.plaintext)
+        result = (rp.signature_info, rp.encryption_info,
+                  as_lines or rp.plaintext)
+        if memo and rp.encryption_info['status'] == 'decrypted':
+            GNUPG_RESULTS.put(memo_key, memo_state, result,
+                              size=len(rp.plaintext or ''))
+        return result
 
     def base64_segment(self, dec_start, dec_end, skip, line_len, line_end = 2):
         """
@@ -1238,8 +1626,19 @@ class GnuPG:
             clearsign=True)[1]
         >>> g.verify(s)
         """
+        memo_state = self.keyring_cache().keyring_state()
+        memo_key = GNUPG_RESULTS.key(self.keyring_cache(), 'verify',
+                                     data, signature)
+        found = GNUPG_RESULTS.get(memo_key, memo_state)
+        if found is not None:
+            return found
+
         params = ["--verify"]
-        if signature:
+        pooled = self.pooled()
+        if signature and pooled:
+            params[:0] = ["--enable-special-filenames"]
+            params += ["--", GnuPGCoprocessPool.SIG_FD, "-"]
+        elif signature:
             sig = tempfile.NamedTemporaryFile()
             sig.write(signature)
             sig.flush()
@@ -1248,10 +1647,14 @@ class GnuPG:
 
         self.event.running_gpg(_('Checking signature in %d bytes of data'
                                  ) % len(data))
-        ret, retvals = self.run(params, gpg_input=data, partial_read_ok=True)
+        ret, retvals = self.run(params, gpg_input=data, partial_read_ok=True,
+                                pooled=pooled, signature=signature)
 
         rp = GnuPGResultParser(debug=self.debug)
-        return rp.parse([None, retvals]).signature_info
+        si = rp.parse([None, retvals]).signature_info
+        if si['status'] != 'error':
+            GNUPG_RESULTS.put(memo_key, memo_state, si)
+        return si
 
     def encrypt(self, data, tokeys=[], armor=True,
                             sign=False, fromkey=None, throw_keyids=False):
@@ -1331,13 +1734,18 @@ class GnuPG:
 
         self.event.running_gpg(_('Signing key %s with %s'
                                  ) % (keyid, signingkey or _('default')))
+        before = self.keyring_cache().keyring_state()
         retvals = self.run(action, send_passphrase=True)
+        self.keyring_cache().changed(before, [keyid], refresh=self._list_keys)
 
         return retvals
 
     def delete_key(self, key_fingerprint):
         cmd = ['--yes', '--delete-secret-and-public-key', key_fingerprint]
-        return self.run(cmd)
+        before = self.keyring_cache().keyring_state()
+        retvals = self.run(cmd)
+        self.keyring_cache().changed(before, [key_fingerprint])
+        return retvals
 
     def recv_key(self, keyid,
                  keyservers=DEFAULT_KEYSERVERS,
@@ -1346,6 +1754,7 @@ class GnuPG:
             keyid = '0x%s' % keyid
         self.event.running_gpg(_('Downloading key %s from key servers'
                                  ) % (keyid))
+        before = self.keyring_cache().keyring_state()
         for keyserver in keyservers:
             cmd = ['--keyserver', keyserver,
                    '--recv-key', self._escape_hex_keyid_term(keyid)]
@@ -1354,7 +1763,7 @@ class GnuPG:
             retvals = self.run(cmd)
             if 'unsupported' not in ''.join(retvals[1]["stdout"]):
                 break
-        return self._parse_import(retvals[1]["status"])
+        return self._imported(before, self._parse_import(retvals[1]["status"]))
 
     def parse_hpk_response(self, lines):
         results = {}
@@ -149,6 +149,23 @@ def MimeReplacePart(part, newpart, keep_old_headers=False):
     return copied
 
 
+def SignedPayload(part):
+    """
+    Split a multipart/signed part into its payload (a Message), the data
+    which was signed and the signature itself.
+    """
+    boundary = part.get_boundary()
+    payload, signature = part.get_payload()
+
+    # The Python get_payload() method likes to rewrite headers,
+    # which breaks signature verification. So we manually parse
+    # out the raw payload here.
+    head, raw_payload, junk = part.as_string(
+        ).replace('\r\n', '\n').split('\n--%s\n' % boundary, 2)
+
+    return payload, Normalize(raw_payload), signature.get_payload()
+
+
 def UnwrapMimeCrypto(part, protocols=None, psi=None, pei=None, charsets=None,
                      unwrap_attachments=True, require_MDC=True,
                      depth=0, sibling=0, efail_unsafe=False, allow_decrypt=True):
@@ -184,17 +201,8 @@ def UnwrapMimeCrypto(part, protocols=None, psi=None, pei=None, charsets=None,
 
     if part.is_multipart() and mimetype == 'multipart/signed':
         try:
-            boundary = part.get_boundary()
-            payload, signature = part.get_payload()
-
-            # The Python get_payload() method likes to rewrite headers,
-            # which breaks signature verification. So we manually parse
-            # out the raw payload here.
-            head, raw_payload, junk = part.as_string(
-                ).replace('\r\n', '\n').split('\n--%s\n' % boundary, 2)
-
-            part.signature_info = crypto_cls().verify(
-                Normalize(raw_payload), signature.get_payload())
+            payload, signed_data, signature = SignedPayload(part)
+            part.signature_info = crypto_cls().verify(signed_data, signature)
             part.signature_info.bubble_up(psi)
 
             # Reparent the contents up, removing the signature wrapper
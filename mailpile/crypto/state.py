@@ -42,6 +42,17 @@ class CryptoInfo(dict):
         else:
             self.update(self.DEFAULTS)
 
+    def __reduce__(self):
+        # Pickle our attributes and items together, so they can be restored
+        # without going through __setitem__ (which needs the attributes).
+        return (self.__class__, (), (self.__dict__, dict(self)))
+
+    def __setstate__(self, state):
+        attrs, items = state
+        self.__dict__.update(attrs)
+        dict.clear(self)
+        dict.update(self, items)
+
     part_status = property(lambda self: (self._status or
                                          self.DEFAULTS["status"]),
                            lambda self, v: self._set_status(v))
@@ -262,6 +262,143 @@ class ReadLineIOFilter(IOFilter):
             self._maybe_flush(eof=True)
 
 
+class SyncIOFilter(object):
+    """
+    This is a synchronous alternative to IOFilter.reader(): data is read
+    from the filehandle and filtered on demand, in the calling thread, so
+    no thread or pipe is needed.
+
+    If start_data or stop_check are given, input is processed line by
+    line (like ReadLineIOFilter), stopping after the line stop_check
+    matches.
+    """
+    BLOCKSIZE = IOFilter.BLOCKSIZE
+
+    def __init__(self, fd, callback, name=None, blocksize=None,
+                 start_data=None, stop_check=None):
+        self.fd = fd
+        self.callback = callback
+        self.name = name
+        self.blocksize = blocksize or self.BLOCKSIZE
+        self.by_line = (start_data is not None or stop_check is not None)
+        self.stop_check = stop_check
+        self.buffered = list(start_data or [])
+        self.buf_bytes = sum(len(s) for s in self.buffered)
+        self.output = []
+        self.out_bytes = 0
+        self.eof = False
+
+    def __str__(self):
+        return 'SyncIOFilter(%s)' % (self.name or self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def reader(self):
+        return self
+
+    def join(self, aborting=None):
+        pass
+
+    def close(self):
+        # Make sure the file is left where a threaded filter would have
+        # left it, after the stop line, even if not all data was read.
+        if self.by_line and not self.eof:
+            for line in self.fd:
+                if self.stop_check and self.stop_check(line):
+                    break
+        self.eof = True
+        self.output = []
+        self.out_bytes = 0
+
+    def _pump_lines(self):
+        stopped = True
+        for line in self.fd:
+            self.buffered.append(line)
+            if line.strip():
+                # Don't count blank lines
+                self.buf_bytes += len(line)
+            if self.stop_check and self.stop_check(line):
+                break
+            if self.buf_bytes >= self.blocksize:
+                stopped = False
+                break
+
+        output = [self.callback(''.join(self.buffered))]
+        self.buffered = []
+        self.buf_bytes = 0
+        while stopped:
+            output.append(self.callback(None) or '')
+            if not output[-1]:
+                self.eof = True
+                break
+        return ''.join(output)
+
+    def pump(self):
+        """Filter another block of input. Returns False at EOF."""
+        if self.eof:
+            return False
+        if self.by_line:
+            data = self._pump_lines()
+        else:
+            data = self.fd.read(self.blocksize)
+            if data:
+                data = self.callback(data)
+            else:
+                data = self.callback(None) or ''
+                self.eof = True
+        if data:
+            self.output.append(data)
+            self.out_bytes += len(data)
+        return True
+
+    def _take(self, size):
+        data = ''.join(self.output)
+        if size < len(data):
+            self.output = [data[size:]]
+            self.out_bytes = len(data) - size
+            return data[:size]
+        self.output = []
+        self.out_bytes = 0
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self.pump():
+                pass
+            return self._take(self.out_bytes)
+        while self.out_bytes < size and self.pump():
+            pass
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while not (self.output and '\n' in self.output[-1]):
+            if not self.pump():
+                break
+        data = ''.join(self.output)
+        eol = data.find('\n') + 1 or len(data)
+        if size is not None and 0 <= size < eol:
+            eol = size
+        self.output = [data]
+        self.out_bytes = len(data)
+        return self._take(eol)
+
+    def readlines(self, *args):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration()
+        return line
+
+
 class IOCoprocess(object):
     def __init__(self, command, fd, name=None, long_running=False):
         self.stderr = ''
@@ -691,6 +828,11 @@ def EncryptingStreamer(*args, **kwargs):
 class DecryptingStreamer(InputCoprocess):
     """
     This class creates a coprocess for decrypting data.
+
+    By default (in_process=True), data is decrypted on demand as it is
+    read, in the calling thread; a filter thread and external coprocess
+    are only used for formats we cannot decrypt ourselves (legacy
+    OpenSSL ciphers and PGP).
     """
     BEGIN_PGP = "-----BEGIN PGP MESSAGE-----"
     END_PGP = "-----END PGP MESSAGE-----"
@@ -721,7 +863,8 @@ class DecryptingStreamer(InputCoprocess):
 
     def __init__(self, fd,
                  mep_key=None, gpg_pass=None, sha256=None, cipher=None,
-                 name=None, long_running=False, gpgi=None, md_alg=None):
+                 name=None, long_running=False, gpgi=None, md_alg=None,
+                 in_process=True):
         self.expected_outer_sha256 = sha256
         self.expected_inner_sha256 = None
         self.expected_inner_md5sum = None
@@ -745,14 +888,31 @@ class DecryptingStreamer(InputCoprocess):
         # Start reading our data...
         self.startup_lock = CryptoLock()
         self.startup_lock.acquire()
-        self.data_filter = self._mk_data_filter(fd, self._read_data,
-                                                self.startup_lock.release)
+        if in_process:
+            self.data_filter = self._mk_sync_filter(fd, self._read_data)
+        else:
+            self.data_filter = self._mk_data_filter(fd, self._read_data,
+                                                    self.startup_lock.release)
         self.read_fd = self.data_filter.reader()
         try:
+            if in_process:
+                # Process data in this thread until the header is parsed
+                while self.state == self.STATE_BEGIN:
+                    if not self.data_filter.pump():
+                        break
+
             # Once the header has been processed (_read_data() will release
             # the lock), fork out our coprocess.
             self.startup_lock.acquire()
-            InputCoprocess.__init__(self, self._mk_command(), self.read_fd,
+            command = self._mk_command()
+            if in_process and command:
+                # External commands need a real file descriptor to read
+                # from, so we fall back to a filter thread and a pipe.
+                self.data_filter = IOFilter(
+                    self.data_filter, lambda d: d or '',
+                    name='%s/filter' % (self.name or 'ds'))
+                self.read_fd = self.data_filter.reader()
+            InputCoprocess.__init__(self, command, self.read_fd,
                                     name=name, long_running=long_running)
         except:
             try:
@@ -821,13 +981,15 @@ class DecryptingStreamer(InputCoprocess):
         return IOFilter(fd, cb, error_callback=ecb,
                         name='%s/filter' % (self.name or 'ds'))
 
+    def _mk_sync_filter(self, fd, cb):
+        return SyncIOFilter(fd, cb, name='%s/sync' % (self.name or 'ds'))
+
     def _read_data(self, data):
         def process(data):
             if self.decryptor is not None:
                 eof = not data
                 if self.decoder_data_bytes and data:
-                    self.buffered += ''.join([c for c in data if c not in
-                                              (' ', '\t', '\r', '\n')])
+                    self.buffered += data.translate(None, ' \t\r\n')
                 else:
                     self.buffered += (data or '')
                 data = ''
@@ -1012,6 +1174,12 @@ class PartialDecryptingStreamer(DecryptingStreamer):
                                 error_callback=ecb,
                                 name='%s/rlfilter' % (self.name or 'ds'))
 
+    def _mk_sync_filter(self, fd, cb):
+        return SyncIOFilter(fd, cb,
+                            start_data=self.start_data,
+                            stop_check=self.EndEncrypted,
+                            name='%s/rlsync' % (self.name or 'ds'))
+
 
 if __name__ == "__main__":
     import random  # See! Not in the main module!
@@ -1219,6 +1387,33 @@ U2FsdGVkX19U8G7SKp8QygUusdHZThlrLcI04+jZ9U5kwfsw7bJJ2721dwgIpCUh
         os.unlink(fn)
       print()
 
+    print('Benchmark: in-process vs. threaded aes-128-ctr decryption')
+    fn = '/tmp/enc-benchmark.tmp'
+    for size, count in ((1024, 200), (10 * 1024 * 1024, 2)):
+        data = ('Hello world! This is great!\n' * (size // 28 + 1))[:size]
+        with EncryptingStreamer('test key', dir='/tmp', delimited=True,
+                                cipher='aes-128-ctr') as es:
+            es.write(data)
+            es.finish()
+            es.save(fn)
+            mac = es.outer_mac_sha256()
+        for in_process in (False, True):
+            t0 = time.time()
+            for i in range(0, count):
+                with open(fn, 'rb') as bfd:
+                    with PartialDecryptingStreamer(
+                            [], bfd, mep_key='test key', sha256=mac,
+                            in_process=in_process) as ds:
+                        _assert(ds.read(), data)
+                        _assert(ds.verify(testing=True))
+            elapsed = time.time() - t0
+            print(' => %d x %d bytes, %s: %.3fs (%.2f MB/s)'
+                  % (count, size, in_process and 'in-process' or 'threaded',
+                     elapsed, count * size / (1024 * 1024 * elapsed)))
+    os.unlink(fn)
+    _assert(fdcheck('Benchmark'))
+    print()
+
     _assert(len(DETECTED_OBSOLETE_FORMATS) > 0)
     print('Obsolete formats detected: %s' % DETECTED_OBSOLETE_FORMATS)
 
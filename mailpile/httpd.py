@@ -15,12 +15,15 @@ import SocketServer
 import time
 import threading
 import traceback
+import zlib
+from collections import deque
 from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 from urllib import quote, unquote
 from urlparse import parse_qs, urlparse
 
 import mailpile.util
 import mailpile.security as security
+from mailpile.commands import COMMANDS
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.urlmap import UrlMap
@@ -46,6 +49,51 @@ def Idle_HTTPD(allowed=1):
         return BLOCK_HTTPD_LOCK
 
 
+# Responses larger than this are streamed in blocks of this size, instead
+# of being compressed (or read from disk) in one go.
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class ChunkedWriter(object):
+    """Write a response body using HTTP/1.1 chunked transfer encoding."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:  # An empty chunk would mark the end of the body
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def close(self):
+        self.wfile.write('0\r\n\r\n')
+
+
+class GzipWriter(object):
+    """Compress a response body incrementally, as it is written."""
+    def __init__(self, wfile, level=6):
+        self.wfile = wfile
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+: gzip framing
+
+    def write(self, data):
+        self.wfile.write(self.compressor.compress(data))
+
+    def close(self):
+        self.wfile.write(self.compressor.flush())
+        self.wfile.close()
+
+
+class ClosingWriter(object):
+    """Write a response body of unknown length to an HTTP/1.0 client."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        self.wfile.write(data)
+
+    def close(self):
+        pass
+
+
 class HttpRequestHandler(SimpleXMLRPCRequestHandler):
     # Allow persistent HTTP/1.1 connections
     protocol_version = 'HTTP/1.1'
@@ -83,6 +131,32 @@ class HttpRequestHandler(SimpleXMLRPCRequestHandler):
     _NEWLINE_RE = re.compile('[\r\n]+')
     _HTML_RE = re.compile('[<>\'\"]+')
 
+    def setup(self):
+        if isinstance(self.request, HttpConnection):
+            # Pooled connections keep their files from request to request,
+            # so no buffered (pipelined) data gets lost in between.
+            self.connection = self.request.sock
+            self.rfile = self.request.rfile
+            self.wfile = self.request.wfile
+        else:
+            SimpleXMLRPCRequestHandler.setup(self)
+
+    def handle(self):
+        if isinstance(self.request, HttpConnection):
+            # Handle a single request; the pool decides what happens next.
+            self.close_connection = 1
+            self.handle_one_request()
+            self.request.keep_alive = not self.close_connection
+        else:
+            SimpleXMLRPCRequestHandler.handle(self)
+
+    def finish(self):
+        if isinstance(self.request, HttpConnection):
+            if not self.wfile.closed:
+                self.wfile.flush()
+        else:
+            SimpleXMLRPCRequestHandler.finish(self)
+
     def assert_no_newline(self, data):
         if re.search(self._NEWLINE_RE, str(data) or '') is not None:
             raise ValueError()
@@ -212,6 +286,21 @@ class HttpRequestHandler(SimpleXMLRPCRequestHandler):
                               and not send any response body
         """
         message = unicode(message).encode('utf-8')
+        if (not suppress_body and
+                len(message) > STREAM_BLOCK_SIZE and
+                self._can_gzip(message)):
+            # Large responses get compressed and sent a block at a time,
+            # so we never hold a second, compressed copy in memory.
+            self.log_request(code, len(message))
+            wfile = self.start_streaming_response(
+                code=code, msg=msg, mimetype=mimetype,
+                header_list=header_list, cachectrl=(cachectrl or "no-cache"),
+                compress=True, full_size=len(message))
+            for i in range(0, len(message), STREAM_BLOCK_SIZE):
+                wfile.write(message[i:i + STREAM_BLOCK_SIZE])
+            wfile.close()
+            return
+
         self.log_request(code, message and len(message) or '-')
         # Send HTTP/1.1 header
         self.send_http_response(code, msg)
@@ -230,6 +319,42 @@ class HttpRequestHandler(SimpleXMLRPCRequestHandler):
         if not suppress_body:
             self.wfile.write(message or '')
 
+    def start_streaming_response(self,
+                                 code=200, msg='OK',
+                                 mimetype='text/html', header_list=[],
+                                 cachectrl='private',
+                                 compress=False, full_size=None):
+        """
+        Sends the HTTP header for a response body of unknown length, and
+        returns a file-like object for writing the body. The caller must
+        close() it when done.
+
+        The body is sent using chunked transfer encoding, or by closing
+        the connection when done if the client only speaks HTTP/1.0.
+
+        compress      -- Set this to True to gzip the body as it is written
+        full_size     -- The uncompressed size of the body, if known
+        """
+        headers = []
+        if self.request_version == 'HTTP/1.1':
+            headers.append(('Transfer-Encoding', 'chunked'))
+            wfile = ChunkedWriter(self.wfile)
+        else:
+            self.close_connection = 1
+            headers.append(('Connection', 'close'))
+            wfile = ClosingWriter(self.wfile)
+        if compress:
+            headers.append(('Content-Encoding', 'gzip'))
+            if full_size is not None:
+                headers.append(('X-Full-Size', '%s' % full_size))
+            wfile = GzipWriter(wfile)
+
+        self.send_http_response(code, msg)
+        self.send_standard_headers(header_list=(header_list + headers),
+                                   mimetype=mimetype,
+                                   cachectrl=cachectrl)
+        return wfile
+
     def guess_mimetype(self, fpath):
         ext = os.path.basename(fpath).rsplit('.')[-1]
         return (self._MIMETYPE_MAP.get(ext.lower()) or
@@ -243,13 +368,14 @@ class HttpRequestHandler(SimpleXMLRPCRequestHandler):
         data = '%s-%s' % (self.server.secret, '-'.join((str(a) for a in args)))
         return hashlib.md5(data).hexdigest()
 
-    def _maybe_gzip(self, data, msg_size, headers):
-        if (data and
-                (len(data) > 1400) and
-                (data[:2] not in ('\xff\xd8', '\x89\x50', # JPEG, PNG
+    def _can_gzip(self, data):
+        return ((data[:2] not in ('\xff\xd8', '\x89\x50', # JPEG, PNG
                                   '\x1f\x8b', 'BZ', 'PK' # GZIP, BZIP, PKZIP
                                   )) and
-                ('gzip' in self.headers.get('accept-encoding', ''))):
+                ('gzip' in self.headers.get('accept-encoding', '')))
+
+    def _maybe_gzip(self, data, msg_size, headers):
+        if data and (len(data) > 1400) and self._can_gzip(data):
             gzipped = cStringIO.StringIO()
             with gzip.GzipFile(fileobj=gzipped, mode='w') as fd:
                 fd.write(data)
@@ -262,44 +388,133 @@ class HttpRequestHandler(SimpleXMLRPCRequestHandler):
         headers.append(('Content-Length', '%s' % msg_size))
         return data, headers
 
+    def _open_precompressed(self, config, tpl, filename, mtime):
+        """Open a pre-gzipped variant of a static file, if it is current."""
+        if 'gzip' not in self.headers.get('accept-encoding', ''):
+            return None, None
+        try:
+            gz_path, gz_fd, gz_mt = config.open_file(tpl, filename + '.gz')
+            if os.path.getmtime(gz_path) >= mtime:
+                return gz_path, gz_fd
+            gz_fd.close()
+        except (IOError, OSError, ValueError):
+            pass
+        return None, None
+
+    def _send_fd(self, fd, size):
+        """Copy size bytes from a file to the client, using sendfile if we can."""
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile and isinstance(self.wfile, socket._fileobject):
+            self.wfile.flush()
+            offset, out_fd = 0, self.connection.fileno()
+            while offset < size:
+                sent = sendfile(out_fd, fd.fileno(), offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+        else:
+            while size > 0:
+                data = fd.read(min(size, STREAM_BLOCK_SIZE))
+                if not data:
+                    break
+                self.wfile.write(data)
+                size -= len(data)
+
     def send_file(self, config, filename, suppress_body=False):
         # FIXME: Do we need more security checks?
+        fd = None
+        headers = []
+        mimetype = 'text/plain'
         if '..' in filename:
             code, msg = 403, "Access denied"
         else:
             try:
                 tpl = config.sys.path.get(self.http_host(), 'html_theme')
                 fpath, fd, mt = config.open_file(tpl, filename)
-                with fd:
-                    mimetype = mt or self.guess_mimetype(fpath)
-                    msg_size = os.path.getsize(fpath)
-                    if not suppress_body:
-                        message = fd.read()
-                    else:
-                        message = None
+                mimetype = mt or self.guess_mimetype(fpath)
+                msg_size = os.path.getsize(fpath)
+                mtime = os.path.getmtime(fpath)
                 code, msg = 200, "OK"
             except IOError as e:
-                mimetype = 'text/plain'
                 if e.errno == 2:
                     code, msg = 404, "File not found"
                 elif e.errno == 13:
                     code, msg = 403, "Access denied"
                 else:
                     code, msg = 500, "Internal server error"
-                message = None
                 msg_size = 0
 
         # Note: We assume the actual static content almost never varies
-        #       on a given Mailpile instance, thuse the long TTL and no
-        #       ETag for conditional loads.
+        #       on a given Mailpile instance, thus the long TTL. The ETag
+        #       allows cheap conditional reloads once that expires.
+        cachectrl = 'must-revalidate, max-age=36000'
+        if fd is None:
+            self.log_request(code, '-')
+            self.send_http_response(code, msg)
+            self.send_standard_headers(header_list=[('Content-Length', '0')],
+                                       mimetype=mimetype,
+                                       cachectrl=cachectrl)
+            return
 
-        message, headers = self._maybe_gzip(message, msg_size, [])
-        self.log_request(code, msg_size if (message is not None) else '-')
-        self.send_http_response(code, msg)
-        self.send_standard_headers(header_list=headers,
-                                   mimetype=mimetype,
-                                   cachectrl='must-revalidate, max-age=36000')
-        self.wfile.write(message or '')
+        try:
+            etag = self._mk_etag(fpath, msg_size, mtime)
+            headers.extend([('ETag', etag), ('Vary', 'Accept-Encoding')])
+            if self.headers.get('if-none-match') == etag:
+                self.log_request(304, '-')
+                self.send_http_response(304, 'Unmodified')
+                self.send_standard_headers(header_list=headers,
+                                           mimetype=mimetype,
+                                           cachectrl=cachectrl)
+                return
+
+            gz_path, gz_fd = self._open_precompressed(
+                config, tpl, filename, mtime)
+            if gz_fd is not None:
+                fd.close()
+                fd, gz_size = gz_fd, os.path.getsize(gz_path)
+                headers.extend([('Content-Length', '%s' % gz_size),
+                                ('X-Full-Size', '%s' % msg_size),
+                                ('Content-Encoding', 'gzip')])
+                body_size = gz_size
+
+            elif msg_size <= STREAM_BLOCK_SIZE:
+                message = fd.read()
+                message, headers = self._maybe_gzip(message, msg_size, headers)
+                self.log_request(code, msg_size)
+                self.send_http_response(code, msg)
+                self.send_standard_headers(header_list=headers,
+                                           mimetype=mimetype,
+                                           cachectrl=cachectrl)
+                if not suppress_body:
+                    self.wfile.write(message)
+                return
+
+            else:
+                first = fd.read(STREAM_BLOCK_SIZE)
+                if not suppress_body and self._can_gzip(first):
+                    self.log_request(code, msg_size)
+                    wfile = self.start_streaming_response(
+                        code=code, msg=msg, mimetype=mimetype,
+                        header_list=headers, cachectrl=cachectrl,
+                        compress=True, full_size=msg_size)
+                    while first:
+                        wfile.write(first)
+                        first = fd.read(STREAM_BLOCK_SIZE)
+                    wfile.close()
+                    return
+                fd.seek(0)
+                headers.append(('Content-Length', '%s' % msg_size))
+                body_size = msg_size
+
+            self.log_request(code, body_size)
+            self.send_http_response(code, msg)
+            self.send_standard_headers(header_list=headers,
+                                       mimetype=mimetype,
+                                       cachectrl=cachectrl)
+            if not suppress_body:
+                self._send_fd(fd, body_size)
+        finally:
+            fd.close()
 
     def do_POST(self, method='POST'):
         (scheme, netloc, path, params, query, frag) = urlparse(self.path)
@@ -578,19 +793,25 @@ class HttpServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
         self.__is_shut_down.clear()
         try:
             while not (self.__shutdown_request or mailpile.util.QUITTING):
-                # FIXME: Let's add a global FD to interrupt this, so we can
-                #        be more responsive AND lengthen our timeouts.
-                r, w, e = SocketServer._eintr_retry(
-                    select.select, [self], [], [], poll_interval)
-                if self in r:
-                    self._handle_request_noblock()
-                elif not (mailpile.util.QUITTING or tick_func is None):
-                    tick_func(self)
+                self._select_and_handle(poll_interval, tick_func)
         finally:
             self.__shutdown_request = False
             if self.__is_shut_down is not None:
                 self.__is_shut_down.set()
 
+    def _select_and_handle(self, poll_interval, tick_func):
+        # FIXME: Let's add a global FD to interrupt this, so we can
+        #        be more responsive AND lengthen our timeouts.
+        r, w, e = SocketServer._eintr_retry(
+            select.select, [self], [], [], poll_interval)
+        if self in r:
+            self._handle_request_noblock()
+        elif not (mailpile.util.QUITTING or tick_func is None):
+            tick_func(self)
+
+    def stats(self):
+        return {'live': LIVE_HTTP_REQUESTS}
+
     def shutdown(self, join=True):
         self.__shutdown_request = True
         if join and (self.__is_shut_down is not None):
@@ -617,10 +838,339 @@ class HttpServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
                 self.shutdown()
 
 
+class HttpConnection(object):
+    """A client connection, which may be kept alive between requests."""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.rfile = sock.makefile('rb', -1)
+        self.wfile = sock.makefile('wb', 0)
+        self.keep_alive = False
+        self.last_used = time.time()
+        self.partial_since = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def buffered(self):
+        """Return any data we have read, but not yet handled."""
+        return self.rfile._rbuf.getvalue()
+
+    def peek(self, size=512):
+        """Return the start of the next request, without consuming it."""
+        return (self.buffered() or
+                self.sock.recv(size, socket.MSG_PEEK))[:size]
+
+    def receive(self, size=4096):
+        """
+        Buffer data which has arrived; only call this once select() says
+        there is some, as it would block otherwise. Returns False if the
+        client has gone away.
+        """
+        try:
+            data = self.sock.recv(size)
+        except socket.error:
+            return False
+        if not data:
+            return False
+        self.rfile._rbuf.seek(0, 2)
+        self.rfile._rbuf.write(data)
+        if self.partial_since is None:
+            self.partial_since = time.time()
+        return True
+
+    def request_ready(self, max_size=65536):
+        """Check whether the request line and headers have all arrived."""
+        head = self.buffered()
+        return ('\r\n\r\n' in head or '\n\n' in head or
+                len(head) >= max_size)
+
+    def close(self):
+        for fd in (self.wfile, self.rfile):
+            try:
+                fd.close()
+            except (IOError, OSError, socket.error):
+                pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError, socket.error):
+            pass
+        self.sock.close()
+
+
+class HttpStats(object):
+    """Request counts and latency histograms, per request priority."""
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 30)  # Upper bounds, in seconds
+
+    def __init__(self, priorities):
+        self.lock = threading.Lock()
+        self.stats = dict((p, {'requests': 0,
+                               'wait': [0] * (len(self.BUCKETS) + 1),
+                               'time': [0] * (len(self.BUCKETS) + 1)})
+                          for p in priorities)
+
+    def _bucket(self, elapsed):
+        for i, limit in enumerate(self.BUCKETS):
+            if elapsed <= limit:
+                return i
+        return len(self.BUCKETS)
+
+    def record(self, priority, waited, elapsed):
+        with self.lock:
+            st = self.stats[priority]
+            st['requests'] += 1
+            st['wait'][self._bucket(waited)] += 1
+            st['time'][self._bucket(elapsed)] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'buckets': list(self.BUCKETS),
+                'priorities': dict((p, {'requests': st['requests'],
+                                        'wait': list(st['wait']),
+                                        'time': list(st['time'])})
+                                   for p, st in self.stats.iteritems())}
+
+
+def _wakeup_socket_pair():
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        # Windows has no socketpair(), make one the long way.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            writer = socket.create_connection(listener.getsockname())
+            reader = listener.accept()[0]
+            return reader, writer
+        finally:
+            listener.close()
+
+
+class PooledHttpServer(HttpServer):
+    """
+    An HTTP server with a fixed pool of worker threads.
+
+    Connections are kept alive between requests; idle connections are
+    watched by the main loop, which reads the request line and headers
+    and then queues each request by priority. Interactive requests are
+    handled first, then static content, then background polling (which
+    may never occupy more than half the workers, so it cannot starve the
+    rest). Since workers only ever get complete request heads, slow
+    clients cannot tie them up; those which take longer than
+    HEADER_TIMEOUT to send their headers are disconnected.
+    """
+    INTERACTIVE, STATIC, BACKGROUND = PRIORITIES = range(0, 3)
+    PRIORITY_NAMES = ('interactive', 'static', 'background')
+    STATIC_PATHS = ('/static/', '/bower_components/', '/favicon.ico')
+    KEEPALIVE_TIMEOUT = 60
+    HEADER_TIMEOUT = 15
+    REQUEST_TIMEOUT = 60
+
+    def __init__(self, session, sspec, handler, workers=8):
+        HttpServer.__init__(self, session, sspec, handler)
+        self.workers = []
+        self.stopping = False
+        self.worker_count = max(1, workers)
+        self.max_background = max(1, self.worker_count // 2)
+        self.busy = [0] * len(self.PRIORITIES)
+        self.queues = [deque() for p in self.PRIORITIES]
+        self.queue_cond = threading.Condition(threading.Lock())
+        self.idle = set()
+        self.idle_lock = threading.Lock()
+        self.connections = 0
+        self.http_stats = HttpStats(self.PRIORITY_NAMES)
+        self._wakeup_r, self._wakeup_w = _wakeup_socket_pair()
+        self._polling_urls = (0, [])
+
+    def _polling_command_urls(self):
+        # Cache the list of command URLs, until more plugins load.
+        if self._polling_urls[0] != len(COMMANDS):
+            urls = sorted(((c.SYNOPSIS[2], c.IS_POLLING_ACTIVITY)
+                           for c in COMMANDS if c.SYNOPSIS[2]),
+                          key=lambda u: -len(u[0]))
+            self._polling_urls = (len(COMMANDS), urls)
+        return self._polling_urls[1]
+
+    def classify(self, request_line):
+        """Choose a priority for a request, based on its request line."""
+        try:
+            path = unquote(request_line.split(' ')[1].split('?')[0])
+        except IndexError:
+            return self.INTERACTIVE
+        http_path = self.session.config.sys.http_path or ''
+        if http_path and path.startswith(http_path):
+            path = path[len(http_path):]
+        if path.startswith('/_/'):
+            path = path[2:]
+        for static in self.STATIC_PATHS:
+            if path.startswith(static):
+                return self.STATIC
+
+        parts = path.strip('/').split('/')
+        if parts[0] == 'api' and len(parts) > 1:
+            parts = parts[2:]
+        path = '/'.join(parts)
+        for url, polling in self._polling_command_urls():
+            if path == url or path.startswith(url + '/'):
+                return self.BACKGROUND if polling else self.INTERACTIVE
+        return self.INTERACTIVE
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send('x')
+        except socket.error:
+            pass
+
+    def enqueue(self, conn):
+        """Queue the next request on a connection."""
+        try:
+            peeked = conn.peek()
+        except socket.error:
+            peeked = ''
+        if not peeked:
+            conn.close()
+            return
+        priority = self.classify(peeked.split('\n', 1)[0])
+        conn.partial_since = None
+        with self.queue_cond:
+            self.queues[priority].append((conn, time.time()))
+            self.queue_cond.notify()
+
+    def _next_request(self):
+        with self.queue_cond:
+            while not (self.stopping or mailpile.util.QUITTING):
+                for priority, queue in enumerate(self.queues):
+                    if queue and (priority != self.BACKGROUND or
+                                  self.busy[priority] < self.max_background):
+                        self.busy[priority] += 1
+                        return (priority,) + queue.popleft()
+                self.queue_cond.wait(1)
+        return None, None, None
+
+    def _worker(self):
+        while True:
+            priority, conn, queued = self._next_request()
+            if conn is None:
+                return
+            started = time.time()
+            try:
+                conn.keep_alive = False
+                conn.sock.settimeout(self.REQUEST_TIMEOUT)
+                self.finish_request(conn, conn.address)
+            except:
+                traceback.print_exc()
+            finally:
+                with self.queue_cond:
+                    self.busy[priority] -= 1
+                    self.queue_cond.notify()
+            self.http_stats.record(self.PRIORITY_NAMES[priority],
+                                   started - queued, time.time() - started)
+
+            if not conn.keep_alive or mailpile.util.QUITTING:
+                conn.close()
+            elif conn.request_ready():
+                self.enqueue(conn)
+            else:
+                conn.last_used = time.time()
+                if conn.buffered():
+                    conn.partial_since = conn.last_used
+                with self.idle_lock:
+                    self.idle.add(conn)
+                self._wake()
+
+    def _start_workers(self):
+        while len(self.workers) < self.worker_count and not self.stopping:
+            worker = threading.Thread(target=self._worker,
+                                      name='HTTP worker %d' % len(self.workers))
+            worker.daemon = True
+            self.workers.append(worker)
+            worker.start()
+
+    def _select_and_handle(self, poll_interval, tick_func):
+        self._start_workers()
+        with self.idle_lock:
+            idle = list(self.idle)
+        r, w, e = SocketServer._eintr_retry(
+            select.select, [self, self._wakeup_r] + idle, [], [],
+            poll_interval)
+        if self._wakeup_r in r:
+            self._wakeup_r.recv(1024)
+        if self in r:
+            try:
+                sock, address = self.get_request()
+                if self.verify_request(sock, address):
+                    self.connections += 1
+                    with self.idle_lock:
+                        self.idle.add(HttpConnection(sock, address))
+                else:
+                    self.shutdown_request(sock)
+            except socket.error:
+                pass
+        ready = [c for c in idle if c in r]
+        if ready:
+            with self.idle_lock:
+                self.idle -= set(ready)
+            for conn in ready:
+                if not conn.receive():
+                    conn.close()
+                elif conn.request_ready():
+                    self.enqueue(conn)
+                else:
+                    with self.idle_lock:
+                        self.idle.add(conn)
+
+        # Close connections which have been idle for too long, or are
+        # taking too long to send us a request.
+        now = time.time()
+        expired = now - self.KEEPALIVE_TIMEOUT
+        slow = now - self.HEADER_TIMEOUT
+        with self.idle_lock:
+            stale = [c for c in self.idle
+                     if c.last_used < expired or
+                     (c.partial_since or now) < slow]
+            self.idle -= set(stale)
+        for conn in stale:
+            conn.close()
+
+        if not (r or mailpile.util.QUITTING or tick_func is None):
+            tick_func(self)
+
+    def stats(self):
+        stats = HttpServer.stats(self)
+        with self.queue_cond:
+            stats.update({
+                'workers': self.worker_count,
+                'connections': self.connections,
+                'busy': dict(zip(self.PRIORITY_NAMES, self.busy)),
+                'queued': dict(zip(self.PRIORITY_NAMES,
+                                   (len(q) for q in self.queues)))})
+        with self.idle_lock:
+            stats['idle'] = len(self.idle)
+        stats.update(self.http_stats.as_dict())
+        return stats
+
+    def shutdown(self, join=True):
+        with self.queue_cond:
+            self.stopping = True
+            self.queue_cond.notify_all()
+        with self.idle_lock:
+            idle, self.idle = self.idle, set()
+        for conn in idle:
+            conn.close()
+        HttpServer.shutdown(self, join=join)
+
+
 class HttpWorker(threading.Thread):
     def __init__(self, session, sspec):
         threading.Thread.__init__(self)
-        self.httpd = HttpServer(session, sspec, HttpRequestHandler)
+        workers = session.config.sys.http_workers
+        if workers > 0:
+            self.httpd = PooledHttpServer(session, sspec, HttpRequestHandler,
+                                          workers=workers)
+        else:
+            self.httpd = HttpServer(session, sspec, HttpRequestHandler)
         self.daemon = True
         self.session = session
 
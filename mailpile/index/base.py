@@ -1,7 +1,6 @@
 from __future__ import print_function
 import copy
 import json
-import random
 import rfc822
 import time
 import traceback
@@ -10,6 +9,8 @@ from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.index.msginfo import MessageInfoConstants
 from mailpile.index.search import SearchResultSet
+from mailpile.index.tokens import TokenIndex
+from mailpile.lru_cache import LRUCache
 from mailpile.mailutils import MBX_ID_LEN
 from mailpile.mailutils.addresses import AddressHeaderParser
 from mailpile.mailutils.safe import *
@@ -31,9 +32,13 @@ class BaseIndex(MessageInfoConstants):
 
     def __init__(self, config):
         self.config = config
-        self.CACHE = {}
+        self.CACHE = LRUCache('metadata',
+                              max_entries=self.MAX_CACHE_ENTRIES,
+                              max_bytes=config.sys.metadata_cache_kb * 1024,
+                              sizeof=self._cache_entry_size)
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self._email_tokens = None
 
     ### Known e-mail addresses #############################################
 
@@ -45,6 +50,10 @@ class BaseIndex(MessageInfoConstants):
             self.EMAILS.append('')
         self.EMAILS[eid] = '%s (%s)' % (email, name or email)
         self.EMAIL_IDS[email.lower()] = eid
+        et = self._email_tokens
+        if et is not None and et[0] is self.EMAILS and eid <= et[2]:
+            et[1].add(eid, self.EMAILS[eid])
+            et[2] = max(et[2], eid + 1)
         # FIXME: This needs to get written out...
         return eid
 
@@ -58,6 +67,21 @@ class BaseIndex(MessageInfoConstants):
                     name = en
         return self.add_email(email, name=name, eid=eid)
 
+    def email_token_index(self):
+        """
+        Return a TokenIndex of the known e-mail addresses, keyed by their
+        position in EMAILS. It is built on first use and kept up to date
+        as addresses are added (or the EMAILS list is replaced).
+        """
+        emails = self.EMAILS
+        et = self._email_tokens
+        if et is None or et[0] is not emails:
+            et = self._email_tokens = [emails, TokenIndex(), 0]
+        while et[2] < len(emails):
+            et[1].add(et[2], emails[et[2]])
+            et[2] += 1
+        return et[1]
+
     def compact_to_list(self, msg_to):
         eids = []
         for ai in msg_to:
@@ -167,19 +191,22 @@ class BaseIndex(MessageInfoConstants):
             '',                               # Replies
             msg_mid]                          # Thread
 
+    @classmethod
+    def _cache_entry_size(cls, crv):
+        # A rough estimate of how much memory a cached entry uses
+        size = 256
+        for field in crv.get('msg_info') or []:
+            size += 64 + 2 * len(field)
+        if 'metadata' in crv:
+            size += 4096
+        return size
+
     def get_msg_at_idx_pos(self, msg_idx):
         try:
             crv = self.CACHE.get(msg_idx, {})
             if 'msg_info' in crv:
                 return crv['msg_info']
 
-            if len(self.CACHE) > self.MAX_CACHE_ENTRIES:
-                try:
-                    for k in random.sample(
-                            self.CACHE.keys(), self.MAX_CACHE_ENTRIES/20):
-                        del self.CACHE[k]
-                except KeyError:
-                    pass
             rv = self.get_msg_at_idx_pos_uncached(msg_idx)
             crv['msg_info'] = rv
             self.CACHE[msg_idx] = crv
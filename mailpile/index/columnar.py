@@ -0,0 +1,345 @@
+"""
+Columnar, memory-mappable snapshots of the metadata index.
+
+The text metadata index (mailpile.idx) stores each message as a single
+tab-separated UTF-8 line, which must be read, split and decoded before
+anything can be done with it. For large indexes that dominates startup.
+
+A columnar snapshot stores the same data as:
+
+  - fixed-width arrays for the message date, size (KB) and thread ID,
+  - a sorted array of message indexes for each tag,
+  - an offset-indexed string heap for each of the remaining text fields,
+    and one for the known e-mail addresses.
+
+The snapshot is read using mmap: only the fixed-width columns are copied
+into memory at load time, individual strings are sliced out of the heaps
+on demand. Each snapshot records the inode and size of the text index it
+was made from, so changes appended to the text index later on can simply
+be replayed on top of it.
+
+Snapshots are never encrypted, so callers must only use them when the
+text index itself is stored in the clear.
+
+>>> import tempfile
+>>> rows = ['\\t'.join([b36(i), 'ptr%d' % i, 'id%d' % i, b36(1000 + i),
+...                    'From', '', '', '1', 'Subject %d' % i, 'Snippet',
+...                    '0', '', b36(i)]) for i in range(0, 3)]
+>>> fn = os.path.join(tempfile.mkdtemp(), 'test.idx.col')
+>>> WriteColumnarIndex(fn, rows, [u'bre@example.com (Bjarni)'],
+...                    {'0': set([0, 2])}, src_ino=1, src_size=100)
+3
+
+>>> cir = ColumnarIndexReader(fn)
+>>> len(cir), cir.src_ino, cir.src_size
+(3, 1, 100)
+>>> cir.line(2) == rows[2]
+True
+>>> cir.msg_info(1)[MessageInfoConstants.MSG_SUBJECT]
+u'Subject 1'
+>>> list(cir.column('date'))
+[1000, 1001, 1002]
+>>> [(t, list(m) == [0, 2]) for t, m in cir.tag_members()]
+[('0', True)]
+>>> cir.emails()
+[u'bre@example.com (Bjarni)']
+
+>>> rows = ColumnarRows(cir)
+>>> rows[1] = 'changed'
+>>> rows.append('appended')
+>>> len(rows), rows[1], rows[3], rows[0] == cir.line(0)
+(4, 'changed', 'appended', True)
+>>> rows.msg_info(1) is None, rows.msg_info(2)[0]
+(True, u'2')
+"""
+from __future__ import print_function
+import array
+import mmap
+import os
+import struct
+
+from mailpile.index.msginfo import MessageInfoConstants
+from mailpile.util import *
+
+
+# Fields stored as offset-indexed string heaps, in row order. The MID is
+# implicit (it is the row number) and the date, size and thread ID are
+# stored as fixed-width columns.
+HEAP_FIELDS = (
+    ('ptrs', MessageInfoConstants.MSG_PTRS),
+    ('id', MessageInfoConstants.MSG_ID),
+    ('from', MessageInfoConstants.MSG_FROM),
+    ('to', MessageInfoConstants.MSG_TO),
+    ('cc', MessageInfoConstants.MSG_CC),
+    ('subject', MessageInfoConstants.MSG_SUBJECT),
+    ('body', MessageInfoConstants.MSG_BODY),
+    ('tags', MessageInfoConstants.MSG_TAGS),
+    ('replies', MessageInfoConstants.MSG_REPLIES),
+    ('thread_mid', MessageInfoConstants.MSG_THREAD_MID))
+
+FIXED_FIELDS = (
+    ('date', MessageInfoConstants.MSG_DATE),
+    ('kb', MessageInfoConstants.MSG_KB))
+
+MAGIC = 'MPIDXCOL'
+VERSION = 1
+
+# magic, version, sizeof(long), rows, sections, source inode, source size
+HEADER = struct.Struct('<8sIIQQQQ')
+SECTION = struct.Struct('<24sQQ')
+
+ROW_PRESENT = 1
+
+
+def _b36int(value, default=0):
+    try:
+        return int(value, 36)
+    except (ValueError, TypeError):
+        return default
+
+
+def WriteColumnarIndex(fn, lines, emails, tags, src_ino=0, src_size=0):
+    """
+    Write a columnar snapshot of the metadata index to the file fn.
+
+    The lines are UTF-8 encoded, tab-separated metadata index rows (as
+    found in MailIndex.INDEX), emails is a list of known e-mail addresses
+    and tags a dict mapping tag IDs to sets of message indexes. Returns
+    the number of rows written.
+    """
+    count = 0
+    flags = array.array('B')
+    fixed = dict((name, array.array('l')) for name, f in FIXED_FIELDS)
+    thread = array.array('l')
+    heaps = dict((name, ([], array.array('L', [0])))
+                 for name, f in HEAP_FIELDS)
+
+    def heap_append(heap, value):
+        values, offsets = heap
+        values.append(value)
+        offsets.append(offsets[-1] + len(value))
+
+    for line in lines:
+        words = line.split('\t') if line else []
+        if len(words) == MessageInfoConstants.MSG_FIELDS_V2:
+            flags.append(ROW_PRESENT)
+            for name, f in FIXED_FIELDS:
+                fixed[name].append(_b36int(words[f]))
+            tmid = words[MessageInfoConstants.MSG_THREAD_MID].split('/')[0]
+            thread.append(_b36int(tmid, default=-1))
+            for name, f in HEAP_FIELDS:
+                heap_append(heaps[name], words[f])
+        else:
+            flags.append(0)
+            for name, f in FIXED_FIELDS:
+                fixed[name].append(0)
+            thread.append(-1)
+            for name, f in HEAP_FIELDS:
+                heap_append(heaps[name], '')
+        count += 1
+
+    email_heap = ([], array.array('L', [0]))
+    for email in emails:
+        heap_append(email_heap, email.encode('utf-8'))
+
+    sections = [('flags', flags.tostring()), ('thread', thread.tostring())]
+    sections += [(name, fixed[name].tostring()) for name, f in FIXED_FIELDS]
+    for name, (values, offsets) in (
+            [(n, heaps[n]) for n, f in HEAP_FIELDS] +
+            [('@emails', email_heap)]):
+        sections.append((name + '.o', offsets.tostring()))
+        sections.append((name, ''.join(values)))
+    for tid, members in tags.iteritems():
+        if members:
+            tag_array = array.array('i', sorted(members))
+            sections.append(('tag:' + tid, tag_array.tostring()))
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    toc = []
+    for name, data in sections:
+        toc.append(SECTION.pack(name.encode('utf-8'), offset, len(data)))
+        offset += len(data)
+
+    newfile = '%s.new' % fn
+    with open(newfile, 'wb') as fd:
+        fd.write(HEADER.pack(MAGIC, VERSION, array.array('l').itemsize,
+                             count, len(sections), src_ino, src_size))
+        fd.write(''.join(toc))
+        for name, data in sections:
+            fd.write(data)
+    os.rename(newfile, fn)
+    return count
+
+
+class ColumnarIndexReader(object):
+    """
+    Read-only access to a columnar metadata index snapshot.
+
+    Raises ValueError if the file is not a snapshot we can read; callers
+    should treat that as "no snapshot" and fall back to the text index.
+    """
+    def __init__(self, fn):
+        self.filename = fn
+        with open(fn, 'rb') as fd:
+            try:
+                self._mmap = mmap.mmap(fd.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                raise ValueError('Cannot map %s' % fn)
+
+        if len(self._mmap) < HEADER.size:
+            raise ValueError('Truncated snapshot: %s' % fn)
+        (magic, version, long_size, self.rows, sections,
+         self.src_ino, self.src_size) = HEADER.unpack_from(self._mmap, 0)
+        if ((magic != MAGIC) or (version != VERSION) or
+                (long_size != array.array('l').itemsize)):
+            raise ValueError('Incompatible snapshot: %s' % fn)
+
+        self.sections = {}
+        for i in range(0, sections):
+            name, offset, length = SECTION.unpack_from(
+                self._mmap, HEADER.size + SECTION.size * i)
+            if offset + length > len(self._mmap):
+                raise ValueError('Truncated snapshot: %s' % fn)
+            self.sections[name.rstrip('\0')] = (offset, length)
+
+        self._flags = self._section('flags')
+        self._heaps = dict((name, self.column(name + '.o', typecode='L'))
+                           for name, f in HEAP_FIELDS + (('@emails', 0),))
+        for name, f in HEAP_FIELDS:
+            if len(self._heaps[name]) != self.rows + 1:
+                raise ValueError('Corrupt snapshot: %s' % fn)
+
+    def __len__(self):
+        return self.rows
+
+    def _section(self, name):
+        offset, length = self.sections[name]
+        return self._mmap[offset:offset + length]
+
+    def column(self, name, typecode='l'):
+        """Return a fixed-width column as an array."""
+        data = array.array(typecode)
+        data.fromstring(self._section(name))
+        return data
+
+    def present(self, pos):
+        return (ord(self._flags[pos]) & ROW_PRESENT) != 0
+
+    def string(self, name, pos):
+        """Return a single raw (UTF-8 encoded) string from a heap."""
+        offsets = self._heaps[name]
+        base = self.sections[name][0]
+        return self._mmap[base + offsets[pos]:base + offsets[pos + 1]]
+
+    def strings(self, name):
+        """Iterate through all the raw strings in a heap, in row order."""
+        offsets = self._heaps[name]
+        base, length = self.sections[name]
+        heap = self._mmap[base:base + length]
+        for i in range(0, len(offsets) - 1):
+            yield heap[offsets[i]:offsets[i + 1]]
+
+    def line(self, pos):
+        """Reconstruct a UTF-8 encoded metadata index line."""
+        if not self.present(pos):
+            return ''
+        words = [None] * MessageInfoConstants.MSG_FIELDS_V2
+        words[MessageInfoConstants.MSG_MID] = b36(pos)
+        for name, f in FIXED_FIELDS:
+            words[f] = b36(self._fixed(name, pos))
+        for name, f in HEAP_FIELDS:
+            words[f] = self.string(name, pos)
+        return '\t'.join(words)
+
+    def msg_info(self, pos):
+        """Return a decoded metadata row, or None if the row is empty."""
+        if not self.present(pos):
+            return None
+        words = [None] * MessageInfoConstants.MSG_FIELDS_V2
+        words[MessageInfoConstants.MSG_MID] = unicode(b36(pos))
+        for name, f in FIXED_FIELDS:
+            words[f] = unicode(b36(self._fixed(name, pos)))
+        for name, f in HEAP_FIELDS:
+            words[f] = self.string(name, pos).decode('utf-8')
+        return words
+
+    def _fixed(self, name, pos):
+        offset = self.sections[name][0]
+        return struct.unpack_from('l', self._mmap,
+                                  offset + pos * array.array('l').itemsize)[0]
+
+    def tag_members(self):
+        """Iterate through (tag ID, array of message indexes) pairs."""
+        for name in self.sections:
+            if name.startswith('tag:'):
+                yield name[4:], self.column(name, typecode='i')
+
+    def emails(self):
+        return [e.decode('utf-8') for e in self.strings('@emails')]
+
+    def close(self):
+        self._mmap.close()
+
+
+class ColumnarRows(object):
+    """
+    A list-alike of metadata index lines, backed by a columnar snapshot.
+
+    Rows which have not changed since the snapshot was taken are served
+    straight from the snapshot; changed and appended rows are kept in
+    memory as plain strings, just like a regular MailIndex.INDEX.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self._count = len(reader)
+        self._changed = {}
+        self._extra = []
+
+    def __len__(self):
+        return self._count + len(self._extra)
+
+    def __iter__(self):
+        return (self[i] for i in xrange(0, len(self)))
+
+    def _pos(self, pos):
+        if pos < 0:
+            pos += len(self)
+        if pos < 0 or pos >= len(self):
+            raise IndexError('Row %s out of range' % pos)
+        return pos
+
+    def __getitem__(self, pos):
+        pos = self._pos(pos)
+        if pos >= self._count:
+            return self._extra[pos - self._count]
+        line = self._changed.get(pos)
+        if line is None:
+            return self.reader.line(pos)
+        return line
+
+    def __setitem__(self, pos, line):
+        pos = self._pos(pos)
+        if pos >= self._count:
+            self._extra[pos - self._count] = line
+        else:
+            self._changed[pos] = line
+
+    def append(self, line):
+        self._extra.append(line)
+
+    def msg_info(self, pos):
+        """Return a decoded row if it can be read from the snapshot."""
+        if pos < self._count and pos not in self._changed:
+            return self.reader.msg_info(pos)
+        return None
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
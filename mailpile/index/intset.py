@@ -0,0 +1,330 @@
+"""
+Compact sets of small non-negative integers (message indexes).
+
+An IntSet keeps its members as a sorted array of 32-bit ints,
+which is an order of magnitude smaller than a Python set of base-36
+strings and can be intersected, merged and subtracted without building
+any intermediate Python objects.
+
+On disk (and in other line-based text formats) an IntSet is written as a
+delta-encoded list of varints, base64 encoded and prefixed with a '~' so
+it can be told apart from the older tab-separated lists of base-36 IDs.
+
+>>> a = IntSet([5, 1, 3, 3, 1000])
+>>> list(a), len(a), 3 in a, 4 in a
+([1, 3, 5, 1000], 4, True, False)
+
+>>> b = IntSet.FromB36(['1', '5', 'RS', 'bogus!'])
+>>> list(b)
+[1, 5, 1000]
+
+>>> list(a & b), list(a | IntSet([2])), list(a - b)
+([1, 5, 1000], [1, 2, 3, 5, 1000], [3])
+
+>>> a.encode()
+'~AQIC4wc='
+>>> IntSet.Parse(['~AQIC4wc=']) == a
+True
+>>> IntSet.Parse(['1', 'RS', '~AwI=']) == IntSet([1, 3, 5, 1000])
+True
+
+>>> a |= [7, 2000]
+>>> a -= IntSet([1])
+>>> a &= range(0, 1001)
+>>> a
+IntSet([3, 5, 7, 1000])
+"""
+from __future__ import print_function
+import array
+import base64
+import binascii
+from bisect import bisect_left
+
+from mailpile.util import b36
+
+
+def _as_array(values):
+    if isinstance(values, IntSet):
+        return values.ids
+    return array.array('i', sorted(set(values)))
+
+
+# All the set operations below are a single merge pass over the two
+# sorted arrays, appending to a fresh array. When one operand is more
+# than GALLOP_RATIO times smaller than the other, the loop runs over the
+# smaller one and bisects into the larger one, copying the runs in
+# between with one slice each; otherwise both arrays are walked in step.
+GALLOP_RATIO = 16
+
+
+def _union(a, b):
+    if not b:
+        return array.array('i', a)
+    if not a:
+        return array.array('i', b)
+    if a[-1] < b[0]:
+        return a + b
+    if b[-1] < a[0]:
+        return b + a
+    if len(a) < len(b):
+        a, b = b, a
+    result = array.array('i')
+    append, extend = result.append, result.extend
+    i = j = 0
+    na, nb = len(a), len(b)
+    if nb * GALLOP_RATIO < na:
+        for y in b:
+            k = bisect_left(a, y, i)
+            if k > i:
+                extend(a[i:k])
+                i = k
+            if i < na and a[i] == y:
+                i += 1
+            append(y)
+    else:
+        while i < na and j < nb:
+            x, y = a[i], b[j]
+            if x < y:
+                append(x)
+                i += 1
+            elif y < x:
+                append(y)
+                j += 1
+            else:
+                append(x)
+                i += 1
+                j += 1
+        extend(b[j:])
+    extend(a[i:])
+    return result
+
+
+def _intersection(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    result = array.array('i')
+    if not a or a[-1] < b[0] or b[-1] < a[0]:
+        return result
+    append = result.append
+    i = j = 0
+    na, nb = len(a), len(b)
+    if na * GALLOP_RATIO < nb:
+        for x in a:
+            j = bisect_left(b, x, j)
+            if j == nb:
+                break
+            if b[j] == x:
+                append(x)
+    else:
+        while i < na and j < nb:
+            x, y = a[i], b[j]
+            if x < y:
+                i += 1
+            elif y < x:
+                j += 1
+            else:
+                append(x)
+                i += 1
+                j += 1
+    return result
+
+
+def _difference(a, b):
+    if not a or not b or a[-1] < b[0] or b[-1] < a[0]:
+        return array.array('i', a)
+    result = array.array('i')
+    append, extend = result.append, result.extend
+    i = j = 0
+    na, nb = len(a), len(b)
+    if nb * GALLOP_RATIO < na:
+        # Copy the runs of a between the members of b
+        for y in b:
+            k = bisect_left(a, y, i)
+            if k > i:
+                extend(a[i:k])
+                i = k
+            if i < na and a[i] == y:
+                i += 1
+    elif na * GALLOP_RATIO < nb:
+        # Keep the members of a which are not found in b
+        for x in a:
+            j = bisect_left(b, x, j)
+            if j == nb or b[j] != x:
+                append(x)
+        return result
+    else:
+        while i < na and j < nb:
+            x, y = a[i], b[j]
+            if x < y:
+                append(x)
+                i += 1
+            elif y < x:
+                j += 1
+            else:
+                i += 1
+                j += 1
+    extend(a[i:])
+    return result
+
+
+def EncodeVarints(ids):
+    """Delta and varint encode a sorted sequence of ints."""
+    out = bytearray()
+    last = 0
+    for v in ids:
+        delta = v - last
+        last = v
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def DecodeVarints(data, ids=None):
+    """Decode data created by EncodeVarints, appending to an array."""
+    if ids is None:
+        ids = array.array('i')
+    last = value = shift = 0
+    for b in bytearray(data):
+        value |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            last += value
+            ids.append(last)
+            value = shift = 0
+    return ids
+
+
+class IntSet(object):
+    """A sorted, compact set of non-negative ints."""
+    __slots__ = ('ids', )
+
+    def __init__(self, values=None):
+        if values is None:
+            self.ids = array.array('i')
+        elif isinstance(values, IntSet):
+            self.ids = array.array('i', values.ids)
+        else:
+            self.ids = _as_array(values)
+
+    @classmethod
+    def _FromArray(cls, ids):
+        obj = cls()
+        obj.ids = ids
+        return obj
+
+    @classmethod
+    def FromB36(cls, values):
+        """Create from a sequence of base-36 strings, ignoring garbage."""
+        ints = []
+        for v in values:
+            try:
+                ints.append(int(v, 36) if isinstance(v, basestring) else v)
+            except ValueError:
+                pass
+        return cls(ints)
+
+    @classmethod
+    def Parse(cls, words):
+        """Create from encoded chunks and/or base-36 strings."""
+        encoded = [w for w in words if w[:1] == '~']
+        if not encoded:
+            return cls.FromB36(words)
+        ids = array.array('i')
+        for chunk in encoded:
+            try:
+                DecodeVarints(base64.b64decode(chunk[1:]), ids)
+            except (TypeError, binascii.Error):
+                pass
+        if len(encoded) < len(words):
+            return cls(ids) | cls.FromB36(w for w in words if w[:1] != '~')
+        elif len(encoded) > 1:
+            return cls(ids)
+        return cls._FromArray(ids)
+
+    @classmethod
+    def Estimate(cls, words):
+        """
+        Estimate the size of encoded chunks and/or base-36 strings without
+        decoding them. Every varint takes at least a byte, so this is an
+        upper bound for encoded chunks, and exact for base-36 strings
+        (unless they have duplicates).
+
+        >>> IntSet.Estimate(['~AQIC4wc=']), IntSet.Estimate(['1', 'RS'])
+        (6, 2)
+        """
+        return sum(((len(w) - 1) * 3 // 4) if (w[:1] == '~') else 1
+                   for w in words)
+
+    def encode(self):
+        return '~' + base64.b64encode(EncodeVarints(self.ids))
+
+    def b36(self):
+        return [b36(i) for i in self.ids]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __nonzero__(self):
+        return len(self.ids) > 0
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, value):
+        i = bisect_left(self.ids, value)
+        return i < len(self.ids) and self.ids[i] == value
+
+    def __eq__(self, other):
+        if isinstance(other, IntSet):
+            return self.ids == other.ids
+        return set(self.ids) == set(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'IntSet(%s)' % list(self.ids)
+
+    def __or__(self, other):
+        return IntSet._FromArray(_union(self.ids, _as_array(other)))
+
+    def __and__(self, other):
+        return IntSet._FromArray(_intersection(self.ids, _as_array(other)))
+
+    def __sub__(self, other):
+        return IntSet._FromArray(_difference(self.ids, _as_array(other)))
+
+    def __ior__(self, other):
+        self.ids = _union(self.ids, _as_array(other))
+        return self
+
+    def __iand__(self, other):
+        self.ids = _intersection(self.ids, _as_array(other))
+        return self
+
+    def __isub__(self, other):
+        self.ids = _difference(self.ids, _as_array(other))
+        return self
+
+    def add(self, value):
+        i = bisect_left(self.ids, value)
+        if i == len(self.ids) or self.ids[i] != value:
+            self.ids.insert(i, value)
+
+    def discard(self, value):
+        i = bisect_left(self.ids, value)
+        if i < len(self.ids) and self.ids[i] == value:
+            del self.ids[i]
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,256 @@
+"""
+Memory-mapped metadata index rows and compact lookup tables.
+
+Loading the text metadata index (mailpile.idx) normally keeps every line
+in memory as a Python string, along with dicts mapping every message
+pointer and Message-ID to a message index. For large archives that adds
+up to a lot of RAM.
+
+MappedRows is a list-alike of metadata index lines which keeps only an
+array of file offsets; lines are sliced out of a memory-mapped copy of
+the index file (which must not be encrypted) when they are needed. Rows
+which change after loading are kept in memory as plain strings.
+
+CompactHashMap replaces the PTRS and MSGIDS dicts: it stores hashes of
+the keys (64 bits wide, on 64-bit platforms) and their values in a pair
+of sorted arrays. The keys themselves are not stored, so listing them
+requires a key_source which can regenerate them (from the index rows).
+Hash collisions are astronomically unlikely, so they are not checked for.
+
+>>> import tempfile
+>>> fn = os.path.join(tempfile.mkdtemp(), 'test.idx')
+>>> with open(fn, 'w') as fd:
+...     fd.write('# comment\\nrow zero\\r\\nrow one\\nrow two')
+>>> mm = MapFile(fn)
+>>> rows = MappedRows(mm, array.array('l', [10, 20, -1]))
+>>> len(rows), rows[0], rows[1], rows[2], rows[-2]
+(3, 'row zero', 'row one', '', 'row one')
+>>> rows[0] = 'row zero'
+>>> rows[2] = 'changed'
+>>> rows.append('appended')
+>>> list(rows), sorted(rows.changed())
+(['row zero', 'row one', 'changed', 'appended'], [2, 3])
+>>> rows.set_offset(1, 28)
+>>> rows[1]
+'row two'
+
+>>> chm = CompactHashMap()
+>>> chm['a'] = 1
+>>> chm[u'b'] = 2
+>>> chm.compact()
+>>> chm['c'] = 3
+>>> del chm['a']
+>>> chm.get('a'), chm['b'], chm.get(u'c'), 'b' in chm, 'd' in chm, len(chm)
+(None, 2, 3, True, False, 2)
+>>> chm.compact()
+>>> len(chm), chm.get('b'), chm.get('c'), chm.get('a', -1)
+(2, 2, 3, -1)
+>>> chm.key_source = lambda: [('a', 0), ('b', 2), ('c', 3), ('c', 4)]
+>>> sorted(chm.iteritems())
+[('b', 2), ('c', 3)]
+"""
+from __future__ import print_function
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+
+
+def MapFile(fn):
+    """Return a read-only memory map of a file, or None if it is empty."""
+    with open(fn, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MappedRows(object):
+    """
+    A list-alike of metadata index lines, backed by a memory-mapped file.
+
+    Each row is either an offset into the mapped file (-1 for empty rows),
+    or a line which changed or was appended since the file was mapped.
+    """
+    def __init__(self, mapped, offsets):
+        self.mapped = mapped
+        self.offsets = offsets
+        self._changed = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return (self[i] for i in xrange(0, len(self)))
+
+    def _pos(self, pos):
+        if pos < 0:
+            pos += len(self)
+        if pos < 0 or pos >= len(self):
+            raise IndexError('Row %s out of range' % pos)
+        return pos
+
+    def _mapped_line(self, offset):
+        end = self.mapped.find('\n', offset)
+        if end < 0:
+            end = len(self.mapped)
+        if end > offset and self.mapped[end - 1] == '\r':
+            end -= 1
+        return self.mapped[offset:end]
+
+    def __getitem__(self, pos):
+        pos = self._pos(pos)
+        line = self._changed.get(pos)
+        if line is None:
+            offset = self.offsets[pos]
+            if offset < 0:
+                return ''
+            return self._mapped_line(offset)
+        return line
+
+    def __setitem__(self, pos, line):
+        pos = self._pos(pos)
+        offset = self.offsets[pos]
+        if offset >= 0 and self._mapped_line(offset) == line:
+            self._changed.pop(pos, None)
+        else:
+            self._changed[pos] = line
+
+    def append(self, line):
+        self.offsets.append(-1)
+        if line:
+            self._changed[len(self.offsets) - 1] = line
+
+    def set_offset(self, pos, offset):
+        """Point a row at a (new) line in the mapped file."""
+        self.offsets[pos] = offset
+        self._changed.pop(pos, None)
+
+    def changed(self):
+        """Return the positions of rows which are kept in memory."""
+        return self._changed.keys()
+
+
+HASH_BYTES = array.array('l').itemsize
+
+
+def KeyHash(key):
+    """Return a long-sized hash of a (unicode or UTF-8 encoded) key."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('l', hashlib.md5(key).digest()[:HASH_BYTES])[0]
+
+
+class CompactHashMap(object):
+    """
+    A dict-alike mapping strings to non-negative integers, by hash.
+
+    Lookups do a binary search on an array of sorted hashes. Changes go
+    to a small dict first, which is merged into the arrays once it grows
+    too large (or compact() is called).
+    """
+    DELETED = -1
+    MIN_PENDING = 4096
+    COPY_CHUNK = 65536
+
+    def __init__(self, key_source=None):
+        self.key_source = key_source
+        self._hashes = array.array('l')
+        self._values = array.array('l')
+        self._pending = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _lookup(self, h):
+        value = self._pending.get(h)
+        if value is None:
+            i = bisect.bisect_left(self._hashes, h)
+            if i < len(self._hashes) and self._hashes[i] == h:
+                return self._values[i]
+            return self.DELETED
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(KeyHash(key))
+        return default if (value == self.DELETED) else value
+
+    def __getitem__(self, key):
+        value = self._lookup(KeyHash(key))
+        if value == self.DELETED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(KeyHash(key)) != self.DELETED
+
+    has_key = __contains__
+
+    def __setitem__(self, key, value):
+        h = KeyHash(key)
+        if self._lookup(h) == self.DELETED:
+            self._count += 1
+        self._pending[h] = value
+        if len(self._pending) > max(self.MIN_PENDING, len(self._hashes) // 8):
+            self.compact()
+
+    def __delitem__(self, key):
+        h = KeyHash(key)
+        if self._lookup(h) == self.DELETED:
+            raise KeyError(key)
+        self._pending[h] = self.DELETED
+        self._count -= 1
+
+    def compact(self):
+        """Merge pending changes into the sorted arrays."""
+        if not self._pending:
+            return
+        old_hashes, old_values = self._hashes, self._values
+        hashes, values = array.array('l'), array.array('l')
+
+        def copy(start, end):
+            # Copy runs a chunk at a time, so there is never a large
+            # temporary copy in memory on top of the old and new arrays.
+            for i in xrange(start, end, self.COPY_CHUNK):
+                j = min(end, i + self.COPY_CHUNK)
+                hashes.extend(old_hashes[i:j])
+                values.extend(old_values[i:j])
+
+        pos = 0
+        for h, value in sorted(self._pending.iteritems()):
+            i = bisect.bisect_left(old_hashes, h, pos)
+            copy(pos, i)
+            pos = i
+            if pos < len(old_hashes) and old_hashes[pos] == h:
+                pos += 1
+            if value != self.DELETED:
+                hashes.append(h)
+                values.append(value)
+        copy(pos, len(old_hashes))
+
+        self._hashes, self._values = hashes, values
+        self._pending = {}
+
+    def iteritems(self):
+        """Iterate through the (key, value) pairs, using the key_source."""
+        for key, value in self.key_source():
+            if self.get(key) == value:
+                yield key, value
+
+    def keys(self):
+        return [k for k, v in self.iteritems()]
+
+    def __iter__(self):
+        return (k for k, v in self.iteritems())
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
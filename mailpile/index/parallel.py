@@ -0,0 +1,135 @@
+"""
+Parse messages in a pool of worker processes.
+
+Scanning a mailbox is dominated by MIME parsing, decoding and turning
+text (and HTML) into keywords, which normally all happens one message at
+a time on the scan worker thread. A ParallelMessageReader hands that work
+to a pool of forked worker processes, which inherit the configuration,
+plugins and index of the main process as they were when the pool was
+created.
+
+Workers only parse messages and walk their parts (see
+MailIndex.read_message_parts). Everything which assigns message indexes,
+updates the posting lists or has other side effects still happens in the
+main process, in mailbox order.
+
+Messages which fail to parse (or whose results cannot be sent back to the
+main process) are simply left out of the results, so the caller can fall
+back to processing them the normal way and report errors as usual.
+
+Forking is required, so on platforms without it callers should check
+ParallelMessageReader.Available() and scan serially instead.
+
+Forking a threaded process is not entirely safe: a worker inherits any
+lock another thread happened to hold at the time, and may deadlock on it.
+Workers replace the locks of the shared caches they use, but if a worker
+still takes longer than STALL_TIMEOUT seconds to return a result, the
+pool is torn down and the reader marked as stalled; it returns no more
+results, and the caller parses the remaining messages serially.
+"""
+from __future__ import print_function
+import cPickle
+import cStringIO
+import multiprocessing
+import os
+import threading
+import traceback
+from multiprocessing import TimeoutError
+
+from mailpile.i18n import gettext as _
+from mailpile.lru_cache import CACHE_REGISTRY
+from mailpile.mailutils.emails import ParseMessage
+
+
+# Set in the worker processes by _InitWorker: (session, index)
+_WORKER_CONTEXT = None
+
+
+def _InitWorker(session, index):
+    global _WORKER_CONTEXT
+    _WORKER_CONTEXT = (session, index)
+
+    # Only the forking thread lives on in the worker, so cache locks held
+    # by any other thread would never be released. Start afresh.
+    for cache in list(CACHE_REGISTRY):
+        cache.lock = threading.RLock()
+
+
+def _ParseAndRead(job):
+    msg_key, msg_data = job
+    session, index = _WORKER_CONTEXT
+    try:
+        msg_fd = cStringIO.StringIO(msg_data)
+        msg = ParseMessage(msg_fd,
+            pgpmime=(session.config.prefs.index_encrypted and 'all'),
+            config=session.config)
+        msg_bytes = msg_fd.tell()
+        msg_parts = index.read_message_parts(
+            session, 'new', index.get_msg_id(msg, ''), msg)
+        return msg_key, cPickle.dumps((msg, msg_bytes, msg_parts),
+                                      cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        if session.config.sys.debug:
+            traceback.print_exc()
+        return msg_key, None
+
+
+class ParallelMessageReader(object):
+    """
+    Parse messages and extract keywords from their parts, in parallel.
+
+    The results of read() can be passed to MailIndex._real_scan_one
+    as the msg_parsed argument.
+    """
+    # How many messages to hand each worker per batch
+    BATCH_PER_PROCESS = 8
+
+    # How long to wait for any one result before giving up on the pool
+    STALL_TIMEOUT = 60
+
+    def __init__(self, session, index, processes):
+        self.session = session
+        self.processes = processes
+        self.stalled = False
+        self.pool = multiprocessing.Pool(processes,
+                                         initializer=_InitWorker,
+                                         initargs=(session, index))
+
+    @classmethod
+    def Available(cls):
+        return hasattr(os, 'fork')
+
+    def batch_size(self):
+        return self.processes * self.BATCH_PER_PROCESS
+
+    def read(self, jobs):
+        """
+        Parse a list of (msg_key, raw message data) pairs, returning a
+        dict mapping msg_key to (msg, msg_bytes, msg_parts) tuples.
+        """
+        results = {}
+        if self.stalled:
+            return results
+        parsed = self.pool.imap_unordered(_ParseAndRead, jobs)
+        for i in range(0, len(jobs)):
+            try:
+                msg_key, data = parsed.next(timeout=self.STALL_TIMEOUT)
+            except TimeoutError:
+                self.session.ui.warning(
+                    _('Parser processes stalled, parsing serially instead'))
+                self.stalled = True
+                self.close()
+                break
+            if data is not None:
+                try:
+                    results[msg_key] = cPickle.loads(data)
+                except (cPickle.UnpicklingError, AttributeError,
+                        ImportError, EOFError, TypeError):
+                    pass
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
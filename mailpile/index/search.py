@@ -1,8 +1,138 @@
 from __future__ import print_function
+import heapq
+import threading
 import time
+from itertools import ifilterfalse
 
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.intset import IntSet, GALLOP_RATIO
+
+
+class SearchPlan(object):
+    """
+    Combine the hits of a list of search terms, cheapest terms first.
+
+    Each term is added with its operator ('+' for OR, '-' for NOT and
+    None for AND), an estimate of how many hits it has and a function
+    which evaluates it. Evaluation functions return a collection of
+    message indexes, or SearchPlan.ALL for the entire index.
+
+    The terms are combined left-to-right just as the user typed them, but
+    within each run of AND and NOT terms the positive terms are evaluated
+    in increasing order of estimated size and the NOT terms after that.
+    Once the results are empty, nothing more gets evaluated. The ALL set
+    is never materialized unless there is nothing to intersect it with.
+
+    >>> sp = SearchPlan(10)
+    >>> ev = []
+    >>> def term(hits):
+    ...     return lambda: ev.append(hits) or hits
+    >>> sp.add(None, 10, lambda: SearchPlan.ALL)
+    >>> sp.add('-', 3, term([1, 2, 3]))
+    >>> sp.add(None, 5, term(set([2, 3, 4, 5, 6])))
+    >>> sp.add(None, 2, term(IntSet([4, 6])))
+    >>> sorted(sp.execute()), ev
+    ([4, 6], [IntSet([4, 6]), set([2, 3, 4, 5, 6]), [1, 2, 3]])
+
+    Empty results short-circuit the rest of the plan:
+    >>> sp = SearchPlan(10)
+    >>> sp.add(None, 0, term([]))
+    >>> sp.add(None, 1, term([9]))
+    >>> sp.add('+', 1, term([7]))
+    >>> sorted(sp.execute()), ev[-2:]
+    ([7], [[], [7]])
+
+    Negating everything gives the complement:
+    >>> sp = SearchPlan(5)
+    >>> sp.add(None, 5, lambda: SearchPlan.ALL)
+    >>> sp.add('-', 2, lambda: [0, 4])
+    >>> sorted(sp.execute())
+    [1, 2, 3]
+    """
+    ALL = 'all:mail'
+
+    def __init__(self, universe_size):
+        self.universe_size = universe_size
+        self.terms = []
+
+    def add(self, op, estimate, evaluate):
+        self.terms.append((op, estimate, evaluate))
+
+    def _all(self):
+        return set(xrange(0, self.universe_size))
+
+    def _intersect(self, results, hits):
+        if isinstance(hits, IntSet):
+            if len(results) * GALLOP_RATIO < len(hits):
+                return set(r for r in results if r in hits)
+        results.intersection_update(hits)
+        return results
+
+    def _subtract(self, results, hits):
+        if isinstance(hits, IntSet):
+            if len(results) * GALLOP_RATIO < len(hits):
+                return set(r for r in results if r not in hits)
+        results.difference_update(hits)
+        return results
+
+    def _run(self, results, positives, negatives):
+        # Our results always go first, unless they are ALL.
+        if results is not self.ALL:
+            positives = [(len(results), lambda: results)] + positives
+        positives.sort(key=lambda p: p[0])
+
+        acc = None
+        for estimate, evaluate in positives:
+            if acc is not None and not acc:
+                return acc
+            hits = evaluate()
+            if hits is self.ALL:
+                continue
+            elif acc is None:
+                acc = hits if (hits is results) else set(hits)
+            else:
+                acc = self._intersect(acc, hits)
+
+        if acc is None:
+            if not negatives:
+                return self.ALL
+            acc = self._all()
+        for estimate, evaluate in negatives:
+            if not acc:
+                break
+            hits = evaluate()
+            if hits is self.ALL:
+                return set()
+            acc = self._subtract(acc, hits)
+        return acc
+
+    def execute(self):
+        """Evaluate the plan, returning a set of message indexes."""
+        if not self.terms:
+            return set()
+
+        results = self.ALL
+        # The first term seeds the results, no matter what its op is.
+        positives, negatives = [self.terms[0][1:]], []
+        for op, estimate, evaluate in self.terms[1:]:
+            if op == '+':
+                results = self._run(results, positives, negatives)
+                positives, negatives = [], []
+                hits = evaluate()
+                if results is self.ALL or hits is self.ALL:
+                    results = self.ALL
+                else:
+                    results.update(hits)
+            elif op == '-':
+                negatives.append((estimate, evaluate))
+            else:
+                positives.append((estimate, evaluate))
+
+        results = self._run(results, positives, negatives)
+        if results is self.ALL:
+            return self._all()
+        return results
 
 
 class SearchResultSet:
@@ -30,36 +160,258 @@ class SearchResultSet:
     def excluded(self):
         return self._results['excluded']
 
+    def dependencies(self):
+        return set(['*'])
+
+
+class PartiallySortedResults(list):
+    """
+    A list of search results, of which only the first few are in order.
+
+    The rest of the list is sorted on demand, a page at a time, when it
+    is accessed by index or slice. The sorted_upto attribute is the
+    cursor which keeps track of how far along we are. Iterating over the
+    list or checking membership does not sort anything, so those are
+    only useful for set-like operations.
+
+    >>> keys = [(i * 7) % 20 for i in range(0, 20)]
+    >>> psr = PartiallySortedResults(range(0, 20), keys.__getitem__,
+    ...                              reverse=True, page=2)
+    >>> psr.sort_upto(2)
+    >>> psr.sorted_upto, len(psr), list.__getslice__(psr, 0, 2)
+    (2, 20, [17, 14])
+    >>> psr[2], psr.sorted_upto
+    (11, 4)
+    >>> psr[0:5], psr.sorted_upto
+    ([17, 14, 11, 8, 5], 6)
+
+    Copies keep the cursor, other operations sort everything first:
+    >>> psr[:].sorted_upto, psr.index(0), psr.sorted_upto
+    (6, 19, 20)
+    >>> [keys[i] for i in psr] == range(19, -1, -1)
+    True
+    """
+    def __init__(self, results, key, reverse=False, page=25):
+        list.__init__(self, results)
+        self.key = key
+        self._reverse = reverse
+        self.page = page
+        self.sorted_upto = 0
+
+    def sort_upto(self, upto):
+        """Make sure the first `upto` results are in order."""
+        start = self.sorted_upto
+        if upto <= start:
+            return
+        tail = list.__getslice__(self, start, len(self))
+        count = max(upto - start, self.page)
+        if count * 4 >= len(tail):
+            tail.sort(key=self.key, reverse=self._reverse)
+            count = len(tail)
+        else:
+            select = heapq.nlargest if self._reverse else heapq.nsmallest
+            head = select(count, tail, key=self.key)
+            chosen = set(head)
+            head.extend(ifilterfalse(chosen.__contains__, tail))
+            tail = head
+        list.__setslice__(self, start, len(self), tail)
+        self.sorted_upto = start + count
+
+    def _sorted_copy(self):
+        psr = PartiallySortedResults(self, self.key,
+                                     reverse=self._reverse, page=self.page)
+        psr.sorted_upto = self.sorted_upto
+        return psr
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            start, stop, step = pos.indices(len(self))
+            if (start, stop, step) == (0, len(self), 1):
+                return self._sorted_copy()
+            self.sort_upto(max(start, stop))
+        elif pos < 0:
+            self.sort_upto(len(self))
+        else:
+            self.sort_upto(pos + 1)
+        return list.__getitem__(self, pos)
+
+    def __getslice__(self, start, stop):
+        return self.__getitem__(slice(start, stop))
+
+    def index(self, *args):
+        self.sort_upto(len(self))
+        return list.index(self, *args)
+
+    def pop(self, *args):
+        self.sort_upto(len(self))
+        return list.pop(self, *args)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.sorted_upto = len(self)
+
+    def reverse(self):
+        self.sort_upto(len(self))
+        list.reverse(self)
+
 
 SEARCH_RESULT_CACHE = {}
+SEARCH_RESULT_CACHE_LOCK = threading.RLock()
+SEARCH_RESULT_CACHE_GENERATION = [0]  # Bumped when everything is expired
+SEARCH_RESULT_CACHE_SERIAL = [0]      # Bumped whenever anything is expired
+SEARCH_RESULT_CACHE_CHANGES = []      # (serial, changed deps) of recent drops
+SEARCH_RESULT_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'invalidations': 0}
 
 
 class CachedSearchResultSet(SearchResultSet):
     """
     Cached search result.
+
+    Each cached result records what it depends on: the posting lists
+    (keywords, and tags as '<tid>:in') it was calculated from, 'all:mail'
+    if it depends on the size of the index, or ANYTHING if we cannot tell.
+    DropCaches uses that to only expire results that may have changed.
+
+    Results of searches which overlap with a DropCaches call are not
+    cached if any of their dependencies changed in the meantime, which
+    is checked against a log of the last MAX_CHANGES invalidations.
+
+    The cache is bounded; the least recently used results are evicted
+    once there are more than MAX_ENTRIES of them.
+
+    >>> CachedSearchResultSet.DropCaches()
+    >>> srs = CachedSearchResultSet(None, ['in:inbox'])
+    >>> len(srs.set_results([1, 2, 3], [3], deps=['0:in']))
+    3
+    >>> len(CachedSearchResultSet(None, ['in:inbox']))
+    3
+    >>> CachedSearchResultSet.DropCaches(msg_idxs=[4], tags=['1'])
+    >>> len(CachedSearchResultSet(None, ['in:inbox']))
+    3
+    >>> CachedSearchResultSet.DropCaches(msg_idxs=[4], tags=['0', '1'])
+    >>> len(CachedSearchResultSet(None, ['in:inbox']))
+    0
+
+    Unrelated changes made while searching do not prevent caching:
+    >>> srs = CachedSearchResultSet(None, ['in:inbox'])
+    >>> CachedSearchResultSet.DropCaches(msg_idxs=[4], tags=['1'])
+    >>> len(srs.set_results([1, 2], [], deps=['0:in']))
+    2
+    >>> CachedSearchResultSet(None, ['in:inbox']).cached
+    True
+    >>> CachedSearchResultSet.DropCaches(msg_idxs=[4], tags=['0'])
+    >>> srs = CachedSearchResultSet(None, ['in:inbox'])
+    >>> CachedSearchResultSet.DropCaches(msg_idxs=[5], tags=['0'])
+    >>> len(srs.set_results([1, 2, 5], [], deps=['0:in']))
+    3
+    >>> CachedSearchResultSet(None, ['in:inbox']).cached
+    False
     """
-    def __init__(self, idx, terms):
-        global SEARCH_RESULT_CACHE
+    ANYTHING = '*'
+    MAX_ENTRIES = 250
+    MAX_CHANGES = 1000
+
+    def __init__(self, idx, terms, variant=''):
         self.terms = set(terms)
         self._index = idx
-        self._results = SEARCH_RESULT_CACHE.get(self._skey(), {})
-        self._results['_last_used'] = time.time()
+        self._key = '%s %s' % (variant, ' '.join(terms))
+        with SEARCH_RESULT_CACHE_LOCK:
+            self._generation = SEARCH_RESULT_CACHE_GENERATION[0]
+            self._serial = SEARCH_RESULT_CACHE_SERIAL[0]
+            self._results = SEARCH_RESULT_CACHE.get(self._skey(), {})
+            self.cached = ('raw' in self._results)
+            if self.cached:
+                SEARCH_RESULT_CACHE_STATS['hits'] += 1
+            else:
+                SEARCH_RESULT_CACHE_STATS['misses'] += 1
+            self._results['_last_used'] = time.time()
 
     def _skey(self):
-        return ' '.join(self.terms)
+        return self._key
+
+    def dependencies(self):
+        return set(self._results.get('_deps') or [self.ANYTHING])
 
-    def set_results(self, *args):
-        global SEARCH_RESULT_CACHE
-        SearchResultSet.set_results(self, *args)
-        SEARCH_RESULT_CACHE[self._skey()] = self._results
+    def set_results(self, results, exclude, deps=None):
+        SearchResultSet.set_results(self, results, exclude)
+        self._results['_deps'] = (set(deps) if (deps is not None)
+                                  else set([self.ANYTHING]))
         self._results['_last_used'] = time.time()
+        with SEARCH_RESULT_CACHE_LOCK:
+            # If anything we depend on was invalidated while we were busy
+            # searching, our results may already be stale; do not cache.
+            if self._changed_since(self._results['_deps']):
+                return self
+            SEARCH_RESULT_CACHE[self._skey()] = self._results
+            self._evict(len(SEARCH_RESULT_CACHE) - self.MAX_ENTRIES)
         return self
 
+    def _changed_since(self, deps):
+        if self._generation != SEARCH_RESULT_CACHE_GENERATION[0]:
+            return True
+        if self._serial == SEARCH_RESULT_CACHE_SERIAL[0]:
+            return False
+        changes = SEARCH_RESULT_CACHE_CHANGES
+        if not changes or changes[0][0] > self._serial + 1:
+            return True  # The log no longer goes back far enough
+        for serial, changed in reversed(changes):
+            if serial <= self._serial:
+                break
+            if self.ANYTHING in deps or not deps.isdisjoint(changed):
+                return True
+        return False
+
+    @classmethod
+    def _evict(cls, count):
+        if count <= 0:
+            return
+        lru = sorted(SEARCH_RESULT_CACHE.iteritems(),
+                     key=lambda kv: kv[1].get('_last_used', 0))
+        for skey, results in lru[:count]:
+            del SEARCH_RESULT_CACHE[skey]
+        SEARCH_RESULT_CACHE_STATS['evictions'] += len(lru[:count])
+
+    @classmethod
+    def DropCaches(cls, msg_idxs=None, tags=None, terms=None):
+        """
+        Expire cached results which may have been changed by edits to
+        the given messages, tags or posting list terms. If called with
+        no arguments, everything is expired.
+        """
+        with SEARCH_RESULT_CACHE_LOCK:
+            if msg_idxs is None and tags is None and terms is None:
+                SEARCH_RESULT_CACHE_GENERATION[0] += 1
+                SEARCH_RESULT_CACHE_SERIAL[0] += 1
+                SEARCH_RESULT_CACHE_STATS['invalidations'] += len(
+                    SEARCH_RESULT_CACHE)
+                SEARCH_RESULT_CACHE.clear()
+                del SEARCH_RESULT_CACHE_CHANGES[:]
+                return
+
+            changed = set(terms or [])
+            changed |= set('%s:in' % tid for tid in (tags or []))
+            if not (changed or msg_idxs):
+                return
+            SEARCH_RESULT_CACHE_SERIAL[0] += 1
+            SEARCH_RESULT_CACHE_CHANGES.append(
+                (SEARCH_RESULT_CACHE_SERIAL[0], changed))
+            del SEARCH_RESULT_CACHE_CHANGES[:-cls.MAX_CHANGES]
+            for skey, results in SEARCH_RESULT_CACHE.items():
+                deps = results.get('_deps') or set([cls.ANYTHING])
+                if cls.ANYTHING in deps or not deps.isdisjoint(changed):
+                    del SEARCH_RESULT_CACHE[skey]
+                    SEARCH_RESULT_CACHE_STATS['invalidations'] += 1
+
     @classmethod
-    def DropCaches(cls, msg_idxs=None, tags=None):
-        # FIXME: Make this more granular
-        global SEARCH_RESULT_CACHE
-        SEARCH_RESULT_CACHE = {}
+    def CacheStats(cls):
+        with SEARCH_RESULT_CACHE_LOCK:
+            stats = dict(SEARCH_RESULT_CACHE_STATS)
+            stats['entries'] = len(SEARCH_RESULT_CACHE)
+        return stats
 
 
 if __name__ == '__main__':
@@ -0,0 +1,410 @@
+"""
+Immutable, sorted segments of posting lists (a log-structured merge tree).
+
+New search terms accumulate in the keyword journal (kw-journal.dat) and
+the in-memory GLOBAL_GPL of mailpile.postinglist. Traditionally they are
+then migrated term by term into PostingListContainer files, which means
+rewriting many small files and purging deleted messages from each one.
+
+A SegmentStore instead flushes the whole journal at once, as a single new
+segment: a file of posting lists sorted by term signature, with a sparse
+index for lookups. Segments are never modified. A tiered merger combines
+the oldest FANOUT segments of a level into one segment of the next level
+up, so each posting list gets rewritten about log(N) times in total.
+
+Deleted messages are recorded as tombstones, which are subtracted when
+reading and dropped from the data itself whenever segments get merged.
+Terms listed as exempt (the list of deleted messages itself) keep them.
+
+The list of live segments, the tombstones and I/O statistics are kept in
+a small JSON manifest which is replaced atomically. Any segment file not
+listed there is left over from an interrupted flush or merge, and gets
+removed when the store is opened.
+
+Segments are not encrypted, so callers must only use them when the
+search index itself is not supposed to be encrypted.
+
+>>> import tempfile
+>>> store = SegmentStore(tempfile.mkdtemp(), fanout=2)
+>>> store.flush({'aaa': IntSet([1, 2]), 'bbb': IntSet([3])})
+>>> store.flush({'aaa': [4], 'ccc': [2, 5], 'ddd': [2]},
+...             tombstones=[2], exempt=['ddd'])
+>>> store.hits('aaa'), store.hits('ccc'), store.hits('ddd')
+(IntSet([1, 4]), IntSet([5]), IntSet([2]))
+>>> store.hits('zzz')
+IntSet([])
+>>> store.estimate('aaa') >= 2, store.estimate('zzz')
+(True, 0)
+
+>>> store.merge()
+1
+>>> [(s['level'], s['records']) for s in store.segments]
+[(1, 4)]
+>>> store.hits('aaa'), store.hits('bbb'), store.hits('ddd')
+(IntSet([1, 4]), IntSet([3]), IntSet([2]))
+>>> st = store.stats()
+>>> st['flushes'], st['merges'], st['write_amplification'] > 1.0
+(2, 1, True)
+
+The manifest survives a restart:
+>>> SegmentStore(store.path).hits('aaa')
+IntSet([1, 4])
+"""
+from __future__ import print_function
+import heapq
+import json
+import os
+import struct
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+from mailpile.index.intset import IntSet
+from mailpile.util import *
+
+
+SEGMENT_MAGIC = 'MPSEG001'
+
+# index offset, record count, magic
+TRAILER = struct.Struct('<QQ8s')
+
+
+def _sig(sig):
+    return sig.encode('utf-8') if isinstance(sig, unicode) else sig
+
+
+def WriteSegment(fn, records, index_interval=64):
+    """
+    Write (sig, IntSet) records, which must be sorted by sig, to a new
+    segment file. Empty posting lists are skipped. Returns the number of
+    records and bytes written.
+    """
+    count = 0
+    index = []
+    newfile = '%s.new' % fn
+    with open(newfile, 'wb') as fd:
+        fd.write(SEGMENT_MAGIC + '\n')
+        for sig, ids in records:
+            if not ids:
+                continue
+            if count % index_interval == 0:
+                index.append('%s\t%d\n' % (sig, fd.tell()))
+            fd.write('%s\t%s\n' % (sig, ids.encode()))
+            count += 1
+        index_offset = fd.tell()
+        fd.write(''.join(index))
+        fd.write(TRAILER.pack(index_offset, count, SEGMENT_MAGIC))
+        size = fd.tell()
+    os.rename(newfile, fn)
+    return count, size
+
+
+class Segment(object):
+    """
+    The sparse index of a segment file. Reads go through file objects
+    owned by the SegmentStore, so we do not hold any file handles open.
+    """
+    def __init__(self, fd):
+        fd.seek(0, 2)
+        size = fd.tell()
+        if size < len(SEGMENT_MAGIC) + 1 + TRAILER.size:
+            raise ValueError('Truncated segment')
+        fd.seek(size - TRAILER.size)
+        self.end, self.count, magic = TRAILER.unpack(fd.read(TRAILER.size))
+        if magic != SEGMENT_MAGIC or self.end > size - TRAILER.size:
+            raise ValueError('Not a segment')
+
+        fd.seek(self.end)
+        self.keys, self.offsets = [], []
+        for line in fd.read(size - TRAILER.size - self.end).splitlines():
+            sig, offset = line.split('\t')
+            self.keys.append(sig)
+            self.offsets.append(int(offset))
+
+    def find(self, fd, sig):
+        """Return the encoded posting list of a signature, or None."""
+        i = bisect_right(self.keys, sig) - 1
+        if i < 0:
+            return None
+        start = self.offsets[i]
+        end = self.offsets[i + 1] if (i + 1 < len(self.offsets)) else self.end
+        fd.seek(start)
+        for line in fd.read(end - start).splitlines():
+            key, value = line.split('\t', 1)
+            if key == sig:
+                return value
+            elif key > sig:
+                break
+        return None
+
+    def get(self, fd, sig):
+        value = self.find(fd, sig)
+        return IntSet.Parse([value]) if (value is not None) else None
+
+    def records(self, fd):
+        """Iterate through all the (sig, encoded value) pairs, in order."""
+        fd.seek(len(SEGMENT_MAGIC) + 1)
+        while fd.tell() < self.end:
+            sig, value = fd.readline().rstrip('\n').split('\t', 1)
+            yield sig, value
+
+
+class SegmentStore(object):
+    """
+    A directory of posting list segments, see the module documentation.
+    """
+    FANOUT = 4
+    MAX_OPEN_FILES = 16
+    MANIFEST = 'MANIFEST'
+
+    def __init__(self, path, fanout=None, max_open_files=None):
+        self.path = path
+        self.fanout = fanout or self.FANOUT
+        self.max_open_files = max_open_files or self.MAX_OPEN_FILES
+        self.lock = threading.RLock()
+        self.merge_lock = threading.Lock()
+        self._fds = OrderedDict()
+        self._readers = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._load_manifest()
+
+    @classmethod
+    def ForConfig(cls, config, create=False):
+        """Return the store of a workdir, or None if there is none yet."""
+        path = os.path.join(config.workdir, 'search', 'segments')
+        with SEGMENT_STORES_LOCK:
+            store = SEGMENT_STORES.get(path)
+            if store is None and (create or
+                                  os.path.exists(os.path.join(
+                                      path, cls.MANIFEST))):
+                store = SEGMENT_STORES[path] = cls(path)
+            return store
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.path, self.MANIFEST), 'rb') as fd:
+                manifest = json.load(fd)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+        self.seq = manifest.get('seq', 0)
+        self.segments = manifest.get('segments', [])
+        self.tombstones = IntSet.Parse([manifest.get('tombstones', '~')])
+        self.exempt = set(_sig(s) for s in manifest.get('exempt', []))
+        self.counters = {
+            'flushes': 0,
+            'merges': 0,
+            'flushed_bytes': 0,
+            'written_bytes': 0}
+        self.counters.update(manifest.get('counters', {}))
+
+        # Clean up after interrupted flushes or merges
+        live = set(s['name'] for s in self.segments)
+        for fn in os.listdir(self.path):
+            if fn.startswith('seg-') and fn not in live:
+                safe_remove(os.path.join(self.path, fn))
+
+    def _save_manifest(self):
+        manifest = {
+            'seq': self.seq,
+            'segments': self.segments,
+            'tombstones': self.tombstones.encode(),
+            'exempt': sorted(self.exempt),
+            'counters': self.counters}
+        fn = os.path.join(self.path, self.MANIFEST)
+        with open(fn + '.new', 'wb') as fd:
+            json.dump(manifest, fd)
+        os.rename(fn + '.new', fn)
+
+    def _new_segment(self, level):
+        with self.lock:
+            self.seq += 1
+            name = 'seg-%d-%08d' % (level, self.seq)
+        return name, os.path.join(self.path, name)
+
+    def _open(self, name):
+        """Return (reader, fd) for a segment, keeping the fd cached."""
+        fd = self._fds.pop(name, None)
+        if fd is None:
+            fd = open(os.path.join(self.path, name), 'rb')
+            while len(self._fds) >= self.max_open_files:
+                self._fds.popitem(last=False)[1].close()
+        self._fds[name] = fd
+        if name not in self._readers:
+            self._readers[name] = Segment(fd)
+        return self._readers[name], fd
+
+    def _forget(self, name):
+        fd = self._fds.pop(name, None)
+        if fd is not None:
+            fd.close()
+        self._readers.pop(name, None)
+
+    def flush(self, words, tombstones=None, exempt=None):
+        """
+        Write a dict of posting lists out as a new segment, and record
+        which message IDs have been deleted.
+        """
+        records = sorted((_sig(sig), IntSet(ids))
+                         for sig, ids in words.iteritems() if ids)
+        segment = None
+        if records:
+            name, fn = self._new_segment(0)
+            count, size = WriteSegment(fn, records)
+            segment = {'name': name, 'level': 0,
+                       'records': count, 'bytes': size}
+
+        with self.lock:
+            if segment:
+                self.segments.append(segment)
+                self.counters['flushes'] += 1
+                self.counters['flushed_bytes'] += segment['bytes']
+                self.counters['written_bytes'] += segment['bytes']
+            if tombstones:
+                self.tombstones |= tombstones
+            if exempt:
+                self.exempt |= set(_sig(s) for s in exempt)
+            if segment or tombstones or exempt:
+                self._save_manifest()
+
+    def hits(self, sig):
+        """Return the IntSet of message IDs matching a term signature."""
+        sig = _sig(sig)
+        result = IntSet()
+        with self.lock:
+            for segment in self.segments:
+                reader, fd = self._open(segment['name'])
+                ids = reader.get(fd, sig)
+                if ids:
+                    result |= ids
+            if result and self.tombstones and sig not in self.exempt:
+                result -= self.tombstones
+        return result
+
+    def estimate(self, sig):
+        """
+        Estimate how many message IDs match a term signature, without
+        decoding anything. Every ID takes at least one byte, so this is
+        an upper bound; tombstones are not subtracted.
+        """
+        sig = _sig(sig)
+        count = 0
+        with self.lock:
+            for segment in self.segments:
+                reader, fd = self._open(segment['name'])
+                value = reader.find(fd, sig)
+                if value:
+                    count += IntSet.Estimate([value])
+        return count
+
+    def _pick_merge(self):
+        levels = {}
+        for segment in self.segments:
+            levels.setdefault(segment['level'], []).append(segment)
+        for level in sorted(levels.keys()):
+            if len(levels[level]) >= self.fanout:
+                return level, levels[level][:self.fanout]
+        return None, []
+
+    def _merged_records(self, victims, tombstones, exempt):
+        streams = []
+        for segment in victims:
+            fd = open(os.path.join(self.path, segment['name']), 'rb')
+            streams.append((fd, Segment(fd).records(fd)))
+        try:
+            last_sig, values = None, []
+            for sig, value in heapq.merge(*[s for fd, s in streams]):
+                if sig != last_sig and values:
+                    yield last_sig, self._combine(last_sig, values,
+                                                  tombstones, exempt)
+                    values = []
+                last_sig = sig
+                values.append(value)
+            if values:
+                yield last_sig, self._combine(last_sig, values,
+                                              tombstones, exempt)
+        finally:
+            for fd, s in streams:
+                fd.close()
+
+    def _combine(self, sig, values, tombstones, exempt):
+        ids = IntSet.Parse(values)
+        if tombstones and sig not in exempt:
+            ids -= tombstones
+        return ids
+
+    def merge(self, runtime=None):
+        """
+        Merge segments until no level has FANOUT or more of them, or
+        until runtime seconds have passed. Returns the number of merges.
+        """
+        deadline = runtime and (time.time() + runtime)
+        merges = 0
+        with self.merge_lock:
+            while not (deadline and time.time() > deadline):
+                with self.lock:
+                    level, victims = self._pick_merge()
+                    tombstones = IntSet(self.tombstones)
+                    exempt = set(self.exempt)
+                if not victims:
+                    break
+
+                name, fn = self._new_segment(level + 1)
+                count, size = WriteSegment(
+                    fn, self._merged_records(victims, tombstones, exempt))
+                segment = {'name': name, 'level': level + 1,
+                           'records': count, 'bytes': size}
+
+                with self.lock:
+                    names = set(v['name'] for v in victims)
+                    pos = min(i for i, s in enumerate(self.segments)
+                              if s['name'] in names)
+                    self.segments = [s for s in self.segments
+                                     if s['name'] not in names]
+                    if count:
+                        self.segments.insert(pos, segment)
+                    self.counters['merges'] += 1
+                    self.counters['written_bytes'] += size
+                    self._save_manifest()
+                    for victim in names:
+                        self._forget(victim)
+
+                for victim in names:
+                    safe_remove(os.path.join(self.path, victim))
+                if not count:
+                    safe_remove(fn)
+                merges += 1
+        return merges
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['segments'] = len(self.segments)
+            stats['levels'] = len(set(s['level'] for s in self.segments))
+            stats['bytes'] = sum(s['bytes'] for s in self.segments)
+            stats['tombstones'] = len(self.tombstones)
+            stats['open_files'] = len(self._fds)
+            stats['write_amplification'] = (
+                float(stats['written_bytes']) / stats['flushed_bytes']
+                if stats['flushed_bytes'] else 0.0)
+        return stats
+
+    def close(self):
+        with self.lock:
+            for name in list(self._fds.keys()):
+                self._forget(name)
+
+
+SEGMENT_STORES = {}
+SEGMENT_STORES_LOCK = threading.Lock()
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
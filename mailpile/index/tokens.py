@@ -0,0 +1,166 @@
+"""
+A substring index for short texts, such as names and e-mail addresses.
+
+Texts are split into tokens (words), and each distinct token is mapped
+to the keys of the texts it occurs in. Since names and domains repeat a
+lot, the vocabulary is much smaller than the texts themselves. To find
+the tokens which contain a search term, the vocabulary is packed into a
+single newline-separated string which is searched with str.find(), so
+even a vocabulary of hundreds of thousands of tokens is searched in a
+millisecond or two. Candidate keys are then checked against the full
+text, so results are exactly those a linear scan would find.
+
+>>> ti = TokenIndex()
+>>> ti.add('bre', u'Bjarni R. Einarsson', 'bre@example.com')
+>>> ti.add('dude', 'Dude', 'd@evil.com')
+>>> ti.add('guy', 'Guy Evilsson')
+>>> sorted(ti.search(['evil'])), sorted(ti.search(['ARSS', 'ex']))
+(['dude', 'guy'], ['bre'])
+>>> sorted(ti.search(['d@evil'])), sorted(ti.search(['uy'])), ti.search(['q'])
+(['dude'], ['guy'], set([]))
+>>> sorted(ti.search([''])), sorted(ti.search([' ', 'evil']))
+(['bre', 'dude', 'guy'], ['dude', 'guy'])
+
+>>> ti.add('dude', 'Dude', 'dude@example.com')
+>>> sorted(ti.search(['example.com'])), sorted(ti.search(['evil']))
+(['bre', 'dude'], ['guy'])
+>>> ti.remove('guy')
+>>> ti.search(['evil']), len(ti), 'guy' in ti
+(set([]), 2, False)
+"""
+from __future__ import print_function
+import bisect
+import re
+import threading
+
+
+class TokenIndex(object):
+    """
+    An incrementally updated substring index, mapping texts to keys.
+    """
+    MIN_SUBSTRING = 3
+    MAX_PENDING = 500
+    TOKEN_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.texts = {}       # key -> normalized text
+        self.postings = {}    # token -> set of keys
+        self._packed = u'\n'  # Searchable vocabulary, see _pack()
+        self._starts = []     # Offsets of each packed token
+        self._tokens = []     # The packed tokens, in order
+        self._pending = set() # Tokens added since we last packed
+        self._stale = 0       # Tokens removed since we last packed
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, key):
+        return key in self.texts
+
+    @classmethod
+    def normalize(cls, text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return text.lower()
+
+    def _split(self, text):
+        return set(t for t in self.TOKEN_RE.split(text) if t)
+
+    def add(self, key, *texts):
+        """Index (or reindex) the texts for a key."""
+        text = u'\n'.join(self.normalize(t) for t in texts if t)
+        with self.lock:
+            if key in self.texts:
+                self._remove(key)
+            self.texts[key] = text
+            for token in self._split(text):
+                keys = self.postings.get(token)
+                if keys is None:
+                    keys = self.postings[token] = set()
+                    self._pending.add(token)
+                keys.add(key)
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for token in self._split(text):
+            keys = self.postings.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    # The token lingers in the packed vocabulary until the
+                    # next repack, but it no longer leads anywhere.
+                    del self.postings[token]
+                    self._pending.discard(token)
+                    self._stale += 1
+
+    def _pack(self):
+        self._tokens = sorted(self.postings)
+        self._starts, pos = [], 1
+        for token in self._tokens:
+            self._starts.append(pos)
+            pos += len(token) + 1
+        self._packed = u'\n%s\n' % u'\n'.join(self._tokens)
+        self._pending = set()
+        self._stale = 0
+
+    def _matching_tokens(self, piece):
+        """Find tokens containing a piece of a term."""
+        if (len(self._pending) > self.MAX_PENDING or
+                self._stale > max(self.MAX_PENDING, len(self._tokens) // 4)):
+            self._pack()
+        found = [t for t in self._pending if piece in t]
+
+        packed, starts, tokens = self._packed, self._starts, self._tokens
+        pos = packed.find(piece)
+        while pos >= 0:
+            i = bisect.bisect_right(starts, pos) - 1
+            found.append(tokens[i])
+            end = starts[i] + len(tokens[i])
+            pos = packed.find(piece, max(end, pos + 1))
+        return found
+
+    def _search_term(self, term):
+        if not term.strip():
+            # Like '' in text, an empty term matches everything
+            return set(self.texts)
+        pieces = self._split(term)
+        piece = max(pieces, key=len) if pieces else ''
+        if len(piece) < self.MIN_SUBSTRING and term != piece:
+            # Short bits of punctuated terms match much of the vocabulary,
+            # so a plain scan is as quick (and handles pure punctuation).
+            return set(k for k, t in self.texts.iteritems() if term in t)
+
+        matches = set()
+        for token in self._matching_tokens(piece):
+            matches |= self.postings.get(token, set())
+        if term != piece:
+            matches = set(k for k in matches if term in self.texts[k])
+        return matches
+
+    def search(self, terms):
+        """Return the keys of texts matching all of the terms."""
+        results = None
+        with self.lock:
+            for term in terms:
+                matches = self._search_term(self.normalize(term))
+                results = matches if (results is None) else (results & matches)
+                if not results:
+                    return set()
+            return set(self.texts) if (results is None) else results
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
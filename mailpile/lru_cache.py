@@ -0,0 +1,185 @@
+"""
+Bounded, thread-safe LRU caches with statistics.
+
+Each LRUCache has a budget for the number of entries it holds and for
+their (estimated) size in bytes; when either is exceeded, the least
+recently used entries are evicted. Caches count their hits, misses and
+evictions and register themselves by name, so their statistics can be
+reported (and their budgets tuned) with the `caches` command.
+
+>>> c = LRUCache('doctest', max_entries=3, max_bytes=100)
+>>> c['a'], c['b'], c['c'] = 1, 2, 3
+>>> c.get('a'), c.get('z')
+(1, None)
+>>> c['d'] = 4
+>>> sorted(c.keys()), 'b' in c
+(['a', 'c', 'd'], False)
+
+>>> c.put('e', 5, size=99)
+>>> sorted(c.keys())
+['d', 'e']
+>>> s = c.stats()
+>>> (s['hits'], s['misses'], s['evictions'], s['entries'], s['bytes'])
+(1, 1, 3, 2, 100)
+
+>>> c.discard_if(lambda k, v: v > 4)
+1
+>>> c.resize(max_entries=0)
+>>> len(c), c.stats()['evictions']
+(0, 4)
+>>> 'doctest' in [s['name'] for s in CacheStats()]
+True
+"""
+from __future__ import print_function
+import threading
+import weakref
+from collections import OrderedDict
+
+
+# All the live caches, so we can report on them
+CACHE_REGISTRY = weakref.WeakSet()
+
+
+class LRUCache(object):
+    """
+    A dict-like cache which evicts the least recently used entries.
+
+    Entry sizes are estimated by the sizeof function (which defaults to
+    counting every entry as one byte), or given explicitly to put().
+    Budgets of None mean "unlimited".
+    """
+    def __init__(self, name, max_entries=None, max_bytes=None, sizeof=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 1)
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        CACHE_REGISTRY.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        with self.lock:
+            return self._entries.keys()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def put(self, key, value, size=None):
+        with self.lock:
+            self._remove(key)
+            if size is None:
+                size = self.sizeof(value)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            self._evict()
+
+    __setitem__ = put
+
+    def _remove(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self._bytes -= self._sizes.pop(key)
+            return True
+        return False
+
+    def _evict(self):
+        while self._entries and (
+                (self.max_entries is not None and
+                 len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self._bytes > self.max_bytes)):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self._entries.get(key, default)
+            self._remove(key)
+            return value
+
+    def __delitem__(self, key):
+        with self.lock:
+            if not self._remove(key):
+                raise KeyError(key)
+
+    def discard_if(self, check):
+        """Remove all entries for which check(key, value) is true."""
+        with self.lock:
+            doomed = [k for k, v in self._entries.iteritems() if check(k, v)]
+            for key in doomed:
+                self._remove(key)
+            return len(doomed)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """Change the budgets (None leaves one as-is), evicting if needed."""
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (float(self.hits) / lookups) if lookups else 0.0}
+
+
+def CacheStats():
+    """Return the statistics of all live caches, sorted by name."""
+    return sorted((c.stats() for c in list(CACHE_REGISTRY)),
+                  key=lambda s: s['name'])
+
+
+def FindCaches(name):
+    return [c for c in list(CACHE_REGISTRY) if c.name == name]
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
@@ -782,6 +782,23 @@ class BaseMailSource(threading.Thread):
     def _msg_key_order(self, key):
         return key
 
+    def _iter_messages(self, src, keys):
+        """
+        Yield (key, metadata keywords, data) for each key. Mailboxes which
+        can download messages in bulk (see SharedImapMailbox) do so, for
+        others we fetch one message at a time. The data is None for
+        messages which could not be found.
+        """
+        if hasattr(src, 'iter_messages'):
+            for result in src.iter_messages(list(keys)):
+                yield result
+            return
+        for key in keys:
+            try:
+                yield key, src.get_metadata_keywords(key), src.get_bytes(key)
+            except KeyError:
+                yield key, None, None
+
     def _copy_new_messages(self, mbx_key, mbx_cfg, src,
                            stop_after=-1, scan_args=None, deadline=None):
         session, config = self.session, self.session.config
@@ -873,17 +890,15 @@ class BaseMailSource(threading.Thread):
 
             # Go download!
             key_errors = []
-            for key in reversed(keys):
+            started = time.time()
+            for key, mkws, data in self._iter_messages(src, reversed(keys)):
                 if self._check_interrupt(log=False, clear=False):
                     progress['interrupted'] = True
                     return count
 
                 session.ui.mark(_('Copying message: %s') % key)
                 progress['copying_src_id'] = key
-                try:
-                    mkws = src.get_metadata_keywords(key)
-                    data = src.get_bytes(key)
-                except KeyError:
+                if data is None:
                     progress['key_errors'] = key_errors
                     key_errors.append(key)
                     # Ignore, in case this is a problem with just this
@@ -896,6 +911,9 @@ class BaseMailSource(threading.Thread):
                 progress['copied_messages'] += 1
                 progress['copied_bytes'] += len(data)
                 progress['uncopied'] -= 1
+                elapsed = max(0.001, time.time() - started)
+                progress['bytes_per_second'] = int(
+                    progress['copied_bytes'] / elapsed)
                 count += 1
 
                 # This forks off a scan job to index the message
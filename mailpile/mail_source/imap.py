@@ -145,6 +145,74 @@ def _parse_imap(reply):
     return (reply[0].upper() == 'OK'), pdata
 
 
+def _uid_set(uids):
+    """
+    Compress a list of UIDs into an IMAP sequence set.
+
+    >>> _uid_set([5, 1, 2, 3, 9, 10, 7])
+    '1:3,5,7,9:10'
+    """
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(('%d' % a) if (a == b) else ('%d:%d' % (a, b))
+                    for a, b in ranges)
+
+
+IMAP_LITERAL = re.compile('\\{(\\d+)\\}$')
+
+
+def _parse_imap_fetch(data):
+    """
+    Parse a raw (unparsed) FETCH response into a dict mapping UIDs to
+    dicts of message attributes. Literals (message bodies) are passed
+    through untouched.
+
+    >>> info = _parse_imap_fetch([
+    ...     ('1 (UID 5 FLAGS (\\Seen) BODY[] {5}', 'Hello'), ')',
+    ...     ('2 (UID 7 BODY[] {3}', 'Bye'), ' FLAGS ())',
+    ...     '3 (UID 8 RFC822.SIZE 100 FLAGS ())'])
+    >>> sorted(info.keys())
+    [5, 7, 8]
+    >>> info[5]['BODY[]'], info[5]['FLAGS'], info[7]['BODY[]']
+    ('Hello', ['\\\\Seen'], 'Bye')
+    >>> info[8]['RFC822.SIZE']
+    '100'
+    """
+    results = {}
+    text, literals = '', {}
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            # A literal; replace it with a placeholder atom which our
+            # parser will pass through, and keep going.
+            placeholder = '\x00%d' % len(literals)
+            literals[placeholder] = item[1]
+            text += IMAP_LITERAL.sub(placeholder, item[0])
+            continue
+
+        text += item
+        ok, parsed = _parse_imap(('OK', [text]))
+        text, lits = '', literals
+        literals = {}
+        if len(parsed) < 2 or not isinstance(parsed[1], list):
+            continue
+        info = dict(zip(*[iter(parsed[1])]*2))
+        for k, v in info.iteritems():
+            if isinstance(v, str) and v in lits:
+                info[k] = lits[v]
+        try:
+            info['UID'] = int(info['UID'])
+            results[info['UID']] = info
+        except (KeyError, ValueError):
+            pass
+    return results
+
+
 class ImapMailboxIndex(MailboxIndex):
     pass
 
@@ -382,7 +450,35 @@ class SharedImapMailbox(Mailbox):
     >>> imap = ImapMailSource(session, imap_config)
     >>> mailbox = SharedImapMailbox(session, imap, conn_cls=_MockImap)
     >>> #mailbox.add('From: Bjarni\\r\\nBarely a message')
+
+    Many messages can be downloaded at once, which is much faster than
+    fetching them one at a time:
+
+    >>> imap = ImapMailSource(session, imap_config)
+    >>> mailbox = SharedImapMailbox(session, imap, conn_cls=_Mocks.Mailbox)
+    >>> keys = mailbox.keys()
+    >>> keys
+    ['1.1', '1.2', '1.3']
+    >>> fetches = imap.conn._conn.fetches
+    >>> results = list(mailbox.iter_messages(keys + ['1.9']))
+    >>> for key, mkws, data in results:
+    ...     print('%s %s %d' % (key, mkws, len(data or '')))
+    1.1 ['s:maildir'] 39
+    1.2 [] 6000
+    1.3 [] 39
+    1.9 None 0
+    >>> imap.conn._conn.fetches - fetches
+    2
+    >>> results[1][2] == mailbox.get_bytes('1.2')
+    True
+    >>> imap.bytes_per_second > 0
+    True
     """
+    # Fetch sizes and flags for this many messages at a time
+    INFO_BATCH = 1000
+
+    # Never request more than this many message bodies at once
+    FETCH_BATCH = 100
 
     def __init__(self, session, mail_source,
                  mailbox_path='INBOX', conn_cls=None):
@@ -473,11 +569,9 @@ class SharedImapMailbox(Mailbox):
         if 'UID' not in info:
             raise KeyError(key)
 
-        # FIXME: This will hard fail to download mail, if our internet
-        #        connection averages 8 kbps or worse. Better would be to
-        #        adapt the chunk size here to actual network performance.
-        #
-        chunk_size = self.source.timeout * 1024
+        # Chunks are sized according to how fast our connection has
+        # been, so each one can complete well within the timeout.
+        chunk_size = self.source.fetch_budget()
         chunk = 0
         msg_data = []
         if _bytes and chunk_size > _bytes:
@@ -490,12 +584,14 @@ class SharedImapMailbox(Mailbox):
             req = '(BODY.PEEK[]<%d.%d>)' % (chunk * chunk_size, chunk_size)
             with self.open_imap() as imap:
                 # Note: use the raw method, not the convenient parsed version.
+                t0 = time.time()
                 typ, data = self.source.timed(imap.uid,
                                               'FETCH', info['UID'], req,
                                               mailbox=self.path)
             self._assert(typ == 'OK',
                          _('Fetching chunk %d failed') % chunk)
             msg_data.append(data[0][1])
+            self.source.record_throughput(len(data[0][1]), time.time() - t0)
             if len(data[0][1]) < chunk_size:
                 chunk = -1
             else:
@@ -507,6 +603,93 @@ class SharedImapMailbox(Mailbox):
         #        significantly less data than expected via. RFC822.SIZE?
         return info, ''.join(msg_data)
 
+    def _fetch_uids(self, uidv, uids, items):
+        self._broken = None
+        with self.open_imap() as imap:
+            t0 = time.time()
+            typ, data = self.source.timed(imap.uid,
+                                          'FETCH', _uid_set(uids), items,
+                                          mailbox=self.path)
+            elapsed = time.time() - t0
+            self._assert(typ == 'OK', _('Fetching messages failed'))
+            self._assert(str(uidv) in imap.mailbox_info('UIDVALIDITY', ['0']),
+                         _('Mailbox is out of sync'))
+        self._broken = False
+        return _parse_imap_fetch(data), elapsed
+
+    def _mkws(self, info):
+        # Translate common IMAP flags into the maildir vocabulary
+        flags = [f.lower() for f in info.get('FLAGS', '')]
+        mkws = []
+        for char, flag in (('s', '\\seen'),
+                           ('r', '\\answered'),
+                           ('d', '\\draft'),
+                           ('f', '\\flagged'),
+                           ('t', '\\deleted')):
+           if flag in flags:
+               mkws.append('%s:maildir' % char)
+        return mkws
+
+    def iter_messages(self, keys):
+        """
+        Download many messages, yielding (key, metadata keywords, data)
+        tuples in the order requested. The keywords and data are None for
+        messages which could not be found.
+
+        Sizes and flags are fetched for a group of messages at once, and
+        then as many message bodies as we expect to be able to download
+        within the timeout are requested using a single FETCH command.
+        Messages too large for that are downloaded in chunks by get().
+        """
+        for i in range(0, len(keys), self.INFO_BATCH):
+            group = keys[i:i + self.INFO_BATCH]
+            uids = {}
+            for key in group:
+                uidv, uid = (int(k, 36) for k in key.split('.'))
+                uids[key] = uid
+            infos, elapsed = self._fetch_uids(uidv, uids.values(),
+                                              '(UID RFC822.SIZE FLAGS)')
+
+            batch, batch_bytes = [], 0
+            for j, key in enumerate(group):
+                info = infos.get(uids[key])
+                size = long((info or {}).get('RFC822.SIZE', 0))
+                batch.append((key, info, size))
+                batch_bytes += size
+                if (j < len(group) - 1 and
+                        len(batch) < self.FETCH_BATCH and
+                        batch_bytes < self.source.fetch_budget()):
+                    continue
+                for result in self._iter_batch(uidv, batch):
+                    yield result
+                batch, batch_bytes = [], 0
+
+    def _iter_batch(self, uidv, batch):
+        budget = self.source.fetch_budget()
+        small = [info['UID'] for key, info, size in batch
+                 if info is not None and size < budget]
+        if small:
+            bodies, elapsed = self._fetch_uids(
+                uidv, small, '(UID RFC822.SIZE FLAGS BODY.PEEK[])')
+            self.source.record_throughput(
+                sum(len(b.get('BODY[]', '')) for b in bodies.values()),
+                elapsed)
+        else:
+            bodies = {}
+
+        for key, info, size in batch:
+            if info is None:
+                yield key, None, None
+                continue
+            body = bodies.get(info['UID'], {})
+            if 'BODY[]' in body:
+                yield key, self._mkws(body), body['BODY[]']
+            else:
+                try:
+                    yield key, self._mkws(info), self.get(key)[1]
+                except KeyError:
+                    yield key, None, None
+
     def get_message(self, key):
         info, payload = self.get(key)
         return Message(payload)
@@ -549,17 +732,7 @@ class SharedImapMailbox(Mailbox):
         return long(self.get_info(key).get('RFC822.SIZE', 0))
 
     def get_metadata_keywords(self, key):
-        # Translate common IMAP flags into the maildir vocabulary
-        flags = [f.lower() for f in self.get_info(key).get('FLAGS', '')]
-        mkws = []
-        for char, flag in (('s', '\\seen'),
-                           ('r', '\\answered'),
-                           ('d', '\\draft'),
-                           ('f', '\\flagged'),
-                           ('t', '\\deleted')):
-           if flag in flags:
-               mkws.append('%s:maildir' % char)
-        return mkws
+        return self._mkws(self.get_info(key))
 
     def __contains__(self, key):
         try:
@@ -859,6 +1032,7 @@ class ImapMailSource(BaseMailSource):
         self.flag_cache = {}
         self.conn = None
         self.conn_id = ''
+        self.bytes_per_second = 0
 
     @classmethod
     def Tester(cls, conn_cls, *args, **kwargs):
@@ -871,6 +1045,23 @@ class ImapMailSource(BaseMailSource):
     def timed_imap(self, *args, **kwargs):
         return _parse_imap(RunTimed(self.timeout, *args, **kwargs))
 
+    def record_throughput(self, data_bytes, elapsed):
+        """Update our (smoothed) estimate of download speed."""
+        if data_bytes > 0 and elapsed > 0:
+            bps = data_bytes / elapsed
+            if self.bytes_per_second:
+                bps = (self.bytes_per_second + bps) / 2
+            self.bytes_per_second = bps
+
+    def fetch_budget(self):
+        """
+        How many bytes we should request at once. We aim for downloads
+        which take at most a quarter of our timeout, but always allow at
+        least 1 kB per second of timeout (the old fixed chunk size).
+        """
+        return int(max(self.timeout * 1024,
+                       self.bytes_per_second * self.timeout / 4))
+
     def _conn_id(self):
         def e(s):
             try:
@@ -1221,6 +1412,57 @@ class _Mocks(object):
     class BadLogin(_MockImap):
         RESULTS = {'login': ('BAD', ['"Sorry dude"'])}
 
+    class Mailbox(_MockImap):
+        """A mailbox with a few messages in it, which counts FETCHes."""
+        UIDVALIDITY = '1'
+        MESSAGES = {
+            1: ('(\\Seen)',
+                'Subject: Hello\r\n\r\nThis is message one\r\n'),
+            2: ('()', 'Subject: Long\r\n\r\n' + ('x' * 5981) + '\r\n'),
+            3: ('()', 'Subject: Hello\r\n\r\nThis is message two\r\n')}
+        RE_PARTIAL = re.compile('BODY.PEEK\\[\\]<(\\d+)\\.(\\d+)>')
+
+        def __init__(self, *args, **kwargs):
+            _MockImap.__init__(self, *args, **kwargs)
+            self.fetches = 0
+            self.select = self._select
+
+        def _select(self, mailbox='INBOX', readonly=False):
+            return ('OK', [str(len(self.MESSAGES))])
+
+        def response(self, code):
+            return (code, {
+                'EXISTS': [str(len(self.MESSAGES))],
+                'UIDVALIDITY': [self.UIDVALIDITY]}.get(code, [None]))
+
+        def _uids(self, uid_set):
+            for part in str(uid_set).split(','):
+                a, b = (part.split(':') + [part])[:2]
+                for uid in range(int(a), int(b) + 1):
+                    if uid in self.MESSAGES:
+                        yield uid
+
+        def uid(self, command, *args):
+            if command == 'SEARCH':
+                return ('OK', [' '.join('%d' % u for u in self.MESSAGES)])
+            self.fetches += 1
+            uid_set, items = args
+            data = []
+            for uid in self._uids(uid_set):
+                flags, body = self.MESSAGES[uid]
+                partial = self.RE_PARTIAL.search(items)
+                if partial:
+                    start, count = (int(i) for i in partial.groups())
+                    body = body[start:start + count]
+                prefix = '%d (UID %d RFC822.SIZE %d FLAGS %s' % (
+                    uid, uid, len(self.MESSAGES[uid][1]), flags)
+                if 'BODY' in items:
+                    data.extend([('%s BODY[] {%d}' % (prefix, len(body)),
+                                  body), ')'])
+                else:
+                    data.append(prefix + ')')
+            return ('OK', data or [None])
+
 
 if __name__ == "__main__":
     import doctest
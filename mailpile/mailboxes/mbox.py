@@ -1,6 +1,7 @@
 from __future__ import print_function
 import errno
 import mailbox
+import mmap
 import os
 import re
 import threading
@@ -126,42 +127,101 @@ class MailpileMailbox(mailbox.mbox):
             pass
 
         with self._lock:
-            fd.seek(0)
-            self._next_key = 0
-            self._toc = {}
-            self._cs = {}
-            data = ''
-            start = None
-            len_nl = 1
-            while (cur_length > 0):
-                self._last_updated = time.time()
-                line_pos = fd.tell()
-                line = fd.readline()
-                if line.startswith('From '):
-                    if start is not None:
-                        len_nl = ('\r' == line[-2]) and 2 or 1
-                        cs4k = self.get_msg_cs4k(0, 0, data[:-len_nl])
-                        self._toc[self._next_key] = (start, line_pos - len_nl)
-                        self._cs[cs4k] = self._next_key
-                        self._cs[self._next_key] = cs4k
-                        self._next_key += 1
-                    start = line_pos
-                    data = line
-                elif line == '':
-                    if (start is not None) and (start != line_pos):
-                        cs4k = self.get_msg_cs4k(0, 0, data[:-len_nl])
-                        self._toc[self._next_key] = (start, line_pos - len_nl)
-                        self._cs[cs4k] = self._next_key
-                        self._cs[self._next_key] = cs4k
-                        self._next_key += 1
-                    break
-                elif len(data) < (4096 + len_nl):
-                    data += line
+            self._last_updated = time.time()
+            if cur_length > 0:
+                mm = mmap.mmap(fd.fileno(), cur_length,
+                               access=mmap.ACCESS_READ)
+                try:
+                    resume = self._toc_resume_point(mm, cur_length)
+                    if resume is None:
+                        self._next_key = 0
+                        self._toc = {}
+                        self._cs = {}
+                        resume = 0
+                    self._scan_toc(mm, resume, cur_length)
+                finally:
+                    mm.close()
+            else:
+                self._next_key = 0
+                self._toc = {}
+                self._cs = {}
             self._file = fd
-            self._file_length = fd.tell()
+            self._file_length = cur_length
             self._mtime = cur_mtime
         self.save(None)
 
+    def _toc_resume_point(self, mm, cur_length):
+        """
+        If the mailbox has only grown since we last scanned it, forget
+        the last message we know about and return its offset, so the scan
+        can resume from there. Returns None if a full rescan is needed.
+        """
+        try:
+            if not (0 < self._file_length < cur_length):
+                return None
+            last_key = self._next_key - 1
+            if (last_key not in self._cs or
+                    len(self._toc) != self._next_key):
+                return None
+            start, stop = self._toc[last_key]
+            if start != max(self._toc.itervalues())[0]:
+                return None
+        except (NameError, AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+        # Make sure the last message is still where we left it; if it is,
+        # we assume nothing before it has changed either.
+        if mm[start:start + 5] != 'From ':
+            return None
+        data = mm[start:min(stop, start + 4096)]
+        if self.get_msg_cs4k(0, 0, data) != self._cs[last_key]:
+            return None
+
+        cs4k = self._cs.pop(last_key)
+        if self._cs.get(cs4k) == last_key:
+            del self._cs[cs4k]
+        del self._toc[last_key]
+        self._next_key = last_key
+        return start
+
+    def _scan_toc(self, mm, offset, length):
+        """
+        Add all messages found at or after offset to the TOC, using the
+        first 4k of each message to generate its checksum.
+        """
+        def _len_nl(pos):
+            eol = mm.find('\n', pos)
+            return 2 if (eol > 0 and mm[eol-1] == '\r') else 1
+
+        if mm[offset:offset + 5] == 'From ':
+            start = offset
+        else:
+            start = mm.find('\nFrom ', offset)
+            if start < 0:
+                return
+            start += 1
+
+        # The line ending of the last message is inferred from the From
+        # line of the message, unless it is the first one in the file.
+        len_nl = 1
+        while start >= 0:
+            nxt = mm.find('\nFrom ', start)
+            if nxt >= 0:
+                nxt += 1
+                len_nl = _len_nl(nxt)
+                stop = nxt - len_nl
+            else:
+                if self._next_key > 0:
+                    len_nl = _len_nl(start)
+                stop = length - len_nl
+
+            cs4k = self.get_msg_cs4k(0, 0, mm[start:min(stop, start + 4096)])
+            self._toc[self._next_key] = (start, stop)
+            self._cs[cs4k] = self._next_key
+            self._cs[self._next_key] = cs4k
+            self._next_key += 1
+            start = nxt
+
     def _generate_toc(self):
         self.update_toc()
 
@@ -440,6 +500,32 @@ Content-Length: %(length)s
              tests += 1
              ptrs.append([msg_ptr, f2size])
 
+        # Append a message; the TOC should be updated incrementally and
+        # match what a full scan of the mailbox finds.
+        tests += 1
+        tf.write(MSG_TEMPLATE % {
+            'subject': 'Appended message', 'msgid': 'appended@example.com',
+            'length': 0, 'content': ''})
+        tf.write("\n")
+        tf.flush()
+        os.utime(tf.name, (time.time(), mmbx._mtime + 1))
+        offsets = []
+        scan_toc = mmbx._scan_toc
+        mmbx._scan_toc = lambda m, o, l: offsets.append(o) or scan_toc(m, o, l)
+        mmbx.update_toc()
+        del mmbx._scan_toc
+        fresh = MailpileMailbox(tf.name)
+        fresh.update_toc()
+        if offsets != [mmbx._toc[len(lengths) - 1][0]]:
+            problems += 1
+            print('BAD Appending triggered a full rescan: %s' % offsets)
+        elif (mmbx._toc, mmbx._cs) != (fresh._toc, fresh._cs):
+            problems += 1
+            print('BAD Incremental TOC differs from full scan')
+        elif verbose:
+            print('ok  Incremental TOC matches full scan')
+        pmbx = mailbox.mbox(tf.name)
+
         # Remove some messages, bypassing MailpileMailbox
         deletions = [0, 5, 10, 15, 34]
         for d in reversed(sorted(deletions)):
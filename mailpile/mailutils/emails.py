@@ -6,6 +6,7 @@ from __future__ import print_function
 import base64
 import copy
 import email.header
+import email.message
 import email.parser
 import email.utils
 import errno
@@ -29,12 +30,13 @@ from platform import system
 from urllib import quote, unquote
 from datetime import datetime, timedelta
 
-from mailpile.crypto.gpgi import GnuPG
+from mailpile.crypto.gpgi import GnuPG, GNUPG_RESULTS
 from mailpile.crypto.mime import UnwrapMimeCrypto, MessageAsString
 from mailpile.crypto.state import EncryptionInfo, SignatureInfo
 from mailpile.eventlog import GetThreadEvent
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.lru_cache import LRUCache
 from mailpile.vcard import AddressInfo
 from mailpile.mailutils import *
 from mailpile.mailutils.addresses import AddressHeaderParser
@@ -76,32 +78,45 @@ def MakeMessageDate(ts=None):
         localtime=False)
 
 
-GLOBAL_PARSE_CACHE_LOCK = MboxLock()
-GLOBAL_PARSE_CACHE = []
+def _ParsedSize(message):
+    # Rough estimate of the memory used by a parsed message: the payloads
+    # dominate, the rest is overhead for headers and objects.
+    size = 2048
+    for part in message.walk():
+        payload = part.get_payload()
+        if isinstance(payload, (str, unicode)):
+            size += 1024 + 2 * len(payload)
+    return size
+
+
+GLOBAL_PARSE_CACHE = LRUCache('parse', max_entries=25,
+                              max_bytes=16 * 1024 * 1024,
+                              sizeof=_ParsedSize)
 
 def ClearParseCache(cache_id=None, pgpmime=False, full=False):
-    global GLOBAL_PARSE_CACHE
-    with GLOBAL_PARSE_CACHE_LOCK:
-        GPC = GLOBAL_PARSE_CACHE
-        for i in range(0, len(GPC)):
-            if (full or
-                    (pgpmime and GPC[i][1]) or
-                    (cache_id and GPC[i][0] == cache_id)):
-                GPC[i] = (None, None, None)
+    if full:
+        GLOBAL_PARSE_CACHE.clear()
+        GNUPG_RESULTS.clear()
+    elif pgpmime or cache_id:
+        GLOBAL_PARSE_CACHE.discard_if(
+            lambda key, message: ((pgpmime and key[1]) or
+                                  (cache_id and key[0] == cache_id)))
 
 
 def ParseMessage(fd, cache_id=None, update_cache=False,
                      pgpmime='all', config=None, event=None,
                      allow_weak_crypto=False):
-    global GLOBAL_PARSE_CACHE
     if not GnuPG:
         pgpmime = False
 
+    if config is not None:
+        GLOBAL_PARSE_CACHE.resize(
+            max_bytes=config.sys.parse_cache_kb * 1024)
+
     if cache_id is not None and not update_cache:
-        with GLOBAL_PARSE_CACHE_LOCK:
-            for cid, pm, message in GLOBAL_PARSE_CACHE:
-                if cid == cache_id and pm == pgpmime:
-                    return message
+        message = GLOBAL_PARSE_CACHE.get((cache_id, pgpmime))
+        if message is not None:
+            return message
 
     if pgpmime:
         message = ParseMessage(fd, cache_id=cache_id, pgpmime=False,
@@ -125,14 +140,19 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
             require_MDC=(not allow_weak_crypto))
 
     else:
-        try:
-            if not hasattr(fd, 'read'):  # Not a file, is it a function?
-                fd = fd()
-            safe_assert(hasattr(fd, 'read'))
-        except (TypeError, AssertionError):
-            return None
+        if isinstance(fd, email.message.Message):
+            # Parsed already, e.g. to check its signatures ahead of time
+            message = fd
+        else:
+            try:
+                if not hasattr(fd, 'read'):  # Not a file, is it a function?
+                    fd = fd()
+                safe_assert(hasattr(fd, 'read'))
+            except (TypeError, AssertionError):
+                return None
+
+            message = email.parser.Parser().parse(fd)
 
-        message = email.parser.Parser().parse(fd)
         msi = message.signature_info = SignatureInfo(bubbly=False)
         mei = message.encryption_info = EncryptionInfo(bubbly=False)
         for part in message.walk():
@@ -140,10 +160,7 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
             part.encryption_info = EncryptionInfo(parent=mei)
 
     if cache_id is not None:
-        with GLOBAL_PARSE_CACHE_LOCK:
-            # Keep 25 items, put new ones at the front
-            GLOBAL_PARSE_CACHE[24:] = []
-            GLOBAL_PARSE_CACHE[:0] = [(cache_id, pgpmime, message)]
+        GLOBAL_PARSE_CACHE[(cache_id, pgpmime)] = message
 
     return message
 
@@ -772,11 +789,11 @@ class Email(object):
     def update_parse_cache(self, newmsg):
         cache_id = self.get_cache_id()
         if cache_id:
-            with GLOBAL_PARSE_CACHE_LOCK:
-                GPC = GLOBAL_PARSE_CACHE
-                for i in range(0, len(GPC)):
-                    if GPC[i][0] == cache_id:
-                        GPC[i] = (cache_id, False, newmsg)
+            # Any cached parse of this message is stale; replace them all
+            # with the new (unwrapped) version.
+            if GLOBAL_PARSE_CACHE.discard_if(
+                    lambda key, message: key[0] == cache_id):
+                GLOBAL_PARSE_CACHE[(cache_id, False)] = newmsg
 
     def clear_from_parse_cache(self):
         cache_id = self.get_cache_id()
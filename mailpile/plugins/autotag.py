@@ -5,6 +5,7 @@
 # of the classifier.
 
 import math
+import threading
 import time
 import datetime
 
@@ -86,6 +87,10 @@ class AutoTagger(object):
         self.trained = True
         return self.trainer.learn(self, *args)
 
+    def learn_batch(self, *args):
+        self.trained = True
+        return self.trainer.learn_batch(self, *args)
+
     def should_tag(self, *args):
         return self.tagger.should_tag(self, *args)
 
@@ -116,6 +121,79 @@ def LoadAutoTagger(config, at_config):
     return config.autotag[aid]
 
 
+class KeywordCache(object):
+    """
+    The keywords extracted from messages, for training autotaggers.
+
+    Entries are keyed by message index (mid) and record the message's
+    Message-ID hash as well, so they are ignored if the index is rebuilt.
+    Messages which get re-indexed are discarded by filter_hook, which
+    loads the cache to do so; changes are saved after retraining and
+    periodically.
+    """
+    PICKLE_NAME = 'pickled-autotag-keywords'
+    SAVE_INTERVAL = 300
+
+    def __init__(self, keywords=None):
+        self.lock = threading.Lock()
+        self.keywords = keywords or {}
+        self.changed = False
+
+    def get(self, mid, msg_id):
+        entry = self.keywords.get(mid)
+        if entry and entry[0] == msg_id:
+            return entry[1]
+        return None
+
+    def put(self, mid, msg_id, keywords):
+        with self.lock:
+            self.keywords[mid] = (msg_id, keywords)
+            self.changed = True
+
+    def discard(self, mid):
+        with self.lock:
+            if self.keywords.pop(mid, None) is not None:
+                self.changed = True
+
+    def prune(self, keep_mids):
+        """Forget all messages other than these."""
+        with self.lock:
+            for mid in set(self.keywords) - set(keep_mids):
+                del self.keywords[mid]
+                self.changed = True
+
+    def snapshot(self):
+        """Return a copy of the keywords if they changed, or None."""
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            return dict(self.keywords)
+
+
+def SaveKeywordCache(config):
+    if config.real_hasattr('autotag_keywords'):
+        kwc = config.autotag_keywords
+        keywords = kwc.snapshot()
+        if keywords is not None:
+            try:
+                config.save_pickle(keywords, KeywordCache.PICKLE_NAME)
+            except:
+                kwc.changed = True
+                raise
+
+
+def LoadKeywordCache(config):
+    if not config.real_hasattr('autotag_keywords'):
+        try:
+            keywords = config.load_pickle(KeywordCache.PICKLE_NAME,
+                                          delete_if_corrupt=True)
+        except (IOError, EOFError):
+            keywords = {}
+        config.real_setattr('autotag_keywords', KeywordCache(keywords))
+    return config.autotag_keywords
+
+
 # FIXME: This is dumb
 import mailpile.config.manager
 mailpile.config.manager.ConfigManager.load_auto_tagger = LoadAutoTagger
@@ -140,6 +218,11 @@ class Trainer(AutoTagCommand):
         """Learn that this message should (or should not) be tagged"""
         pass
 
+    def learn_batch(self, atagger, at_config, keyword_lists, should_tag):
+        """Learn from many messages at once (msg is None for each)"""
+        for keywords in keyword_lists:
+            self.learn(atagger, at_config, None, keywords, should_tag)
+
     def reset(self, atagger, at_config):
         """Reset to an untrained state (called by AutoTagger.reset)"""
         pass
@@ -208,12 +291,11 @@ class Retrain(AutoTagCommand):
                                 ) % (len(interest[ttype]), ttype))
 
         retrained, unreadable = [], []
-        count_all = 0
+        training = []
         for at_config in autotag_configs(config):
             at_tag = config.get_tag(at_config.match_tag)
             if at_tag and at_tag._key in tids:
-                session.ui.mark('Retraining: %s' % at_tag.name)
-
+                session.ui.mark('Choosing messages: %s' % at_tag.name)
                 yn = [(set(), set(), 'in:%s' % at_tag.slug, True),
                       (set(), set(), '-in:%s' % at_tag.slug, False)]
 
@@ -259,42 +341,32 @@ class Retrain(AutoTagCommand):
                             tset |= adding
                             mset -= adding
 
-                # Load classifier, reset
-                atagger = config.load_auto_tagger(at_config)
-                atagger.reset(at_config)
-                for tset, mset, srch, which in yn:
-                    count = 0
-                    # We go through the list of message in order, to avoid
-                    # thrashing caches too badly.
-                    for msg_idx in sorted(list(tset)):
-                        try:
-                            e = Email(idx, msg_idx)
-                            count += 1
-                            count_all += 1
-                            session.ui.mark(
-                                _('Reading %s (%d/%d, %s=%s)'
-                                  ) % (e.msg_mid(), count, len(tset),
-                                       at_tag.name, which))
-                            atagger.learn(at_config,
-                                          e.get_msg(),
-                                          self._get_keywords(e),
-                                          which)
-                            play_nice_with_threads()
-                            if mailpile.util.QUITTING:
-                                return self._error('Aborted')
-                        except (IndexError, TypeError, ValueError,
-                                OSError, IOError):
-                            if 'autotag' in session.config.sys.debug:
-                                import traceback
-                                traceback.print_exc()
-                            unreadable.append(msg_idx)
-                            session.ui.warning(
-                                _('Failed to process message at =%s'
-                                  ) % (b36(msg_idx)))
-
-                # We got this far without crashing, so save the result.
-                config.save_auto_tagger(at_config)
-                retrained.append(at_tag.name)
+                training.append((at_config, at_tag, yn))
+
+        # Read the keywords of every message we will be training on, once,
+        # no matter how many autotaggers want them.
+        all_msg_idxs = set()
+        for at_config, at_tag, yn in training:
+            for tset, mset, srch, which in yn:
+                all_msg_idxs |= tset
+        keywords = self._training_keywords(all_msg_idxs, unreadable)
+        if keywords is None:
+            return self._error('Aborted')
+
+        for at_config, at_tag, yn in training:
+            session.ui.mark('Retraining: %s' % at_tag.name)
+            atagger = config.load_auto_tagger(at_config)
+            atagger.reset(at_config)
+            for tset, mset, srch, which in yn:
+                atagger.learn_batch(at_config,
+                                    [keywords[i] for i in sorted(tset)
+                                     if i in keywords],
+                                    which)
+            play_nice_with_threads()
+
+            # We got this far without crashing, so save the result.
+            config.save_auto_tagger(at_config)
+            retrained.append(at_tag.name)
 
         message = _('Retrained SpamBayes auto-tagging for %s'
                     ) % ', '.join(retrained)
@@ -302,9 +374,51 @@ class Retrain(AutoTagCommand):
         return self._success(message, result={
             'retrained': retrained,
             'unreadable': unreadable,
-            'read_messages': count_all
+            'read_messages': len(all_msg_idxs)
         })
 
+    def _training_keywords(self, msg_idxs, unreadable):
+        """
+        Returns a dict of msg_idx -> keywords for the given messages, from
+        the keyword cache where possible. Returns None if interrupted.
+        """
+        session, config, idx = self.session, self.session.config, self._idx()
+        kwc = LoadKeywordCache(config)
+        keywords = {}
+        count = 0
+        # We go through the list of message in order, to avoid
+        # thrashing caches too badly.
+        for msg_idx in sorted(list(msg_idxs)):
+            if mailpile.util.QUITTING:
+                return None
+            try:
+                e = Email(idx, msg_idx)
+                mid = e.msg_mid()
+                msg_id = e.get_msg_info(field=idx.MSG_ID)
+                kws = kwc.get(mid, msg_id)
+                if kws is None:
+                    count += 1
+                    session.ui.mark(_('Reading %s (%d/%d)'
+                                      ) % (mid, count, len(msg_idxs)))
+                    kws = list(self._get_keywords(e))
+                    kwc.put(mid, msg_id, kws)
+                    if (count % 25) == 0:
+                        play_nice_with_threads()
+                keywords[msg_idx] = kws
+            except (IndexError, TypeError, ValueError,
+                    OSError, IOError):
+                if 'autotag' in session.config.sys.debug:
+                    import traceback
+                    traceback.print_exc()
+                unreadable.append(msg_idx)
+                session.ui.warning(
+                    _('Failed to process message at =%s'
+                      ) % (b36(msg_idx)))
+
+        kwc.prune(b36(i) for i in keywords)
+        SaveKeywordCache(config)
+        return keywords
+
     @classmethod
     def interval_retrain(cls, session):
         """
@@ -328,6 +442,11 @@ _plugins.register_slow_periodic_job(
     'prefs.autotag_retrain_interval',
     Retrain.interval_retrain)
 
+_plugins.register_slow_periodic_job(
+    'save_autotag_keywords',
+    KeywordCache.SAVE_INTERVAL,
+    lambda session: SaveKeywordCache(session.config))
+
 
 class Classify(AutoTagCommand):
     SYNOPSIS = (None, 'autotag/classify', None, '<msgs>')
@@ -408,6 +527,11 @@ _plugins.register_commands(Retrain, Classify, AutoTag)
 
 def filter_hook(session, msg_mid, msg, keywords, **kwargs):
     """Classify this message."""
+    # The message is being (re)indexed, so any keywords we cached for
+    # training may be out of date. Load the cache if need be, or they
+    # would linger until we train next.
+    LoadKeywordCache(session.config).discard(msg_mid)
+
     if not kwargs.get('incoming', False):
         return keywords
 
@@ -34,6 +34,9 @@ class SpamBayesTrainer(mailpile.plugins.autotag.Trainer):
     def learn(self, atagger, at_config, msg, keywords, should_tag):
         _classifier(atagger).learn(keywords, should_tag)
 
+    def learn_batch(self, atagger, at_config, keyword_lists, should_tag):
+        _classifier(atagger).learn_batch(keyword_lists, should_tag)
+
     def reset(self, atagger, at_config):
         atagger.spambayes = Classifier()
 
@@ -1,3 +1,4 @@
+import heapq
 import os
 import random
 import time
@@ -13,6 +14,7 @@ from mailpile.commands import Command, Action
 from mailpile.eventlog import Event
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.search import SEARCH_RESULT_CACHE_SERIAL
 from mailpile.mailutils.addresses import AddressHeaderParser
 from mailpile.mailutils.emails import Email, ExtractEmails, ExtractEmailAndName
 from mailpile.security import SecurePassphraseStorage
@@ -725,6 +727,28 @@ class AddressSearch(VCardCommand):
 
         return addresses.values()
 
+    # (index id, serial, invisible tags) -> [(sender, search text), ...]
+    _RECENT_SENDERS = (None, [])
+
+    @classmethod
+    def _recent_senders(cls, index, invisible):
+        # Extracting senders from metadata is CPU intensive, so we reuse the
+        # results until the index changes (which bumps the serial).
+        key = (id(index), SEARCH_RESULT_CACHE_SERIAL[0], len(index.INDEX),
+               frozenset(invisible))
+        if cls._RECENT_SENDERS[0] != key:
+            recent = []
+            for msg_idx in xrange(max(0, len(index.INDEX)-5000),
+                                  len(index.INDEX)):
+                msg_info = index.get_msg_at_idx_pos(msg_idx)
+                tags = set(msg_info[index.MSG_TAGS].split(','))
+                if not (tags & invisible):
+                    frm = msg_info[index.MSG_FROM]
+                    search = (frm + ' ' + msg_info[index.MSG_SUBJECT]).lower()
+                    recent.append((frm, search))
+            cls._RECENT_SENDERS = (key, recent)
+        return cls._RECENT_SENDERS[1]
+
     def _index_addresses(self, cfg, terms, vcard_addresses, count, deadline):
         existing = dict([(k['address'].lower(), k) for k in vcard_addresses])
         index = self._idx()
@@ -736,42 +760,27 @@ class AddressSearch(VCardCommand):
         addresses = []
 
         # 1st, search the social graph for matches, give low priority.
-        for frm in index.EMAILS:
-            frm_lower = frm.lower()
-            match = True
-            for term in terms:
-                if term not in frm_lower:
-                    match = False
-                    break
-            if match:
-                matches[frm] = matches.get(frm, 0) + 3
-                if len(matches) > (count * 10):
-                    break
-            elif len(matches) and time.time() > deadline:
-                break
+        # If there are very many, we rank the most recently seen ones.
+        eids = index.email_token_index().search(terms)
+        for eid in heapq.nlargest(count * 10, eids):
+            frm = index.EMAILS[eid]
+            matches[frm] = matches.get(frm, 0) + 3
 
         # 2nd, go through at most the last 5000 messages in the index and
         # search for matching senders or recipients, give medium priority.
-        # Note: This is more CPU intensive, so we do this last.
         if len(matches) < (count * 5):
-            for msg_idx in xrange(max(0, len(index.INDEX)-5000),
-                                  len(index.INDEX)):
-                msg_info = index.get_msg_at_idx_pos(msg_idx)
-                tags = set(msg_info[index.MSG_TAGS].split(','))
-                match = not (tags & invisible)
+            for frm, search in self._recent_senders(index, invisible):
+                match = True
+                for term in terms:
+                    if term not in search:
+                        match = False
+                        break
                 if match:
-                    frm = msg_info[index.MSG_FROM]
-                    search = (frm + ' ' + msg_info[index.MSG_SUBJECT]).lower()
-                    for term in terms:
-                        if term not in search:
-                            match = False
-                            break
-                    if match:
-                        matches[frm] = matches.get(frm, 0) + 1
-                        if len(matches) > (count * 5):
-                            break
-                    if len(matches) and time.time() > deadline:
+                    matches[frm] = matches.get(frm, 0) + 1
+                    if len(matches) > (count * 5):
                         break
+                if len(matches) and time.time() > deadline:
+                    break
 
         # Assign info & scores!
         for frm in matches:
@@ -1326,7 +1335,11 @@ class EditProfile(AddProfile):
         safe_assert(vcard)
 
         if self.data.get('_method') == 'POST':
-            self._update_vcard_from_post(vcard)
+            config.vcards.deindex_vcard(vcard)
+            try:
+                self._update_vcard_from_post(vcard)
+            finally:
+                config.vcards.index_vcard(vcard)
             self._background_save(config=True)
             vcard.save()
             return self._success(_('Account Updated!'),
@@ -27,6 +27,7 @@ from mailpile.crypto.gpgi import GnuPG
 from mailpile.eventlog import Event
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.lru_cache import CacheStats, FindCaches
 from mailpile.mailboxes import IsMailbox
 from mailpile.mailutils.emails import ClearParseCache, Email
 from mailpile.postinglist import GlobalPostingList
@@ -641,14 +642,32 @@ class ProgramStatus(Command):
             else:
                 locks = _('Nothing Found')
 
+            http_pool = self.result.get('http_pool')
+            if http_pool:
+                fmt = '  %-12s %5s %5s %8s  %s'
+                buckets = ' '.join('<%ss' % b for b in http_pool['buckets'])
+                http_pool = '\n'.join([
+                    '  %d workers, %d idle connections' % (
+                        http_pool['workers'], http_pool['idle']),
+                    fmt % ('PRIORITY', 'BUSY', 'QUEUE', 'REQUESTS',
+                           'WAIT / TIME (%s, more)' % buckets)] + [
+                    fmt % (p, http_pool['busy'][p], http_pool['queued'][p],
+                           st['requests'],
+                           '%s / %s' % (st['wait'], st['time']))
+                    for p, st in sorted(http_pool['priorities'].items())])
+            else:
+                http_pool = '  ' + _('Nothing Found')
+
             return ('Recent events:\n%s\n\n'
                     'Events in progress:\n%s\n\n'
                     'Live sessions:\n%s\n\n'
                     'Postinglist timers:\n%s\n\n'
+                    'HTTP worker pool:\n%s\n\n'
                     'Threads: (bg delay %.3fs, live=%s, httpd=%s)\n%s\n\n'
                     'Locks:\n%s'
                     ) % (cevents, ievents, sessions,
                          self.result['pl_timers'],
+                         http_pool,
                          self.result['delay'],
                          self.result['live'],
                          self.result['httpd'],
@@ -724,6 +743,9 @@ class ProgramStatus(Command):
             'threads': threads,
             'locks': sorted(locks)
         }
+        if config.http_worker and isinstance(config.http_worker.httpd,
+                                             mailpile.httpd.PooledHttpServer):
+            result['http_pool'] = config.http_worker.httpd.stats()
         if config.event_log:
             result.update({
                 'cevents': list(config.event_log.events(flag='c'))[-10:],
@@ -794,6 +816,48 @@ class CronStatus(Command):
                 'jobs': config.cron_worker.schedule.values()})
 
 
+class CacheStatus(Command):
+    """Display cache statistics or change cache budgets"""
+    SYNOPSIS = (None, 'caches', None, "[<cache> <max-entries> [<max-KB>]]")
+    ORDER = ('Internals', 4)
+    IS_USER_ACTIVITY = False
+
+    class CommandResult(Command.CommandResult):
+        def as_text(self):
+            fmt = ' %-12s %8s %8s %10s %10s %9s %9s %9s %6s'
+            lines = [fmt % ('CACHE', 'ENTRIES', 'MAX', 'KB', 'MAX KB',
+                            'HITS', 'MISSES', 'EVICTED', 'HIT%')]
+            for st in self.result or []:
+                lines.append(fmt % (
+                    st['name'],
+                    st['entries'],
+                    '-' if (st['max_entries'] is None) else st['max_entries'],
+                    st['bytes'] // 1024,
+                    ('-' if (st['max_bytes'] is None)
+                     else st['max_bytes'] // 1024),
+                    st['hits'], st['misses'], st['evictions'],
+                    '%.1f' % (100 * st['hit_rate'])))
+            return '\n'.join(lines)
+
+    def command(self, args=None):
+        args = args if (args is not None) else list(self.args)
+        if args:
+            try:
+                name = args.pop(0)
+                max_entries = int(args.pop(0))
+                max_bytes = (int(args.pop(0)) * 1024) if args else None
+            except (IndexError, ValueError):
+                return self._error(_('Invalid arguments'))
+            caches = FindCaches(name)
+            if not caches:
+                return self._error(_('No such cache: %s') % name)
+            for cache in caches:
+                cache.resize(max_entries=max_entries, max_bytes=max_bytes)
+
+        return self._success(_("Displayed cache statistics"),
+                             result=CacheStats())
+
+
 class HealthCheck(Command):
     """Check and report app health"""
     SYNOPSIS = (None, 'health', None, "")
@@ -2141,8 +2205,8 @@ class HelpSplash(Help):
 
 _plugins.register_commands(
     Load, Optimize, Rescan, DeleteMessages,
-    BrowseOrLaunch, RunWWW, ProgramStatus, CronStatus, HealthCheck,
-    GpgCommand, ListDir, ChangeDir, CatFile, WritePID, Cleanup,
+    BrowseOrLaunch, RunWWW, ProgramStatus, CronStatus, CacheStatus,
+    HealthCheck, GpgCommand, ListDir, ChangeDir, CatFile, WritePID, Cleanup,
     ConfigPrint, ConfigSet, ConfigAdd, ConfigUnset, ConfigureMailboxes,
     ListLanguages, RenderPage, Output, Pipe,
     Help, HelpVars, HelpSplash, Quit, IdleQuit, TrustingQQQ, Abort
@@ -36,6 +36,7 @@ class Events(Command):
     }
     LOG_NOTHING = True
     IS_HANGING_ACTIVITY = True
+    IS_POLLING_ACTIVITY = True
     IS_USER_ACTIVITY = False
 
     DEFAULT_WAIT_TIME = 10.0
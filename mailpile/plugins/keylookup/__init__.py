@@ -14,6 +14,8 @@
 #
 import copy
 import math
+import threading
+import time
 import traceback
 import ssl
 import urllib
@@ -48,6 +50,112 @@ def register_crypto_key_lookup_handler(handler):
         key=lambda h: (0 if h.LOCAL else 1, h.PRIORITY, -h.SCORE))
 
 
+class KeyLookupCache(object):
+    """
+    Remembers the results of key lookups, per handler and address.
+
+    Results expire after the handler's CACHE_TTL seconds. Lookups which
+    found nothing (or failed) are remembered for NEGATIVE_TTL seconds, so
+    we don't keep asking servers which have nothing for us. Concurrent
+    lookups of the same address by the same handler are merged: the
+    latecomers wait for the first lookup and share its results.
+    """
+    PICKLE_NAME = 'pickled-keylookup-cache'
+
+    # Lookups running longer than this are assumed to be stuck
+    STUCK_AFTER = 300
+
+    def __init__(self, entries=None):
+        self.lock = threading.Lock()
+        self.entries = entries or {}  # (handler, address, strict) -> entry
+        self.running = {}             # (handler, address, strict) -> event
+        self.changed = False
+        self.hits = self.misses = 0
+
+    def lookup(self, handler, address, timeout, strict_email_match=False):
+        """
+        Run handler.lookup(address) with a timeout, unless we already
+        know (or are already finding out) the answer.
+        """
+        if not handler.CACHE_TTL:
+            return RunTimed(timeout, handler.lookup, address,
+                            strict_email_match=strict_email_match)
+
+        key = (handler.NAME, address.lower(), bool(strict_email_match))
+        with self.lock:
+            now = time.time()
+            expires, results = self.entries.get(key, (0, None))
+            if expires > now:
+                self.hits += 1
+                return copy.deepcopy(results)
+            started, running = self.running.get(key, (0, None))
+            first = (running is None or started < now - self.STUCK_AFTER)
+            if first:
+                self.misses += 1
+                running = threading.Event()
+                self.running[key] = (now, running)
+
+        if first:
+            # Results are recorded by _lookup, even if we time out.
+            return RunTimed(timeout, self._lookup, handler, key, running,
+                            address, strict_email_match)
+
+        running.wait(timeout)
+        with self.lock:
+            expires, results = self.entries.get(key, (0, None))
+            if expires > time.time():
+                self.hits += 1
+                return copy.deepcopy(results)
+        raise TimedOut('Timed out waiting for: %s' % handler.NAME)
+
+    def _lookup(self, handler, key, running, address, strict_email_match):
+        results = {}
+        try:
+            results = handler.lookup(address,
+                                     strict_email_match=strict_email_match)
+            return results
+        finally:
+            ttl = handler.CACHE_TTL if results else handler.NEGATIVE_TTL
+            with self.lock:
+                self.entries[key] = (time.time() + ttl,
+                                     copy.deepcopy(results))
+                self.changed = True
+                if self.running.get(key, (0, None))[1] is running:
+                    del self.running[key]
+            running.set()
+
+    def prune(self):
+        """Forget expired results."""
+        with self.lock:
+            now = time.time()
+            for key, (expires, results) in self.entries.items():
+                if expires <= now:
+                    del self.entries[key]
+                    self.changed = True
+
+
+def SaveKeyLookupCache(config):
+    if config.real_hasattr('keylookup_cache'):
+        klc = config.keylookup_cache
+        if klc.changed:
+            klc.prune()
+            with klc.lock:
+                entries = copy.deepcopy(klc.entries)
+                klc.changed = False
+            config.save_pickle(entries, KeyLookupCache.PICKLE_NAME)
+
+
+def LoadKeyLookupCache(config):
+    if not config.real_hasattr('keylookup_cache'):
+        try:
+            entries = config.load_pickle(KeyLookupCache.PICKLE_NAME,
+                                         delete_if_corrupt=True)
+        except (IOError, EOFError):
+            entries = {}
+        config.real_setattr('keylookup_cache', KeyLookupCache(entries))
+    return config.keylookup_cache
+
+
 def _score_validity(validity, local=False):
     if "r" in validity:
         return (-1000, _('Encryption key is revoked'))
@@ -226,11 +334,17 @@ def lookup_crypto_keys(session, address,
 
             # h.lookup will remove found keys from the wanted list,
             # but we have to watch out for the effects of timeouts.
-            wanted = ungotten[:]
-            results = RunTimed(timeout, h.lookup, address,
-                               strict_email_match=strict_email_match,
-                               get=(wanted if (get is not None) else None))
-            ungotten[:] = wanted
+            # Plain lookups have no side effects, so they are cached.
+            if get is None and config:
+                results = LoadKeyLookupCache(config).lookup(
+                    h, address, timeout,
+                    strict_email_match=strict_email_match)
+            else:
+                wanted = ungotten[:]
+                results = RunTimed(timeout, h.lookup, address,
+                                   strict_email_match=strict_email_match,
+                                   get=(wanted if (get is not None) else None))
+                ungotten[:] = wanted
         except KeyboardInterrupt:
             raise
         except:
@@ -281,6 +395,8 @@ def lookup_crypto_keys(session, address,
     if event and config:
         event.private_data = {"result": ordered_keys, "runningsearch": False}
         config.event_log.log_event(event)
+    if config:
+        SaveKeyLookupCache(config)
     return ordered_keys
 
 
@@ -620,6 +736,8 @@ class LookupHandler:
     PRIVACY_FRIENDLY = False
     LOCAL = False
     SCORE = 0
+    CACHE_TTL = 3600     # Seconds to remember what we found (0 = never)
+    NEGATIVE_TTL = 600   # Seconds to remember failing to find anything
 
     def __init__(self, session, known_keys_list):
         self.session = session
@@ -685,6 +803,7 @@ class KeychainLookupHandler(LookupHandler):
     PRIVACY_FRIENDLY = True
     PRIORITY = 0
     SCORE = 8
+    CACHE_TTL = 0  # Searching known_keys is cheap, and must be up to date
 
     def _score(self, key):
         return (self.SCORE, _('Found encryption key in keychain'))
@@ -730,6 +849,8 @@ class KeyserverLookupHandler(LookupHandler):
     PRIVACY_FRIENDLY = False
     PRIORITY = 200
     SCORE = 1
+    CACHE_TTL = 24 * 3600
+    NEGATIVE_TTL = 3600
 
     # People with really big keys are just going to have to publish in WKD
     # or something, unless or until the SKS keyservers get fixed somehow.
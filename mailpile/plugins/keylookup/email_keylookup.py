@@ -43,6 +43,8 @@ class EmailKeyLookupHandler(LookupHandler, Search):
     LOCAL = True
     PRIVACY_FRIENDLY = True
     SCORE = 1
+    CACHE_TTL = 600    # New mail may bring new keys
+    NEGATIVE_TTL = 120
 
     def __init__(self, session, *args, **kwargs):
         LookupHandler.__init__(self, session, *args, **kwargs)
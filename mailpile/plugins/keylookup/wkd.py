@@ -76,6 +76,8 @@ class WKDLookupHandler(LookupHandler):
     PRIORITY = 50  # WKD is better than keyservers and better than DNS
     PRIVACY_FRIENDLY = True  # These lookups can go over Tor
     SCORE = 5
+    CACHE_TTL = 24 * 3600
+    NEGATIVE_TTL = 3600
 
     # People with really big keys are just going to have to publish in WKD
     # or something, unless or until the SKS keyservers get fixed somehow.
@@ -911,7 +911,11 @@ class Search(Command):
                         session.results.append(emid_idx)
 
             if session.order:
-                idx.sort_results(session, session.results, session.order)
+                # Only the requested page needs to be in order for now,
+                # the rest gets sorted as we page through the results.
+                session.results = idx.sort_page(session, session.results,
+                                                session.order,
+                                                self._start + self._num)
         else:
             idx = self._idx()
 
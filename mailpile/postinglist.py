@@ -8,8 +8,11 @@ import time
 
 import mailpile.util
 from mailpile.crypto.streamer import EncryptingStreamer
+from mailpile.crypto.streamer import PartialDecryptingStreamer
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.intset import IntSet
+from mailpile.index.segments import SegmentStore
 from mailpile.util import *
 
 
@@ -76,7 +79,13 @@ def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
 
 
 class PostingListContainer(object):
-    """A container for posting lists mapping search terms to message IDs."""
+    """
+    A container for posting lists mapping search terms to message IDs.
+
+    In memory the posting lists are IntSets, on disk they are written as
+    delta/varint encoded chunks; lists of base-36 message IDs written by
+    older versions of Mailpile are read as well.
+    """
 
     MAX_ITEMS = int((60 * 1024) / 5)  # Target size of about 60KB
     MAX_HASH_LEN = 24
@@ -101,6 +110,34 @@ class PostingListContainer(object):
         with PLC_CACHE_LOCK:
             return PLC_CACHE[sig][1]
 
+    @classmethod
+    def Estimate(cls, session, sig):
+        """
+        Estimate how many message IDs are on a posting list, without
+        loading its container unless it is cached already.
+
+        Unencrypted containers are scanned for the lines of our term,
+        which are sized without being decoded (see IntSet.Estimate).
+        Encrypted containers cannot be read without decrypting them, so
+        for those we fall back to an upper bound derived from the size of
+        the whole file.
+        """
+        fn, csig = cls._GetFilenameAndSig(session.config, sig)
+        with PLC_CACHE_LOCK:
+            if csig in PLC_CACHE:
+                return len(PLC_CACHE[csig][1].get(sig) or [])
+        try:
+            prefix, count = '%s\t' % sig, 0
+            with open(fn, 'rb') as fd:
+                for line in fd:
+                    if PartialDecryptingStreamer.StartEncrypted(line):
+                        return os.path.getsize(fn) * 3 // 4
+                    if line.startswith(prefix):
+                        count += IntSet.Estimate(line.split()[1:])
+            return count
+        except (IOError, OSError):
+            return 0
+
     def __init__(self, session, sig, fd=None):
         self.session = session
         self.config = session.config
@@ -108,7 +145,7 @@ class PostingListContainer(object):
         self.lock = PListRLock()
         self.sig = sig
         self.fd = fd
-        self.words = {sig: set()}
+        self.words = {sig: IntSet()}
 
         self.changes = 0
         self._load()
@@ -128,7 +165,7 @@ class PostingListContainer(object):
     def purge_deleted(self, deleted_sig, deleted_set):
         changes = 0
         for sig in self.words:
-	    overlap = (self.words[sig] & deleted_set)
+            overlap = (self.words[sig] & deleted_set)
             if (sig != deleted_sig) and overlap:
                 self.words[sig] -= overlap
                 changes += len(overlap)
@@ -150,10 +187,9 @@ class PostingListContainer(object):
         outfile = self._SaveFile(self.config, self.sig)
         with self.lock:
             # Optimizing for fast loads, so deletion only happens on save.
-            output = '\n'.join('\t'.join(l) for l
-                               in ([sig] + [str(v) for v in vals]
-                                   for sig, vals in self.words.iteritems())
-                               if len(l) > 1)
+            output = '\n'.join('%s\t%s' % (sig, vals.encode())
+                               for sig, vals in self.words.iteritems()
+                               if vals)
             t.append(time.time())
 
             if not output:
@@ -246,18 +282,24 @@ class PostingListContainer(object):
         for line in lines:
             words = line.strip().split('\t')
             if len(words) > 1:
-                self._unlocked_add(words[0], words[1:])
+                self._unlocked_add(words[0], IntSet.Parse(words[1:]))
+
+    @classmethod
+    def _IntSet(cls, values):
+        if isinstance(values, IntSet):
+            return values
+        return IntSet.FromB36(values)
 
     def _unlocked_add(self, sig, values):
-        wset = set(values)
+        wset = self._IntSet(values)
         self.changes += len(wset)
         if sig in self.words:
             self.words[sig] |= wset
         else:
-            self.words[sig] = wset
+            self.words[sig] = IntSet(wset)
 
     def _unlocked_remove(self, sig, values):
-        wset = set(values)
+        wset = self._IntSet(values)
         self.changes += len(wset)
         if sig in self.words:
             self.words[sig] -= wset
@@ -313,7 +355,12 @@ class PostingList(object):
             self.plc = PostingListContainer.Load(self.session, self.sig)
 
     def hits(self):
-        return self.plc.get(self.sig) or set()
+        return self.plc.get(self.sig) or IntSet()
+
+    @classmethod
+    def Estimate(cls, session, word):
+        sig = cls._WordSig(word, session.config)
+        return PostingListContainer.Estimate(session, sig)
 
     def append(self, *eids):
         self.plc.add(self.sig, eids)
@@ -552,7 +599,12 @@ class GlobalPostingList(OldPostingList):
         starttime = time.time()
         count = 0
         global GLOBAL_GPL
-        if (GLOBAL_GPL and (not lazy or len(GLOBAL_GPL) > 50*1024)):
+        if cls.UseSegments(session.config):
+            if (GLOBAL_GPL and (not lazy or len(GLOBAL_GPL) > 50*1024)):
+                count = cls._FlushSegment(session, deleted_sig, deleted_set)
+            cls._ScheduleMerge(session, runtime=runtime)
+
+        elif (GLOBAL_GPL and (not lazy or len(GLOBAL_GPL) > 50*1024)):
             pls = GlobalPostingList(session, '')
 
             # Why sort? Processing keys in order is more efficient, as it lets
@@ -592,6 +644,51 @@ class GlobalPostingList(OldPostingList):
 
         return count
 
+    @classmethod
+    def UseSegments(cls, config):
+        """Segments are not encrypted, so never use them if we should."""
+        return (config.sys.index_segments and
+                not (config.prefs.encrypt_index and config.get_master_key()))
+
+    @classmethod
+    def _FlushSegment(cls, session, deleted_sig, deleted_set):
+        pls = GlobalPostingList(session, '')
+        with GLOBAL_GPL_LOCK:
+            words = dict((sig, IntSet.FromB36(ids))
+                         for sig, ids in GLOBAL_GPL.iteritems()
+                         if ids and sig not in GPL_NEVER_MIGRATE)
+        if words or deleted_set:
+            session.ui.mark(_('Writing %d search terms to a new segment'
+                              ) % len(words))
+            store = SegmentStore.ForConfig(session.config, create=True)
+            store.flush(words,
+                        tombstones=IntSet.FromB36(deleted_set),
+                        exempt=[deleted_sig])
+
+            # Only forget what we wrote, more may have arrived meanwhile.
+            with GLOBAL_GPL_LOCK:
+                for sig, ids in words.iteritems():
+                    remaining = set(GLOBAL_GPL.get(sig, [])) - set(ids.b36())
+                    if remaining:
+                        GLOBAL_GPL[sig] = remaining
+                    elif sig in GLOBAL_GPL:
+                        del GLOBAL_GPL[sig]
+                pls.save()
+        return len(words)
+
+    @classmethod
+    def _ScheduleMerge(cls, session, runtime=0):
+        store = SegmentStore.ForConfig(session.config)
+        if store is None:
+            return
+        slow_worker = getattr(session.config, 'slow_worker', None)
+        if slow_worker:
+            slow_worker.add_unique_task(
+                session, 'Merge search segments',
+                lambda: store.merge(runtime=runtime))
+        else:
+            store.merge(runtime=runtime)
+
     @classmethod
     def SaveFile(cls, session, prefix):
         return os.path.join(session.config.workdir, 'kw-journal.dat')
@@ -705,8 +802,21 @@ class GlobalPostingList(OldPostingList):
         return OldPostingList.remove(self, eids)
 
     def hits(self):
-        return (self.WORDS.get(self.sig, set())
+        hits = (IntSet.FromB36(self.WORDS.get(self.sig, []))
                 | PostingList(self.session, self.word).hits())
+        store = SegmentStore.ForConfig(self.config)
+        if store is not None:
+            hits |= store.hits(self.sig)
+        return hits
+
+    def estimate(self):
+        """Estimate our number of hits, see PostingList.Estimate."""
+        count = (len(self.WORDS.get(self.sig, [])) +
+                 PostingList.Estimate(self.session, self.word))
+        store = SegmentStore.ForConfig(self.config)
+        if store is not None:
+            count += store.estimate(self.sig)
+        return count
 
     def plc_keys(self):
         keys = []
@@ -1,23 +1,35 @@
 from __future__ import print_function
+import array
 import cStringIO
 import email
+import email.parser
+import mmap
+import operator
 import random
 import re
 import rfc822
 import time
 import threading
 import traceback
+from itertools import izip
 from urllib import quote, unquote
 
 import mailpile.util
+from mailpile.crypto.batch import CryptoBatch, LooksSigned
 from mailpile.crypto.gpgi import GnuPG
 from mailpile.crypto.state import CryptoInfo, SignatureInfo, EncryptionInfo
 from mailpile.crypto.streamer import EncryptingStreamer
+from mailpile.crypto.streamer import PartialDecryptingStreamer
 from mailpile.eventlog import GetThreadEvent
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.index.base import BaseIndex
+from mailpile.index.columnar import ColumnarIndexReader, ColumnarRows
+from mailpile.index.columnar import WriteColumnarIndex
+from mailpile.index.mapped import MapFile, MappedRows, CompactHashMap
 from mailpile.index.search import SearchResultSet, CachedSearchResultSet
+from mailpile.index.search import SearchPlan, PartiallySortedResults
+from mailpile.index.parallel import ParallelMessageReader
 from mailpile.plugins import PluginManager
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils.addresses import AddressHeaderParser
@@ -65,6 +77,8 @@ class MailIndex(BaseIndex):
         self.TAGS = {}
         self.MSGIDS = {}
         self.MODIFIED = set()
+        self.STALE_TAG_ROWS = set()
+        self.STALE_TAG_IDS = set()
         self.EMAILS_SAVED = 0
         self._scanned = {}
         self._saved_changes = 0
@@ -98,7 +112,7 @@ class MailIndex(BaseIndex):
 
     def load(self, session=None):
         self.INDEX = []
-        self.CACHE = {}
+        self.CACHE.clear()
         self.PTRS = {}
         self.MSGIDS = {}
         self.EMAILS = []
@@ -172,6 +186,10 @@ class MailIndex(BaseIndex):
             import mailpile.mail_source
             with self._save_lock, self._lock:
                 with open(self.config.mailindex_file(), 'r') as fd:
+                    # If we have an up-to-date columnar snapshot, start with
+                    # that and only parse whatever was appended since.
+                    from_snapshot = self._load_columnar(session, fd)
+
                     # We don't raise on errors, in case only some of the chunks
                     # are corrupt - we want to read the rest of them.
                     errors = 0
@@ -181,10 +199,16 @@ class MailIndex(BaseIndex):
                                              'block of index ending at %d'
                                              % offset)
                     # FIXME: Differentiate between partial index and no index?
-                    gpgi = GnuPG(self.config, event=GetThreadEvent())
-                    decrypt_and_parse_lines(fd, process_lines, self.config,
-                        newlines=True, decode=False, gpgi=gpgi,
-                        _raise=False, error_cb=warn)
+                    if from_snapshot or not self._load_mapped(session,
+                                                              process_lines):
+                        gpgi = GnuPG(self.config, event=GetThreadEvent())
+                        decrypt_and_parse_lines(fd, process_lines, self.config,
+                            newlines=True, decode=False, gpgi=gpgi,
+                            _raise=False, error_cb=warn)
+
+                    # Migration: create the snapshot if we don't have one.
+                    if not (from_snapshot or bogus_lines):
+                        self._save_columnar(session, os.fstat(fd.fileno()))
         except IOError:
             if session:
                 session.ui.warning(_('Metadata index not found: %s'
@@ -223,15 +247,216 @@ class MailIndex(BaseIndex):
 
         self.loaded_index = True
 
+    def columnar_index_file(self):
+        return self.config.mailindex_file() + '.col'
+
+    def _index_in_the_clear(self):
+        # Is the metadata index stored unencrypted? (see _maybe_encrypt)
+        gpgr = self.config.prefs.gpg_recipient
+        return (not self.config.get_master_key() and
+                gpgr in (None, '', '!CREATE', '!PASSWORD'))
+
+    def _columnar_allowed(self):
+        # Snapshots are stored in the clear, so we only keep them if the
+        # metadata index itself is not encrypted.
+        return self.config.sys.index_columnar and self._index_in_the_clear()
+
+    def _mapped_allowed(self):
+        return self.config.sys.index_mapped and self._index_in_the_clear()
+
+    def _row_keys(self, field, split=False):
+        # Regenerate the keys of a CompactHashMap from the index rows.
+        for pos in xrange(0, len(self.INDEX)):
+            line = self.INDEX[pos]
+            if line:
+                value = line.split('\t', field + 1)[field].decode('utf-8')
+                for key in (value.split(',') if split else [value]):
+                    if key:
+                        yield key, pos
+
+    def _reset_ptrs_and_msgids(self):
+        if isinstance(self.INDEX, MappedRows):
+            self.PTRS = CompactHashMap(
+                key_source=lambda: self._row_keys(self.MSG_PTRS, split=True))
+            self.MSGIDS = CompactHashMap(
+                key_source=lambda: self._row_keys(self.MSG_ID))
+        else:
+            self.PTRS = {}
+            self.MSGIDS = {}
+
+    def _mappable_lines(self, mapped):
+        # Iterate through (offset, line) pairs in a mapped index file.
+        pos, end = 0, len(mapped)
+        while pos < end:
+            eol = mapped.find('\n', pos)
+            if eol < 0:
+                eol = end
+            yield pos, mapped[pos:eol]
+            pos = eol + 1
+
+    def _load_mapped(self, session, process_lines):
+        """
+        Load the metadata index as MappedRows, keeping only file offsets
+        for each row instead of the lines themselves.
+
+        This only works for unencrypted indexes in the current format,
+        anything else returns False so the caller can fall back to the
+        normal loader.
+        """
+        if not self._mapped_allowed():
+            return False
+        try:
+            mapped = MapFile(self.config.mailindex_file())
+        except (IOError, OSError, ValueError, mmap.error):
+            return False
+        if mapped is None:
+            return False
+
+        # Make sure we will not have to bail out half-way.
+        fields = self.MSG_FIELDS_V2 - 1
+        for offset, line in self._mappable_lines(mapped):
+            if PartialDecryptingStreamer.StartEncrypted(line):
+                return False
+            if line[:1] not in ('#', '@', '', '\r'):
+                try:
+                    int(line[:line.index('\t')], 36)
+                except ValueError:
+                    return False
+                if line.count('\t') != fields:
+                    return False
+
+        if session:
+            session.ui.mark(_('Mapping metadata index...'))
+        self.INDEX = MappedRows(mapped, array.array('l'))
+        self._reset_ptrs_and_msgids()
+        for offset, line in self._mappable_lines(mapped):
+            if line[:1] in ('#', '@', '', '\r'):
+                process_lines([line])
+            else:
+                words = line.rstrip('\r').split('\t')
+                pos = int(words[self.MSG_MID], 36)
+                self.set_msg_at_idx_pos(pos, words,
+                                        original_line=line.rstrip('\r'))
+                self.INDEX.set_offset(pos, offset)
+                self._saved_lines += 1
+        self.PTRS.compact()
+        self.MSGIDS.compact()
+        return True
+
+    def _remap_rows(self, idxfile, first_offset, lines):
+        # After writing out a new index, point our rows at it, so lines
+        # which changed since we mapped the old one can be released.
+        try:
+            mapped = MapFile(idxfile)
+        except (IOError, OSError, ValueError, mmap.error):
+            return
+        offsets = array.array('l', [-1]) * len(self.INDEX)
+        offset = first_offset
+        for pos, line in enumerate(lines):
+            offsets[pos] = offset
+            offset += len(line) + 1
+        with self._lock:
+            rows = MappedRows(mapped, offsets)
+            for pos in xrange(0, len(self.INDEX)):
+                line = self.INDEX[pos]
+                if pos >= len(lines) or lines[pos] != line:
+                    rows[pos] = line
+            self.INDEX = rows
+
+    def _load_columnar(self, session, fd):
+        if not self._columnar_allowed():
+            return False
+        try:
+            reader = ColumnarIndexReader(self.columnar_index_file())
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        st = os.fstat(fd.fileno())
+        if reader.src_ino != st.st_ino or reader.src_size > st.st_size:
+            reader.close()
+            return False
+
+        if session:
+            session.ui.mark(_('Loading metadata index snapshot...'))
+        self.INDEX = ColumnarRows(reader)
+        self.INDEX_THR = list(reader.column('thread'))
+
+        self.TAGS = dict((tid, set(members))
+                         for tid, members in reader.tag_members())
+        self._sort_unread = None
+        fresh = set()
+        for tid in self._sort_freshness_tags:
+            fresh |= self.TAGS.get(tid, set())
+        dates = reader.column('date')
+        for order, sorter in self.SORT_ORDERS.iteritems():
+            if order == 'date':
+                self.INDEX_SORT[order] = dates
+            elif order == 'freshness':
+                self.INDEX_SORT[order] = array.array('l', dates)
+                for i in fresh:
+                    self.INDEX_SORT[order][i] += self.FRESHNESS_SORT_BOOST
+            else:
+                self.INDEX_SORT[order] = array.array('l', (
+                    sorter(self, self.INDEX.msg_info(i) or self.BOGUS_METADATA)
+                    for i in xrange(0, len(reader))))
+        for order in self.SORT_STRINGS:
+            ids = self._sort_string_ids[order] = array.array('l')
+            ids.extend(self._intern_sort_string(order, raw)
+                       for raw in reader.strings(order))
+            self._sort_stale.add(order)
+
+        for pos, msg_id in enumerate(reader.strings('id')):
+            if reader.present(pos):
+                self.MSGIDS[msg_id.decode('utf-8')] = pos
+        for pos, msg_ptrs in enumerate(reader.strings('ptrs')):
+            for msg_ptr in msg_ptrs.decode('utf-8').split(','):
+                if msg_ptr:
+                    self.PTRS[msg_ptr] = pos
+
+        self.EMAILS = reader.emails()
+        for pos, email in enumerate(self.EMAILS):
+            if email:
+                self.EMAIL_IDS[email.split()[0].lower()] = pos
+
+        self._saved_changes = 0
+        self._saved_lines = len(self.INDEX) + len(self.EMAILS)
+        fd.seek(reader.src_size)
+        return True
+
+    def _save_columnar(self, session, idx_stat):
+        if not self._columnar_allowed():
+            return
+        try:
+            if session:
+                session.ui.mark(_('Saving metadata index snapshot...'))
+            with self._lock:
+                WriteColumnarIndex(self.columnar_index_file(),
+                                   self.INDEX, self.EMAILS, self.TAGS,
+                                   src_ino=idx_stat.st_ino,
+                                   src_size=idx_stat.st_size)
+        except (IOError, OSError):
+            if session:
+                session.ui.warning(_('Failed to save metadata snapshot'))
+            if self.config.sys.debug:
+                traceback.print_exc()
+
     def update_msg_tags(self, msg_idx_pos, msg_info):
+        """Update self.TAGS, returning the IDs of any tags that changed."""
         tags = set(self.get_tags(msg_info=msg_info))
+        changed = set()
         with self._lock:
             for tid in (set(self.TAGS.keys()) - tags):
-                self.TAGS[tid] -= set([msg_idx_pos])
+                if msg_idx_pos in self.TAGS[tid]:
+                    self.TAGS[tid].discard(msg_idx_pos)
+                    changed.add(tid)
             for tid in tags:
                 if tid not in self.TAGS:
                     self.TAGS[tid] = set()
-                self.TAGS[tid].add(msg_idx_pos)
+                if msg_idx_pos not in self.TAGS[tid]:
+                    self.TAGS[tid].add(msg_idx_pos)
+                    changed.add(tid)
+            self._drop_unread_cache(changed)
+        return changed
 
     def _maybe_encrypt(self, data):
         gpgr = self.config.prefs.gpg_recipient
@@ -259,6 +484,7 @@ class MailIndex(BaseIndex):
         try:
             # In a locked section, check what needs to be done!
             with self._lock:
+                self.update_stale_tag_rows()
                 mods, self.MODIFIED = self.MODIFIED, set()
                 old_emails_saved, total = self.EMAILS_SAVED, len(self.EMAILS)
                 index_items = total + len(self.INDEX)
@@ -316,6 +542,7 @@ class MailIndex(BaseIndex):
         try:
             self._save_lock.acquire()
             with self._lock:
+                self.update_stale_tag_rows()
                 old_mods, self.MODIFIED = self.MODIFIED, set()
                 old_emails_saved = self.EMAILS_SAVED
 
@@ -334,8 +561,9 @@ class MailIndex(BaseIndex):
                 quoted_email = quote(self.EMAILS[eid].encode('utf-8'))
                 data.append('@%s\t%s\n' % (b36(eid), quoted_email))
             index_counter = len(self.INDEX)
-            for i in range(0, index_counter):
-                data.append(self.INDEX[i] + '\n')
+            first_offset = sum(len(d) for d in data)
+            lines = [self.INDEX[i] for i in range(0, index_counter)]
+            data.extend(line + '\n' for line in lines)
 
             data = self._maybe_encrypt(''.join(data))
             with open(newfile, 'w') as fd:
@@ -344,6 +572,10 @@ class MailIndex(BaseIndex):
             # Keep the last 5 index files around... just in case.
             backup_file(idxfile, backups=5, min_age_delta=10)
             os.rename(newfile, idxfile)
+            if (isinstance(self.INDEX, MappedRows) and
+                    self._index_in_the_clear()):
+                self._remap_rows(idxfile, first_offset, lines)
+            self._save_columnar(session, os.stat(idxfile))
 
             self._saved_changes = 0
             self._saved_lines = email_counter + index_counter
@@ -361,8 +593,7 @@ class MailIndex(BaseIndex):
     def update_ptrs_and_msgids(self, session):
         session.ui.mark(_('Updating high level indexes'))
         with self._lock:
-            self.PTRS = {}
-            self.MSGIDS = {}
+            self._reset_ptrs_and_msgids()
             for offset in range(0, len(self.INDEX)):
                 message = self.l2m(self.INDEX[offset])
                 if len(message) == self.MSG_FIELDS_V2:
@@ -470,7 +701,7 @@ class MailIndex(BaseIndex):
                                 ) % (mailbox_idx, mailbox_fn, e),
                           error=True)
 
-        if len(self.PTRS.keys()) == 0:
+        if len(self.PTRS) == 0:
             self.update_ptrs_and_msgids(session)
 
         messages = sorted(mbox.keys())
@@ -499,54 +730,105 @@ class MailIndex(BaseIndex):
         not_done_yet = 'NOT DONE YET'
         if reverse:
             messages.reverse()
-        for ui in range(0, len(messages)):
-            if mailpile.util.QUITTING or self.interrupt:
-                ir, self.interrupt = self.interrupt, None
-                return finito(-1, _('Rescan interrupted: %s') % ir)
-            if stop_after and added >= stop_after:
-                messages_md5 = not_done_yet
-                break
-            elif deadline and time.time() > deadline:
-                messages_md5 = not_done_yet
-                break
-            elif mbox_version != mbox.last_updated():
-                messages_md5 = not_done_yet
-                break
 
-            i = messages[ui]
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+        def needs_scan(msg_ptr):
             if msg_ptr in self.PTRS:
-                if not lazy:
-                    msg_info = self.get_msg_at_idx_pos(self.PTRS[msg_ptr])
-                    msg_body = msg_info[self.MSG_BODY]
-                if lazy or (msg_body not in self.MSG_BODY_UNSCANNED):
+                if lazy:
+                    return False
+                msg_info = self.get_msg_at_idx_pos(self.PTRS[msg_ptr])
+                return (msg_info[self.MSG_BODY] in self.MSG_BODY_UNSCANNED)
+            return True
+
+        reader = None
+        parallel = (not lazy and session.config.sys.scan_processes > 0 and
+                    ParallelMessageReader.Available())
+        prefetched = {}
+
+        # Worker processes check signatures in parallel anyway; otherwise
+        # we check the signatures of upcoming messages in batches.
+        crypto_batch = None
+        if (not lazy and not parallel and
+                session.config.prefs.index_encrypted and
+                session.config.sys.scan_crypto_threads > 0):
+            crypto_batch = CryptoBatch(
+                lambda: GnuPG(session.config, event=event),
+                session.config.sys.scan_crypto_threads)
+        verified = {}
+        try:
+            for ui in range(0, len(messages)):
+                if mailpile.util.QUITTING or self.interrupt:
+                    ir, self.interrupt = self.interrupt, None
+                    return finito(-1, _('Rescan interrupted: %s') % ir)
+                if stop_after and added >= stop_after:
+                    messages_md5 = not_done_yet
+                    break
+                elif deadline and time.time() > deadline:
+                    messages_md5 = not_done_yet
+                    break
+                elif mbox_version != mbox.last_updated():
+                    messages_md5 = not_done_yet
+                    break
+
+                i = messages[ui]
+                msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+                if not needs_scan(msg_ptr):
                     if (ui % 1129) == 0:
                         session.ui.mark(parse_status(ui))
                     continue
 
-            session.ui.mark(parse_status(ui))
-            if (ui % 127) == 0 and not force:
-                play_nice_with_threads()
-
-            # Message new or modified, let's parse it.
-            try:
-                last_date, a, u = self.scan_one_message(session,
-                                                        mailbox_idx, mbox, i,
-                                                        wait=True,
-                                                        msg_ptr=msg_ptr,
-                                                        last_date=last_date,
-                                                        process_new=process_new,
-                                                        apply_tags=apply_tags,
-                                                        stop_after=stop_after,
-                                                        editable=editable,
-                                                        event=event,
-                                                        progress=progress,
-                                                        lazy=lazy)
-            except TypeError:
-                a = u = 0
-
-            added += a
-            updated += u
+                session.ui.mark(parse_status(ui))
+                if (ui % 127) == 0 and not force:
+                    play_nice_with_threads()
+
+                # Hand the next batch of messages to our worker processes
+                if parallel and i not in prefetched:
+                    if reader is None:
+                        reader = ParallelMessageReader(
+                            session, self, session.config.sys.scan_processes)
+                    batch = reader.batch_size()
+                    if stop_after:
+                        batch = min(batch, stop_after - added)
+                    prefetched = self._parallel_read_ahead(
+                        reader, mbox, mailbox_idx, messages[ui:], batch,
+                        needs_scan)
+                    if reader.stalled:
+                        parallel = False
+
+                # Check the signatures of the next batch of messages
+                if crypto_batch is not None and i not in verified:
+                    batch = crypto_batch.batch_size()
+                    if stop_after:
+                        batch = min(batch, stop_after - added)
+                    verified = self._verify_ahead(
+                        crypto_batch, mbox, mailbox_idx, messages[ui:], batch,
+                        needs_scan)
+
+                # Message new or modified, let's parse it.
+                try:
+                    last_date, a, u = self.scan_one_message(
+                        session, mailbox_idx, mbox, i,
+                        wait=True,
+                        msg_ptr=msg_ptr,
+                        msg_parsed=prefetched.pop(i, None),
+                        msg_prefetched=verified.get(i),
+                        last_date=last_date,
+                        process_new=process_new,
+                        apply_tags=apply_tags,
+                        stop_after=stop_after,
+                        editable=editable,
+                        event=event,
+                        progress=progress,
+                        lazy=lazy)
+                except TypeError:
+                    a = u = 0
+
+                added += a
+                updated += u
+        finally:
+            if reader is not None:
+                reader.close()
+            if crypto_batch is not None:
+                crypto_batch.close()
 
         if not lazy:
             # Figure out which messages exist at all, and remove stale pointers.
@@ -579,6 +861,47 @@ class MailIndex(BaseIndex):
                       updated=updated,
                       complete=(messages_md5 != not_done_yet))
 
+    def _parallel_read_ahead(self, reader, mbox, mailbox_idx, messages,
+                             count, needs_scan):
+        jobs = []
+        for msg_key in messages:
+            if len(jobs) >= count:
+                break
+            if needs_scan(mbox.get_msg_ptr(mailbox_idx, msg_key)):
+                try:
+                    jobs.append((msg_key, mbox.get_file(msg_key).read()))
+                except (IOError, OSError, ValueError, IndexError, KeyError):
+                    # Errors get reported when we retry in _real_scan_one
+                    pass
+        return reader.read(jobs)
+
+    def _verify_ahead(self, crypto_batch, mbox, mailbox_idx, messages,
+                      count, needs_scan):
+        """
+        Read the next batch of messages and check their signatures,
+        returning a dict of message keys to (data, parsed message or None)
+        for _real_scan_one, so nothing has to be read or parsed twice.
+        """
+        read_ahead, signed = {}, []
+        for msg_key in messages:
+            if len(read_ahead) >= count:
+                break
+            if needs_scan(mbox.get_msg_ptr(mailbox_idx, msg_key)):
+                read_ahead[msg_key] = None
+                try:
+                    data = mbox.get_file(msg_key).read()
+                    if LooksSigned(data):
+                        msg = email.parser.Parser().parsestr(data)
+                        signed.append(msg)
+                    else:
+                        msg = None
+                    read_ahead[msg_key] = (data, msg)
+                except (IOError, OSError, ValueError, IndexError, KeyError):
+                    # Errors get reported when we retry in _real_scan_one
+                    pass
+        crypto_batch.verify(signed)
+        return read_ahead
+
     def scan_one_message(self, session, mailbox_idx, mbox, msg_mbox_key,
                          wait=False, **kwargs):
         args = [session, mailbox_idx, mbox, msg_mbox_key]
@@ -594,7 +917,7 @@ class MailIndex(BaseIndex):
     def _real_scan_one(self, session,
                        mailbox_idx, mbox, msg_mbox_idx,
                        msg_ptr=None, msg_data=None, msg_metadata_kws=None,
-                       last_date=None,
+                       msg_parsed=None, msg_prefetched=None, last_date=None,
                        process_new=None, apply_tags=None, stop_after=None,
                        editable=False, event=None, progress=None,
                        lazy=False):
@@ -611,8 +934,20 @@ class MailIndex(BaseIndex):
         if 'rescan' in session.config.sys.debug:
             session.ui.debug('Reading message %s/%s'
                              % (mailbox_idx, msg_mbox_idx))
+        msg_parts = None
         try:
-            if msg_data:
+            if msg_parsed:
+                # Parsed by a ParallelMessageReader, all we need are the
+                # mailbox metadata.
+                msg, msg_bytes, msg_parts = msg_parsed
+                msg_metadata_kws = mbox.get_metadata_keywords(msg_mbox_idx)
+            elif msg_prefetched:
+                # Read (and if signed, parsed) by _verify_ahead
+                msg_data, msg_fd = msg_prefetched
+                msg_fd = msg_fd or cStringIO.StringIO(msg_data)
+                msg_bytes = len(msg_data)
+                msg_metadata_kws = mbox.get_metadata_keywords(msg_mbox_idx)
+            elif msg_data:
                 msg_fd = cStringIO.StringIO(msg_data)
                 msg_metadata_kws = msg_metadata_kws or []
             elif lazy:
@@ -625,11 +960,12 @@ class MailIndex(BaseIndex):
                 msg_fd = mbox.get_file(msg_mbox_idx)
                 msg_metadata_kws = mbox.get_metadata_keywords(msg_mbox_idx)
 
-            msg = ParseMessage(msg_fd,
-                pgpmime=(session.config.prefs.index_encrypted and 'all'),
-                config=session.config)
-            if not lazy:
-                msg_bytes = msg_fd.tell()
+            if not msg_parsed:
+                msg = ParseMessage(msg_fd,
+                    pgpmime=(session.config.prefs.index_encrypted and 'all'),
+                    config=session.config)
+                if not (lazy or msg_prefetched):
+                    msg_bytes = msg_fd.tell()
 
         except (IOError, OSError, ValueError, IndexError, KeyError):
             if session.config.sys.debug:
@@ -656,7 +992,7 @@ class MailIndex(BaseIndex):
                 session, msg_id, msg_ptr, msg_bytes,
                 msg, msg_metadata_kws,
                 last_date + 1, mailbox_idx, process_new, apply_tags,
-                lazy_body, msg_info)
+                lazy_body, msg_info, msg_parts=msg_parts)
             last_date = long(msg_info[self.MSG_DATE], 36)
             added += 1
 
@@ -752,7 +1088,7 @@ class MailIndex(BaseIndex):
                                 msg_id, msg_ptr, msg_size,
                                 msg, msg_metadata_kws, default_date,
                                 mailbox_idx, process_new, apply_tags,
-                                lazy_body, msg_info):
+                                lazy_body, msg_info, msg_parts=None):
         if lazy_body:
             msg_ts = self._extract_date_ts(session, 'new', msg_id, msg,
                                            default_date)
@@ -783,7 +1119,8 @@ class MailIndex(BaseIndex):
                                               default_date,
                                               process_new=process_new,
                                               apply_tags=apply_tags,
-                                              incoming=True)
+                                              incoming=True,
+                                              msg_parts=msg_parts)
 
             # Finally, update the metadata index with whatever we learned
             self.edit_msg_info(msg_info,
@@ -1231,9 +1568,13 @@ class MailIndex(BaseIndex):
                 words.extend(re.findall(WORD_REGEXP, word))
         return set(words)
 
-    def read_message(self, session,
-                     msg_mid, msg_id, msg, msg_size, msg_ts,
-                     mailbox=None):
+    def read_message_parts(self, session, msg_mid, msg_id, msg):
+        """
+        Walk the MIME parts of a message, extracting keywords and snippets
+        from the text and attachments. This is the expensive part of
+        read_message and only depends on the message itself (and plugins),
+        so it can be done in a separate process; see mailpile.index.parallel.
+        """
         keywords = []
         snippet_text = snippet_html = ''
         body_info = {}
@@ -1352,6 +1693,16 @@ class MailIndex(BaseIndex):
             if not ctype.startswith('multipart/'):
                 parts.append(pinfo)
 
+        return (keywords, body_info, parts, urls, textparts,
+                snippet_text, snippet_html)
+
+    def read_message(self, session,
+                     msg_mid, msg_id, msg, msg_size, msg_ts,
+                     mailbox=None, msg_parts=None):
+        (keywords, body_info, parts, urls, textparts,
+         snippet_text, snippet_html
+         ) = msg_parts or self.read_message_parts(session,
+                                                  msg_mid, msg_id, msg)
         if urls:
             att_urls = []
             for (full_url, txt) in set(urls):
@@ -1521,11 +1872,13 @@ class MailIndex(BaseIndex):
     def index_message(self, session, msg_mid, msg_id,
                       msg, msg_metadata_kws, msg_size, msg_ts,
                       mailbox=None, compact=True, filter_hooks=None,
-                      process_new=None, apply_tags=None, incoming=False):
+                      process_new=None, apply_tags=None, incoming=False,
+                      msg_parts=None):
         keywords, snippet = self.read_message(session,
                                               msg_mid, msg_id, msg,
                                               msg_size, msg_ts,
-                                              mailbox=mailbox)
+                                              mailbox=mailbox,
+                                              msg_parts=msg_parts)
 
         # Apply the defaults for this mail source / mailbox.
         if apply_tags:
@@ -1567,10 +1920,18 @@ class MailIndex(BaseIndex):
                 pass
 
         self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
+        CachedSearchResultSet.DropCaches(msg_idxs=[int(msg_mid, 36)],
+                                         terms=keywords)
         return keywords, snippet
 
     def get_msg_at_idx_pos_uncached(self, msg_idx):
-        rv = self.l2m(self.INDEX[msg_idx])
+        if msg_idx in self.STALE_TAG_ROWS:
+            return self._update_stale_tag_row(msg_idx)
+        rv = None
+        if isinstance(self.INDEX, ColumnarRows):
+            rv = self.INDEX.msg_info(msg_idx)
+        if rv is None:
+            rv = self.l2m(self.INDEX[msg_idx])
         if len(rv) != self.MSG_FIELDS_V2:
             raise ValueError()
         return rv
@@ -1616,27 +1977,39 @@ class MailIndex(BaseIndex):
 
         # Record that these messages were deleted
         GlobalPostingList.Append(session, 'deleted:is', [b36(msg_idx)])
+        CachedSearchResultSet.DropCaches(msg_idxs=[msg_idx],
+                                         terms=['deleted:is'])
 
     def update_msg_sorting(self, msg_idx, msg_info):
         for order, sorter in self.SORT_ORDERS.iteritems():
             self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
+        for order in self.SORT_STRINGS:
+            field = self.SORT_STRING_FIELDS[order]
+            sid = self._intern_sort_string(order, msg_info[field])
+            self._sort_string_ids[order][msg_idx] = sid
+            if order not in self._sort_stale:
+                self.INDEX_SORT[order][msg_idx] = self._sort_ranks[order][sid]
 
     def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
         with self._lock:
+            is_new = (len(self.INDEX) <= msg_idx)
             while len(self.INDEX) <= msg_idx:
                 self.INDEX.append('')
                 self.INDEX_THR.append(-1)
                 for order in self.INDEX_SORT:
                     self.INDEX_SORT[order].append(0)
+                for order in self._sort_string_ids:
+                    self._sort_string_ids[order].append(0)
 
         msg_thr_mid = msg_info[self.MSG_THREAD_MID].split('/')[0]
         self.INDEX[msg_idx] = original_line or self.m2l(msg_info)
+        self.STALE_TAG_ROWS.discard(msg_idx)
         self.INDEX_THR[msg_idx] = int(msg_thr_mid, 36)
         self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
         for msg_ptr in msg_info[self.MSG_PTRS].split(','):
             self.PTRS[msg_ptr] = msg_idx
         self.update_msg_sorting(msg_idx, msg_info)
-        self.update_msg_tags(msg_idx, msg_info)
+        changed_tags = self.update_msg_tags(msg_idx, msg_info)
 
         if not original_line:
             dirty_tags = [u'%s:in' % self.config.tags[t].slug for t in
@@ -1644,7 +2017,9 @@ class MailIndex(BaseIndex):
             self.config.command_cache.mark_dirty(
                 [u'mail:all', u'%s:msg' % msg_idx,
                  u'%s:thread' % int(msg_thr_mid, 36)] + dirty_tags)
-            CachedSearchResultSet.DropCaches(msg_idxs=[msg_idx])
+            CachedSearchResultSet.DropCaches(
+                msg_idxs=[msg_idx], tags=changed_tags,
+                terms=(['all:mail'] if is_new else []))
             self.MODIFIED.add(msg_idx)
             try:
                 del self.CACHE[msg_idx]
@@ -1690,6 +2065,139 @@ class MailIndex(BaseIndex):
             return taglist
         return [r for r in taglist if r in self.config.tags]
 
+    def _update_stale_tag_row(self, msg_idx):
+        # Rewrite the MSG_TAGS of a row which bulk_tag() left out of date,
+        # using self.TAGS as the authority for any tags bulk_tag() changed.
+        with self._lock:
+            rv = None
+            if isinstance(self.INDEX, ColumnarRows):
+                rv = self.INDEX.msg_info(msg_idx)
+            if rv is None:
+                rv = self.l2m(self.INDEX[msg_idx])
+            if len(rv) != self.MSG_FIELDS_V2:
+                raise ValueError()
+            tags = [t for t in rv[self.MSG_TAGS].split(',')
+                    if t and t not in self.STALE_TAG_IDS]
+            tags.extend(t for t in self.STALE_TAG_IDS
+                        if msg_idx in self.TAGS.get(t, ()))
+            rv[self.MSG_TAGS] = ','.join(tags)
+            self.INDEX[msg_idx] = self.m2l(rv)
+            self.STALE_TAG_ROWS.discard(msg_idx)
+            return rv
+
+    def update_stale_tag_rows(self):
+        """Rewrite all rows with tags left out of date by bulk_tag()."""
+        with self._lock:
+            for msg_idx in list(self.STALE_TAG_ROWS):
+                try:
+                    self._update_stale_tag_row(msg_idx)
+                except (IndexError, ValueError):
+                    self.STALE_TAG_ROWS.discard(msg_idx)
+            self.STALE_TAG_IDS = set()
+
+    # Expanding more conversations than this is done with one pass over
+    # the whole index, instead of looking up each conversation.
+    BULK_TAG_SCAN_THREADS = 250
+
+    def _conversation_msg_idxs(self, msg_idxs):
+        threads = set(self.INDEX_THR[i] for i in msg_idxs)
+        threads.discard(-1)
+        if len(threads) > self.BULK_TAG_SCAN_THREADS:
+            return set(i for i, thr in enumerate(self.INDEX_THR)
+                       if thr in threads)
+        conv_idxs = set()
+        for thr in threads:
+            for reply in self.get_conversation(msg_idx=thr, ghosts=True):
+                if reply[self.MSG_MID]:
+                    conv_idxs.add(int(reply[self.MSG_MID], 36))
+        return conv_idxs
+
+    def bulk_tag(self, session, msg_idxs,
+                 add_tags=None, remove_tags=None, conversation=False):
+        """
+        Add and remove tags on many messages at once.
+
+        This updates the tag membership sets directly and invalidates
+        caches once per call, instead of once per message. The MSG_TAGS
+        of each row is only rewritten when the row is next read or the
+        index is saved.
+
+        Returns a dict mapping each tag ID to an (added, removed) tuple
+        of sets of message indexes.
+        """
+        add_tags = list(add_tags or [])
+        remove_tags = list(remove_tags or [])
+        with self._lock:
+            msg_idxs = set(i for i in msg_idxs if 0 <= i < len(self.INDEX))
+            if conversation and msg_idxs:
+                msg_idxs |= self._conversation_msg_idxs(msg_idxs)
+        if not msg_idxs or not (add_tags or remove_tags):
+            return dict((tid, (set(), set()))
+                        for tid in add_tags + remove_tags)
+
+        session.ui.mark(_n('Tagging %d message (%s)',
+                           'Tagging %d messages (%s)',
+                           len(msg_idxs)
+                           ) % (len(msg_idxs),
+                                ' '.join(['+%s' % t for t in add_tags] +
+                                         ['-%s' % t for t in remove_tags])))
+        results = {}
+        changed = set()
+        fresh = set(self._sort_freshness_tags)
+        with self._lock:
+            for tag_id in remove_tags:
+                members = self.TAGS.get(tag_id, set())
+                removed = msg_idxs & members
+                members -= removed
+                results[tag_id] = (set(), removed)
+            for tag_id in add_tags:
+                members = self.TAGS.get(tag_id)
+                if members is None:
+                    members = self.TAGS[tag_id] = set()
+                added = msg_idxs - members
+                members |= added
+                results[tag_id] = (added, results.get(tag_id, (0, set()))[1])
+
+            changed_tags = set(t for t, (a, r) in results.iteritems()
+                               if a or r)
+            for tag_id in changed_tags:
+                changed |= results[tag_id][0] | results[tag_id][1]
+            self.STALE_TAG_IDS |= changed_tags
+            self.STALE_TAG_ROWS |= changed
+            self.MODIFIED |= changed
+            for msg_idx in changed:
+                if msg_idx in self.CACHE:
+                    del self.CACHE[msg_idx]
+
+            self._drop_unread_cache(changed_tags)
+            if changed_tags & fresh:
+                dates = self.INDEX_SORT['date']
+                freshness = self.INDEX_SORT['freshness']
+                fresh_members = [self.TAGS.get(t, ()) for t in fresh]
+                for msg_idx in changed:
+                    boost = any(msg_idx in m for m in fresh_members)
+                    freshness[msg_idx] = dates[msg_idx] + (
+                        self.FRESHNESS_SORT_BOOST if boost else 0)
+
+        # Record that these messages were touched in some way
+        touched = '%x:u' % (time.time() // (24 * 3600))
+        GlobalPostingList.Append(session, touched, [b36(e) for e in msg_idxs])
+        CachedSearchResultSet.DropCaches(msg_idxs=msg_idxs,
+                                         tags=(add_tags + remove_tags),
+                                         terms=[touched])
+        try:
+            dirty = set([u'mail:all'])
+            for tag_id in add_tags + remove_tags:
+                tag = self.config.tags.get(tag_id)
+                if tag:
+                    dirty.add(u'%s:in' % tag.slug)
+            dirty |= set(u'%s:msg' % i for i in changed)
+            dirty |= set(u'%s:thread' % self.INDEX_THR[i] for i in changed)
+            self.config.command_cache.mark_dirty(dirty)
+        except:
+            pass
+        return results
+
     def add_tag(self, session, tag_id,
                 msg_info=None, msg_idxs=None,
                 conversation=False, allow_message_id_clearing=False):
@@ -1700,7 +2208,13 @@ class MailIndex(BaseIndex):
         if not msg_idxs:
             return set()
 
-        CachedSearchResultSet.DropCaches()
+        clear_message_id = False
+        if allow_message_id_clearing:
+            if session.config.tags[tag_id].type == 'trash':
+                 clear_message_id = True
+        if not clear_message_id:
+            return self.bulk_tag(session, msg_idxs, add_tags=[tag_id],
+                                 conversation=conversation)[tag_id][0]
 
         if conversation:
             session.ui.mark(_n('Tagging %d conversation (%s)',
@@ -1718,11 +2232,6 @@ class MailIndex(BaseIndex):
                            len(msg_idxs)
                            ) % (len(msg_idxs), tag_id))
 
-        clear_message_id = False
-        if allow_message_id_clearing:
-            if session.config.tags[tag_id].type == 'trash':
-                 clear_message_id = True
-
         eids = set()
         added = set()
         threads = set()
@@ -1732,6 +2241,7 @@ class MailIndex(BaseIndex):
                 msg_info = self.get_msg_at_idx_pos(msg_idx)
                 tags = set([r for r in msg_info[self.MSG_TAGS].split(',')
                             if r and r in session.config.tags])
+                self.STALE_TAG_ROWS.discard(msg_idx)
                 if tag_id not in tags:
                     tags.add(tag_id)
                     msg_info[self.MSG_TAGS] = ','.join(list(tags))
@@ -1758,11 +2268,13 @@ class MailIndex(BaseIndex):
                 self.TAGS[tag_id] |= eids
             elif eids:
                 self.TAGS[tag_id] = eids
+            self._drop_unread_cache([tag_id])
 
         # Record that these messages were touched in some way
-        GlobalPostingList.Append(session,
-                                 '%x:u' % (time.time() // (24 * 3600)),
-                                 [b36(e) for e in eids])
+        touched = '%x:u' % (time.time() // (24 * 3600))
+        GlobalPostingList.Append(session, touched, [b36(e) for e in eids])
+        CachedSearchResultSet.DropCaches(msg_idxs=eids, tags=[tag_id],
+                                         terms=[touched])
 
         try:
             self.config.command_cache.mark_dirty(
@@ -1781,61 +2293,10 @@ class MailIndex(BaseIndex):
             msg_idxs = set(msg_idxs)
         if not msg_idxs:
             return set()
+        return self.bulk_tag(session, msg_idxs, remove_tags=[tag_id],
+                             conversation=conversation)[tag_id][1]
 
-        session.ui.mark(_n('Untagging conversation (%s)',
-                           'Untagging conversations (%s)',
-                           len(msg_idxs)
-                           ) % (tag_id, ))
-        CachedSearchResultSet.DropCaches()
-        for msg_idx in list(msg_idxs):
-            if conversation:
-                for reply in self.get_conversation(msg_idx=msg_idx,
-                                                   ghosts=True):
-                    if reply[self.MSG_MID]:
-                        msg_idxs.add(int(reply[self.MSG_MID], 36))
-
-        session.ui.mark(_n('Untagging %d message (%s)',
-                           'Untagging %d messages (%s)',
-                           len(msg_idxs)
-                           ) % (len(msg_idxs), tag_id))
-        eids = set()
-        removed = set()
-        threads = set()
-        for msg_idx in msg_idxs:
-            if msg_idx >= 0 and msg_idx < len(self.INDEX):
-                msg_info = self.get_msg_at_idx_pos(msg_idx)
-                tags = set([r for r in msg_info[self.MSG_TAGS].split(',')
-                            if r and r in session.config.tags])
-                if tag_id in tags:
-                    tags.remove(tag_id)
-                    msg_info[self.MSG_TAGS] = ','.join(list(tags))
-                    self.INDEX[msg_idx] = self.m2l(msg_info)
-                    self.MODIFIED.add(msg_idx)
-                    self.update_msg_sorting(msg_idx, msg_info)
-                    if msg_idx in self.CACHE:
-                        del self.CACHE[msg_idx]
-                    removed.add(msg_idx)
-                    threads.add(msg_info[self.MSG_THREAD_MID].split('/')[0])
-                eids.add(msg_idx)
-        with self._lock:
-            if tag_id in self.TAGS:
-                self.TAGS[tag_id] -= eids
-
-        # Record that these messages were touched in some way
-        GlobalPostingList.Append(session,
-                                 '%x:u' % (time.time() // (24 * 3600)),
-                                 [b36(e) for e in eids])
-
-        try:
-            self.config.command_cache.mark_dirty(
-                [u'%s:in' % self.config.tags[tag_id].slug] +
-                [u'%s:msg' % e_idx for e_idx in removed] +
-                [u'%s:thread' % int(mid, 36) for mid in threads])
-        except:
-            pass
-        return removed
-
-    def search_tag(self, session, term, hits, recursion=0):
+    def search_tag(self, session, term, hits, recursion=0, deps=None):
         t = term.split(':', 1)
         tag_id, tag = t[1], self.config.get_tag(t[1])
         results = []
@@ -1844,36 +2305,134 @@ class MailIndex(BaseIndex):
             for subtag in self.config.get_tags(parent=tag_id):
                 results.extend(hits('%s:in' % subtag._key))
             if tag.magic_terms and recursion < 5:
-                results.extend(self.search(session, [tag.magic_terms],
-                                           recursion=recursion+1).as_set())
+                magic = self.search(session, [tag.magic_terms],
+                                    recursion=recursion+1)
+                results.extend(magic.as_set())
+                if deps is not None:
+                    deps |= magic.dependencies()
         results.extend(hits('%s:in' % tag_id))
         return results, tag
 
+    def _plan_term(self, session, term, hits, count, recursion, flags):
+        """
+        Figure out how to search for a single term, returning an estimate
+        of how many hits it has and a function which finds them. Posting
+        lists are estimated using count(), which does not load them, so
+        nothing gets read from disk until the plan is executed. Terms
+        we cannot cheaply estimate claim to match the whole index.
+        """
+        def known(results):
+            return len(results), lambda: results
+
+        unknown = len(self.INDEX)
+
+        def lookup(term):
+            return min(count(term), unknown), lambda: hits(term)
+        if ':' in term:
+            if term.startswith('in:'):
+                tag_id = term.split(':', 1)[1]
+                tag = self.config.get_tag(tag_id)
+                if tag:
+                    if tag.flag_hides:
+                        flags['invisible'] = True
+                    if tag.type == 'mailbox':
+                        flags['mailbox'] = True
+                    if (tag.magic_terms or
+                            self.config.get_tags(parent=tag._key)):
+                        return unknown, lambda: self.search_tag(
+                            session, term, hits, recursion=recursion,
+                            deps=flags.get('deps'))[0]
+                    tag_id = tag._key
+                return lookup('%s:in' % tag_id)
+
+            elif term.startswith('mid:'):
+                return known([int(t, 36) for t in
+                              term[4:].replace('=', '').split(',')])
+            elif term.startswith('body:'):
+                return lookup(term[5:])
+            elif term == 'all:mail':
+                return len(self.INDEX), lambda: SearchPlan.ALL
+            elif term in ('to:me', 'cc:me', 'from:me'):
+                def search_me():
+                    vcards = self.config.vcards
+                    emails, rt = [], []
+                    for vc in vcards.find_vcards([], kinds=['profile']):
+                        emails += [vcl.value for vcl in vc.get_all('email')]
+                    for email in set(emails):
+                        if email:
+                            rt.extend(hits('%s:%s' % (email,
+                                                      term.split(':')[0])))
+                    return rt
+                flags['deps'].add(CachedSearchResultSet.ANYTHING)
+                return unknown, search_me
+            elif term in ('is:encrypted', 'is:signed'):
+                if term == 'is:encrypted':
+                    prefix, statuses = 'mp_enc', EncryptionInfo.STATUSES
+                else:
+                    prefix, statuses = 'mp_sig', SignatureInfo.STATUSES
+                def search_crypto():
+                    rt = []
+                    for status in statuses:
+                        if status in CryptoInfo.STATUSES:
+                            continue
+                        rt.extend(self.search_tag(
+                            session, 'in:%s-%s' % (prefix, status), hits,
+                            recursion=recursion, deps=flags.get('deps'))[0])
+                    return rt
+                return unknown, search_crypto
+            else:
+                if term == 'is:deleted':
+                    flags['deleted'] = True
+                t = term.split(':', 1)
+                fnc = _plugins.get_search_term(t[0])
+                if fnc:
+                    flags['deps'].add(CachedSearchResultSet.ANYTHING)
+                    return unknown, lambda: fnc(self.config, self, term, hits)
+                else:
+                    return lookup('%s:%s' % (t[1], t[0]))
+        else:
+            return lookup(term)
+
     def search(self, session, searchterms,
                keywords=None, order=None, recursion=0, context=None):
         # Stash the raw search terms
         raw_terms = searchterms[:]
+        order = order or (session and session.order) or 'flat-index'
+        hide_invisible = (not session or 'all' not in order)
+
+        # Normal searches are cached; check the cache first.
+        if keywords is None and context is None:
+            srs = CachedSearchResultSet(self, raw_terms,
+                                        variant=('' if hide_invisible
+                                                 else 'all'))
+            if srs.cached:
+                return srs
 
         # Choose how we are going to search
+        deps = set()
         if keywords is not None:
             # Searching within pre-defined keywords
             def hits(term):
                 return [int(h, 36) for h in keywords.get(term, [])]
+
+            def count(term):
+                return len(keywords.get(term, []))
         else:
             # Normal search
             def hits(term):
+                deps.add(term)
                 if term.endswith(':in'):
                     return self.TAGS.get(term.rsplit(':', 1)[0], [])
                 else:
                     session.ui.mark(_('Searching for %s') % term)
-                    gpl_hits = GlobalPostingList(session, term).hits()
-                    try:
-                        return [int(h, 36) for h in gpl_hits]
-                    except ValueError:
-                        b36re = re.compile('^[a-zA-Z0-9]{1,8}$')
-                        print('FIXME! BAD HITS: %s => %s' % (term, [
-                            h for h in gpl_hits if not b36re.match(h)]))
-                        return [int(h, 36) for h in gpl_hits if b36re.match(h)]
+                    return GlobalPostingList(session, term).hits()
+
+            def count(term):
+                deps.add(term)
+                if term.endswith(':in'):
+                    return len(self.TAGS.get(term.rsplit(':', 1)[0], []))
+                else:
+                    return GlobalPostingList(session, term).estimate()
 
         # Replace some GMail-compatible terms with what we really use
         if 'tags' in self.config:
@@ -1892,15 +2451,12 @@ class MailIndex(BaseIndex):
         if searchterms and searchterms[0] and searchterms[0][0] == '-':
             searchterms[:0] = ['all:mail']
 
+        plan = SearchPlan(len(self.INDEX))
         if context:
-            r = [(None, set(context))]
-        else:
-            r = []
-
-        searched_invisible = False
-        searched_mailbox = False
-        searched_deleted = False
+            context = set(context)
+            plan.add(None, len(context), lambda: context)
 
+        flags = {'deps': deps}
         for term in searchterms:
             if term in STOPLIST:
                 if session:
@@ -1913,88 +2469,32 @@ class MailIndex(BaseIndex):
             else:
                 op = None
 
-            r.append((op, []))
-            rt = r[-1][1]
-            term = term.lower()
-
-            if ':' in term:
-                if term.startswith('in:'):
-                    results, tag = self.search_tag(session, term, hits,
-                                                   recursion=recursion)
-                    rt.extend(results)
-                    if tag:
-                        if tag.flag_hides:
-                            searched_invisible = True
-                        if tag.type == 'mailbox':
-                            searched_mailbox = True
-
-                elif term.startswith('mid:'):
-                    rt.extend([int(t, 36) for t in
-                               term[4:].replace('=', '').split(',')])
-                elif term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
-                elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
-                elif term in ('to:me', 'cc:me', 'from:me'):
-                    vcards = self.config.vcards
-                    emails = []
-                    for vc in vcards.find_vcards([], kinds=['profile']):
-                        emails += [vcl.value for vcl in vc.get_all('email')]
-                    for email in set(emails):
-                        if email:
-                            rt.extend(hits('%s:%s' % (email,
-                                                      term.split(':')[0])))
-                elif term == 'is:encrypted':
-                    for status in EncryptionInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(
-                            session, 'in:mp_enc-%s' % status, hits,
-                            recursion=recursion)[0])
-                elif term == 'is:signed':
-                    for status in SignatureInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(
-                            session, 'in:mp_sig-%s' % status, hits,
-                            recursion=recursion)[0])
-                else:
-                    if term == 'is:deleted':
-                        searched_deleted = True
-                    t = term.split(':', 1)
-                    fnc = _plugins.get_search_term(t[0])
-                    if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
-                    else:
-                        rt.extend(hits('%s:%s' % (t[1], t[0])))
-            else:
-                rt.extend(hits(term))
-
-        if r:
-            results = set(r[0][1])
-            for (op, rt) in r[1:]:
-                if op == '+':
-                    results |= set(rt)
-                elif op == '-':
-                    results -= set(rt)
-                else:
-                    results &= set(rt)
+            # Negations and all:mail depend on the size of the index
+            if op == '-' or term == 'all:mail':
+                deps.add('all:mail')
+
+            estimate, evaluate = self._plan_term(session, term.lower(), hits,
+                                                 count, recursion, flags)
+            plan.add(op, estimate, evaluate)
+
+        results = plan.execute()
+        if keywords is None:
             # Sometimes the scan gets aborted...
-            if keywords is None:
-                results -= set([len(self.INDEX)])
-        else:
-            results = set()
+            results.discard(len(self.INDEX))
+
+        searched_invisible = flags.get('invisible', False)
+        searched_mailbox = flags.get('mailbox', False)
+        searched_deleted = flags.get('deleted', False)
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
         exclude = []
-        order = order or (session and session.order) or 'flat-index'
         if (results and (keywords is None) and
                 (not searched_invisible) and
                 (not searched_mailbox) and
                 (not searched_deleted) and
                 ('tags' in self.config) and
-                (not session or 'all' not in order)):
+                hide_invisible):
             invisible = self.config.get_tags(flag_hides=True)
             exclude_terms = (['is:deleted'] +
                              ['in:%s' % i._key for i in invisible])
@@ -2002,17 +2502,15 @@ class MailIndex(BaseIndex):
                 exclude_terms = ([exclude_terms[0]] +
                                  ['+%s' % e for e in exclude_terms[1:]])
             # Recursing to pull the excluded terms from cache as well
-            exclude = self.search(session, exclude_terms).as_set()
+            exclude_srs = self.search(session, exclude_terms)
+            exclude = exclude_srs.as_set()
+            deps |= exclude_srs.dependencies()
 
-        # Decide if this is cached or not
-        if keywords is None:
-            srs = CachedSearchResultSet(self, raw_terms)
-            if len(srs) > 0:
-                return srs
+        if keywords is None and context is None:
+            srs.set_results(results, exclude, deps=deps)
         else:
             srs = SearchResultSet(self, raw_terms, [], [])
-
-        srs.set_results(results, exclude)
+            srs.set_results(results, exclude)
         if session:
             session.ui.mark(_n('Found %d result ',
                                'Found %d results ',
@@ -2034,17 +2532,108 @@ class MailIndex(BaseIndex):
     SORT_ORDERS = {
         'freshness': _freshness_sorter,
         'date': lambda s, mi: long(mi[s.MSG_DATE], 36),
-# FIXME: The following are disabled for now for being memory hogs
-#       'from': lambda s, mi: s.mi[s.MSG_FROM]),
-#       'subject': lambda s, mi: s.mi[s.MSG_SUBJECT]),
+    }
+
+    # Orders which sort by a string: each message only stores the ID of
+    # its (normalized) string in a shared table, and the sort keys are
+    # the ranks of those strings, recalculated when new strings show up.
+    SUBJECT_PREFIX_RE = re.compile(r'^((re|fwd?|aw|sv|tr)(\[\d+\])?:\s*)+',
+                                   re.IGNORECASE)
+    SORT_STRINGS = {
+        'from': lambda mf: mf.replace('"', '').strip().lower(),
+        'subject': lambda ms: MailIndex.SUBJECT_PREFIX_RE.sub(
+            '', ms.strip()).lower(),
+    }
+    SORT_STRING_FIELDS = {
+        'from': BaseIndex.MSG_FROM,
+        'subject': BaseIndex.MSG_SUBJECT,
     }
 
     def _prepare_sorting(self):
         self._sort_freshness_tags = [tag._key for tag in
                                      self.config.get_tags(type='unread')]
+        self._sort_unread = None
         self.INDEX_SORT = {}
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order] = []
+            self.INDEX_SORT[order] = array.array('l')
+        self._sort_strings = {}
+        self._sort_string_ids = {}
+        self._sort_ranks = {}
+        self._sort_stale = set()
+        for order in self.SORT_STRINGS:
+            self.INDEX_SORT[order] = array.array('l')
+            self._sort_strings[order] = {}
+            self._sort_string_ids[order] = array.array('l')
+            self._sort_ranks[order] = array.array('l')
+
+    def _intern_sort_string(self, order, value):
+        # Metadata may arrive as UTF-8 or as unicode; the table must only
+        # ever contain (normalized) unicode, or sorting it will fail.
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        value = self.SORT_STRINGS[order](value)
+        table = self._sort_strings[order]
+        sid = table.get(value)
+        if sid is None:
+            sid = table[value] = len(table)
+            self._sort_stale.add(order)
+        return sid
+
+    def _update_sort_ranks(self, order):
+        """Recalculate the sort keys for a string order, if necessary."""
+        with self._lock:
+            if order not in self._sort_stale:
+                return
+            table = self._sort_strings[order]
+            ranks = array.array('l', [0]) * len(table)
+            for rank, value in enumerate(sorted(table)):
+                ranks[table[value]] = rank
+            self._sort_ranks[order] = ranks
+            self.INDEX_SORT[order] = array.array(
+                'l', map(ranks.__getitem__, self._sort_string_ids[order]))
+            self._sort_stale.discard(order)
+
+    def _drop_unread_cache(self, tag_ids):
+        if self._sort_unread and (set(tag_ids) & self._sort_unread[0]):
+            self._sort_unread = None
+
+    def unread_msg_idxs(self, session):
+        """Return the (cached) set of all messages with unread tags."""
+        tids = frozenset(tag._key for tag in
+                         session.config.get_tags(type='unread'))
+        cached = self._sort_unread
+        if cached is None or cached[0] != tids:
+            unread = set()
+            for tid in tids:
+                unread |= self.TAGS.get(tid, set())
+            cached = self._sort_unread = (tids, unread)
+        return cached[1]
+
+    def collapse_threads(self, results, unread=None):
+        """
+        Filter away all but one result in each conversation.
+
+        Each conversation keeps the position of its first result. If a set
+        of unread messages is provided, the last unread result in each
+        conversation is shown instead of the first one, where possible.
+        """
+        if len(results) < 2:
+            return results
+        threads = operator.itemgetter(*results)(self.INDEX_THR)
+
+        # Walk backwards, so earlier positions overwrite later ones
+        first = dict(izip(reversed(threads),
+                          xrange(len(threads) - 1, -1, -1)))
+        positions = sorted(first.itervalues())
+
+        if unread:
+            fresh = filter(unread.__contains__, results)
+            shown = dict(izip(map(self.INDEX_THR.__getitem__, fresh), fresh))
+            results[:] = [shown.get(threads[p], results[p])
+                          for p in positions]
+        else:
+            results[:] = map(results.__getitem__, positions)
+        return results
 
     def sort_results(self, session, results, how):
         if not results:
@@ -2068,6 +2657,7 @@ class MailIndex(BaseIndex):
                 did_sort = False
                 for order in self.INDEX_SORT:
                     if how.endswith(order):
+                        self._update_sort_ranks(order)
                         try:
                             results.sort(
                                 key=self.INDEX_SORT[order].__getitem__)
@@ -2102,27 +2692,12 @@ class MailIndex(BaseIndex):
             results.reverse()
 
         if 'flat' not in how:
-            all_new = set()
-            if 'freshness' in how:
-                # FIXME: This calculation appears very cachable!
-                new_tags = session.config.get_tags(type='unread')
-                for tag in new_tags:
-                    all_new |= self.TAGS.get(tag._key, set([]))
-
-            # This filters away all but the first (or oldst unread) result in
-            # each conversation.
+            # This filters away all but the first (or oldest unread) result
+            # in each conversation.
             session.ui.mark(_('Collapsing conversations...'))
-            seen, pi = {}, 0
-            for ri in results:
-                ti = self.INDEX_THR[ri]
-                if ti in seen:
-                    if ti in all_new:
-                        results[seen[ti]] = ri
-                else:
-                    results[pi] = ri
-                    seen[ti] = pi
-                    pi += 1
-            results[pi:] = []
+            self.collapse_threads(results, unread=(
+                self.unread_msg_idxs(session) if ('freshness' in how)
+                else None))
             session.ui.mark(_n('Sorted %d message by %s',
                                'Sorted %d messages by %s',
                                count
@@ -2140,6 +2715,66 @@ class MailIndex(BaseIndex):
 
         return True
 
+    def _thread_representatives(self, results, keys, newest):
+        # Pick the result each conversation would be collapsed to if the
+        # results were sorted: the one with the lowest (or highest) key.
+        best, thr = {}, self.INDEX_THR
+        if newest:
+            for ri in results:
+                bi = best.get(thr[ri])
+                if bi is None or keys[ri] > keys[bi]:
+                    best[thr[ri]] = ri
+        else:
+            for ri in results:
+                bi = best.get(thr[ri])
+                if bi is None or keys[ri] < keys[bi]:
+                    best[thr[ri]] = ri
+        return best.values()
+
+    def sort_page(self, session, results, how, limit):
+        """
+        Sort search results, but only put the first `limit` in order.
+
+        This returns a PartiallySortedResults list, which sorts the rest
+        a page at a time as it is accessed. Orders we cannot sort that
+        way (and short result lists) are sorted in place by sort_results
+        and the original list is returned.
+        """
+        how = how or 'flat-unsorted'
+        orders = [o for o in self.INDEX_SORT if how.endswith(o)]
+        if (not orders or len(results) <= limit * 4 or
+                ('freshness' in how and 'flat' not in how)):
+            self.sort_results(session, results, how)
+            return results
+
+        count = len(results)
+        order = orders[0]
+        self._update_sort_ranks(order)
+        keys = self.INDEX_SORT[order]
+        reverse = how.startswith('rev')
+        session.ui.mark(_n('Sorting %d message by %s...',
+                           'Sorting %d messages by %s...',
+                           count
+                           ) % (count, _(how)))
+        try:
+            if 'flat' not in how:
+                session.ui.mark(_('Collapsing conversations...'))
+                results = self._thread_representatives(results, keys, reverse)
+            results = PartiallySortedResults(results, keys.__getitem__,
+                                             reverse=reverse, page=limit)
+            results.sort_upto(limit)
+        except IndexError:
+            # Bogus message indexes; let sort_results deal with them
+            results = list(results)
+            self.sort_results(session, results, how)
+            return results
+
+        session.ui.mark(_n('Sorted first %d of %d results by %s',
+                           'Sorted first %d of %d results by %s',
+                           results.sorted_upto
+                           ) % (results.sorted_upto, len(results), _(how)))
+        return results
+
 
 if __name__ == '__main__':
     import doctest
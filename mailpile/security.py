@@ -10,13 +10,16 @@ from __future__ import print_function
 import copy
 import hashlib
 import json
+import socket
 import ssl
 import time
+import weakref
 
 # Note: Do NOT import mailpile.conn_broker, as our monkey patching
 #       of ssl depends on things happening in the right order. :-/
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.lru_cache import LRUCache
 from mailpile.util import *
 import mailpile.platforms
 
@@ -492,32 +495,33 @@ def tls_configure(sock, context, args, kwargs):
     hostname = None
     accept_certs = []
     if 'server_hostname' in kwargs:
-        try:
-            hostname = '%s:%s' % (kwargs['server_hostname'], sock.getpeername()[1])
-        except TypeError:
-            # sock.getpeername() may fail
-            hostname = '%s' % (kwargs.get('server_hostname'),)
-
-        if hostname:
-            tls_settings = KNOWN_TLS_HOSTS.get(md5_hex(hostname))
-        else:
-            tls_settings = None
+        hostname = tls_peer_name(sock, kwargs)
+        tls_settings, use_web_ca = tls_host_policy(hostname, kwargs)
 
         # These defaults allow us to do certificate TOFU
         if tls_settings is not None:
             accept_certs = [c for c in tls_settings.accept_certs]
         kwargs['cert_reqs'] = ssl.CERT_NONE
-        if context:
+
+        if context is not None and context in TLS_SHARED_CONTEXTS:
+            # Shared contexts are configured once, when they are created
+            # (see tls_client_context), and must not be changed here: other
+            # threads may be using them.
+            if context.verify_mode == ssl.CERT_REQUIRED:
+                accept_certs = None
+            use_web_ca = False
+        elif context:
             context.check_hostname = False
             context.verify_mode = ssl.CERT_NONE
 
         # Attempt to configure for Certificate Authorities
-        use_web_ca = kwargs.get('use_web_ca',
-            tls_settings is None or tls_settings.use_web_ca)
         if use_web_ca:
             try:
                 if context:
-                    context.load_default_certs()
+                    # Avoid reloading the CA certificates if the caller
+                    # reuses their context.
+                    if not context.cert_store_stats().get('x509_ca'):
+                        context.load_default_certs()
                     context.verify_mode = ssl.CERT_REQUIRED
                     context.check_hostname = True
                     accept_certs = None
@@ -548,6 +552,25 @@ def tls_configure(sock, context, args, kwargs):
     return tuple(args), kwargs, hostname, accept_certs
 
 
+def tls_peer_name(sock, kwargs):
+    try:
+        return '%s:%s' % (kwargs['server_hostname'], sock.getpeername()[1])
+    except (TypeError, AttributeError, socket.error):
+        # sock.getpeername() may fail
+        return '%s' % (kwargs.get('server_hostname'),)
+
+
+def tls_host_policy(hostname, kwargs):
+    """Return our TOFU settings for a host and whether to use the web CAs."""
+    if hostname:
+        tls_settings = KNOWN_TLS_HOSTS.get(md5_hex(hostname))
+    else:
+        tls_settings = None
+    use_web_ca = kwargs.get('use_web_ca',
+        tls_settings is None or tls_settings.use_web_ca)
+    return tls_settings, bool(use_web_ca)
+
+
 def tls_new_context():
     if hasattr(ssl, 'OP_NO_SSLv3'):
         return ssl.SSLContext(ssl.PROTOCOL_SSLv23)
@@ -555,6 +578,75 @@ def tls_new_context():
         return ssl.SSLContext(ssl.PROTOCOL_TLSv1)
 
 
+TLS_CLIENT_CONTEXTS = LRUCache('tls-contexts', max_entries=32)
+TLS_SHARED_CONTEXTS = weakref.WeakSet()
+TLS_REUSABLE_KWARGS = set(['server_hostname', 'do_handshake_on_connect',
+                           'suppress_ragged_eofs', 'use_web_ca', 'tofu'])
+
+
+def tls_client_context(sock, args, kwargs):
+    """
+    Return an SSLContext for an outgoing connection, reusing the one we
+    used last time we talked to the same server. Setting up a context
+    (loading the system CA certificates in particular) costs tens of
+    milliseconds, which adds up when we reconnect often.
+
+    Shared contexts are fully configured before anyone gets to use them,
+    and then never modified; if our policy for a server changes, the
+    cache key changes with it and a new context gets created.
+
+    >>> TLS_CLIENT_CONTEXTS.clear()
+    >>> kw = {'server_hostname': 'example.com', 'use_web_ca': False}
+    >>> ctx = tls_client_context(None, (), kw)
+    >>> ctx is tls_client_context(None, (), kw)
+    True
+    >>> ctx.verify_mode == ssl.CERT_NONE
+    True
+    >>> ca = tls_client_context(None, (), dict(kw, use_web_ca=True))
+    >>> ca is ctx, ca.verify_mode == ssl.CERT_REQUIRED, ca.check_hostname
+    (False, True, True)
+
+    Configuring a connection does not change a shared context:
+
+    >>> a, kwa, sname, accept_certs = tls_configure(None, ctx, (), kw)
+    >>> ctx.verify_mode == ssl.CERT_NONE, accept_certs
+    (True, [])
+    >>> a, kwa, sname, accept_certs = tls_configure(
+    ...     None, ca, (), dict(kw, use_web_ca=False))
+    >>> ca.verify_mode == ssl.CERT_REQUIRED, accept_certs
+    (True, None)
+
+    Server-side sockets and unusual arguments get a fresh context:
+
+    >>> ctx is tls_client_context(None, (True, ), kw)
+    False
+    >>> tls_client_context(None, (), {'server_hostname': 'example.com',
+    ...                               'ciphers': 'HIGH'}) in TLS_SHARED_CONTEXTS
+    False
+    """
+    if args or not kwargs.get('server_hostname') or (
+            set(kwargs.keys()) - TLS_REUSABLE_KWARGS):
+        return tls_new_context()
+
+    hostname = tls_peer_name(sock, kwargs)
+    use_web_ca = tls_host_policy(hostname, kwargs)[1]
+    key = (hostname, use_web_ca)
+    context = TLS_CLIENT_CONTEXTS.get(key)
+    if context is None:
+        context = tls_new_context()
+        if use_web_ca:
+            try:
+                context.load_default_certs()
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.check_hostname = True
+            except (NameError, AttributeError):
+                # Old Python: Fall back to TOFU
+                pass
+        TLS_SHARED_CONTEXTS.add(context)
+        TLS_CLIENT_CONTEXTS[key] = context
+    return context
+
+
 def tls_cert_tofu(wrapped, accept_certs, sname):
     global KNOWN_TLS_HOSTS
     cert = tls_sock_cert_sha256(wrapped)
@@ -752,7 +844,8 @@ if __name__ != "__main__":
             ssl.SSLContext.wrap_socket, tls_context_wrap_socket)
         def add_tls_context(unused_org_wrap, sock, *args, **kwargs):
             try:
-                return tls_new_context().wrap_socket(sock, *args, **kwargs)
+                return tls_client_context(sock, args, kwargs).wrap_socket(
+                    sock, *args, **kwargs)
             except:
                 raise
         ssl.wrap_socket = monkey_patch(ssl.wrap_socket, add_tls_context)
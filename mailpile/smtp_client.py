@@ -242,6 +242,10 @@ def SendMail(session, msg_mid, from_to_msg_ev_tuples,
                 sys.stderr.write(_('SMTP connection to: %s:%s as %s\n'
                                    ) % (host, port, user or '(anon)'))
 
+            # Idle connections are shared via. the broker's pool, keyed
+            # by everything which went into setting them up.
+            pool_key = ('smtp', proto, host, int(port), user or '',
+                        md5_hex(pwd or ''), auth_type)
             serverbox = [None]
             def sm_connect_server():
                 server = (smtp_ssl and SMTP_SSL or SMTP
@@ -263,7 +267,34 @@ def SendMail(session, msg_mid, from_to_msg_ev_tuples,
 
                 return server
 
+            def sm_reuse_server():
+                server = ConnBroker.pool.checkout(pool_key)
+                if server is not None:
+                    server.set_debuglevel(
+                        1 if ('sendmail' in session.config.sys.debug) else 0)
+                    serverbox[0] = server
+                return server
+
             def sm_startup():
+                server = sm_reuse_server()
+                if server is None:
+                    sm_login()
+                    server = serverbox[0]
+
+                smtp_do_or_die(_('Sender rejected by SMTP server'),
+                               events, server.mail, frm)
+                for rcpt in to:
+                    rc, msg = server.rcpt(rcpt)
+                    if (rc == SMTORP_HASHCASH_RCODE and
+                            msg.startswith(SMTORP_HASHCASH_PREFIX)):
+                        rc, msg = server.rcpt(SMTorP_HashCash(rcpt, msg))
+                    if rc != 250:
+                        fail(_('Server rejected recipient: %s') % rcpt, events)
+                rcode, rmsg = server.docmd('DATA')
+                if rcode != 354:
+                    fail(_('Server rejected DATA: %s %s') % (rcode, rmsg))
+
+            def sm_login():
                 try:
                     server = sm_connect_server()
                     if not smtp_ssl:
@@ -318,19 +349,6 @@ def SendMail(session, msg_mid, from_to_msg_ev_tuples,
                         # it's passwordless and try to carry one anyway.
                         pass
 
-                smtp_do_or_die(_('Sender rejected by SMTP server'),
-                               events, server.mail, frm)
-                for rcpt in to:
-                    rc, msg = server.rcpt(rcpt)
-                    if (rc == SMTORP_HASHCASH_RCODE and
-                            msg.startswith(SMTORP_HASHCASH_PREFIX)):
-                        rc, msg = server.rcpt(SMTorP_HashCash(rcpt, msg))
-                    if rc != 250:
-                        fail(_('Server rejected recipient: %s') % rcpt, events)
-                rcode, rmsg = server.docmd('DATA')
-                if rcode != 354:
-                    fail(_('Server rejected DATA: %s %s') % (rcode, rmsg))
-
             def sm_write(data):
                 server = serverbox[0]
                 for line in data.splitlines(True):
@@ -344,6 +362,17 @@ def SendMail(session, msg_mid, from_to_msg_ev_tuples,
                 smtp_do_or_die(_('Error spooling mail'),
                                events, server.getreply)
 
+                # The transaction is complete, keep the connection around
+                # in case we have more mail for this server.
+                def healthy():
+                    try:
+                        return server.rset()[0] == 250
+                    except (smtplib.SMTPException, socket.error):
+                        return False
+                ConnBroker.pool.checkin(pool_key, server,
+                                        check=healthy, close=server.close)
+                serverbox[0] = None
+
             def sm_cleanup():
                 server = serverbox[0]
                 if hasattr(server, 'sock'):
@@ -204,6 +204,23 @@ class Classifier:
             wordstream = self._enhance_wordstream(wordstream)
         self._add_msg(wordstream, is_spam)
 
+    def learn_batch(self, wordstreams, is_spam):
+        """Teach the classifier by many examples at once.
+
+        This is equivalent to calling learn() on each wordstream in turn,
+        but word counts are tallied for the whole batch first, so each
+        WordInfo record is only updated once.
+        """
+        counts = {}
+        messages = 0
+        for wordstream in wordstreams:
+            if options["Classifier", "use_bigrams"]:
+                wordstream = self._enhance_wordstream(wordstream)
+            for word in set(wordstream):
+                counts[word] = counts.get(word, 0) + 1
+            messages += 1
+        self._add_counts(counts, messages, is_spam)
+
     def unlearn(self, wordstream, is_spam):
         """In case of pilot error, call unlearn ASAP after screwing up.
 
@@ -315,6 +332,29 @@ class Classifier:
 
         self._post_training()
 
+    def _add_counts(self, counts, messages, is_spam):
+        # Like _add_msg, for a whole batch of messages; counts maps each
+        # word to the number of messages it appeared in.
+        self.probcache = {}    # nuke the prob cache
+        if is_spam:
+            self.nspam += messages
+        else:
+            self.nham += messages
+
+        for word, count in counts.iteritems():
+            record = self._wordinfoget(word)
+            if record is None:
+                record = self.WordInfoClass()
+
+            if is_spam:
+                record.spamcount += count
+            else:
+                record.hamcount += count
+
+            self._wordinfoset(word, record)
+
+        self._post_training()
+
     def _remove_msg(self, wordstream, is_spam):
         self.probcache = {}    # nuke the prob cache
         if is_spam:
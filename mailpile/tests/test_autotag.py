@@ -0,0 +1,72 @@
+import mailpile.plugins.autotag_sb
+from mailpile.plugins.autotag import KeywordCache, Retrain, LoadKeywordCache
+from mailpile.plugins.autotag import SaveKeywordCache, filter_hook
+from mailpile.spambayes import Classifier
+from mailpile.tests import MailPileUnittest
+
+
+class CountingRetrain(Retrain):
+    reads = 0
+
+    def _get_keywords(self, e):
+        CountingRetrain.reads += 1
+        return Retrain._get_keywords(self, e)
+
+
+class TestAutoTag(MailPileUnittest):
+
+    def setUp(self):
+        self.tag = self.config.get_tags(type='inbox')[0]
+        self.tag.auto_tag = 'spambayes'
+        self.config.real_setattr('autotag_keywords', KeywordCache())
+
+    def tearDown(self):
+        self.tag.auto_tag = ''
+
+    def test_learn_batch(self):
+        messages = [['a', 'b', 'c'], ['b', 'c', 'c'], ['d']]
+        one, batch = Classifier(), Classifier()
+        for msg in messages:
+            one.learn(msg, True)
+        one.learn(['a', 'e'], False)
+        batch.learn_batch(messages, True)
+        batch.learn_batch([['a', 'e']], False)
+        self.assertEqual((one.nspam, one.nham), (batch.nspam, batch.nham))
+        counts = lambda c: sorted((w, r.__getstate__())
+                                  for w, r in c.wordinfo.items())
+        self.assertEqual(counts(one), counts(batch))
+        self.assertEqual(one.chi2_spamprob(['b', 'e']),
+                         batch.chi2_spamprob(['b', 'e']))
+
+    def test_retrain_with_keyword_cache(self):
+        CountingRetrain.reads = 0
+        result = CountingRetrain(self.session, arg=[]).run().result
+        self.assertEqual(result['retrained'], [self.tag.name])
+        self.assertTrue(result['read_messages'] > 0)
+        self.assertEqual(CountingRetrain.reads, result['read_messages'])
+        self.assertEqual(len(LoadKeywordCache(self.config).keywords),
+                         result['read_messages'])
+        atagger = self.config.load_auto_tagger(
+            [c for c in mailpile.plugins.autotag.autotag_configs(self.config)
+             if c.match_tag == self.tag._key][0])
+        self.assertTrue(atagger.trained)
+        self.assertTrue(atagger.spambayes.nspam +
+                        atagger.spambayes.nham > 0)
+
+        # Training again uses the cached keywords
+        CountingRetrain.reads = 0
+        result = CountingRetrain(self.session, arg=[]).run().result
+        self.assertEqual(result['retrained'], [self.tag.name])
+        self.assertEqual(CountingRetrain.reads, 0)
+
+    def test_reindex_discards_cached_keywords(self):
+        Retrain(self.session, arg=[]).run()
+        mid = sorted(LoadKeywordCache(self.config).keywords)[0]
+
+        # Re-indexing a message right after a restart, before the cache
+        # has been loaded, still forgets its keywords for good.
+        self.config.__dict__.pop('autotag_keywords')
+        filter_hook(self.session, mid, None, set())
+        SaveKeywordCache(self.config)
+        self.config.__dict__.pop('autotag_keywords')
+        self.assertFalse(mid in LoadKeywordCache(self.config).keywords)
@@ -1,8 +1,10 @@
 import unittest
 import os
+import time
 from mock import patch
 
 import mailpile
+from mailpile.command_cache import CommandCache
 from mailpile.commands import Action as action
 from mailpile.tests import MailPileUnittest
 
@@ -149,6 +151,58 @@ class TestCommandResult(MailPileUnittest):
         self.assertGreater(res.as_html(), 0)
 
 
+class TestCommandCache(MailPileUnittest):
+    class FakeCommand(object):
+        def __init__(self, session):
+            self.session = session
+            self.refreshes = 0
+
+        def refresh(self):
+            self.refreshes += 1
+            return TestCommandCache.FakeResult(self.session)
+
+    class FakeResult(object):
+        def __init__(self, session):
+            self.session = session
+
+    def _cache(self, cc, fprint, req, expires=300):
+        cmd = self.FakeCommand(self.mp._session)
+        cc.cache_result(fprint, time.time() + expires, set(req), cmd,
+                        self.FakeResult(self.mp._session))
+        cc.cache[fprint][-1] -= 1  # Pretend it was cached a while ago
+        return cmd
+
+    def test_mark_dirty_and_refresh(self):
+        cc = CommandCache()
+        inbox = self._cache(cc, 'inbox', ['in:inbox', 'msg:1'])
+        potato = self._cache(cc, 'potato', ['potato'])
+        self.assertTrue(cc.get_result('inbox'))
+
+        keywords = set('kw%d' % i for i in range(0, 1000))
+        cc.mark_dirty(keywords | set(['msg:1']))
+        cc.mark_dirty(['in:inbox'])
+        self.assertEqual(cc.dirty_set(), set(['inbox']))
+        self.assertRaises(KeyError, cc.get_result, 'inbox')
+        self.assertTrue(cc.get_result('potato'))
+
+        # Both marks are coalesced into a single refresh
+        cc.refresh()
+        self.assertEqual((inbox.refreshes, potato.refreshes), (1, 0))
+        self.assertEqual(cc.dirty_set(), set())
+        self.assertEqual(cc.stats()['costs']['inbox']['refreshes'], 1)
+        cc.cache['inbox'][-1] -= 1
+        self.assertTrue(cc.get_result('inbox'))
+
+    def test_size_limit(self):
+        cc = CommandCache(max_entries=2)
+        self._cache(cc, 'a', ['a', 'shared'], expires=100)
+        self._cache(cc, 'b', ['b', 'shared'], expires=300)
+        self._cache(cc, 'c', ['c', 'shared'], expires=200)
+        self.assertEqual(sorted(cc.cache.keys()), ['b', 'c'])
+        self.assertFalse('a' in cc.by_req)
+        self.assertEqual(cc.by_req['shared'], set(['b', 'c']))
+
+
 class TestTagging(MailPileUnittest):
     def test_addtag(self):
         pass
@@ -0,0 +1,124 @@
+import asyncore
+import smtpd
+import threading
+import time
+from email.mime.text import MIMEText
+
+from mailpile.conn_brokers import Master, ConnectionPool
+from mailpile.plugins import PluginManager
+from mailpile.smtp_client import SendMail
+from mailpile.tests import MailPileUnittest
+
+
+class DroppingSMTPChannel(smtpd.SMTPChannel):
+    def found_terminator(self):
+        in_data = (self._SMTPChannel__state == self.DATA)
+        smtpd.SMTPChannel.found_terminator(self)
+        if in_data and self._SMTPChannel__server.drop_idle:
+            # Hang up without telling the client, like servers with a
+            # short idle timeout do.
+            self.close_when_done()
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.drop_idle = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            DroppingSMTPChannel(self, *pair)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos))
+
+
+class TestConnectionPool(MailPileUnittest):
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool()
+        pool.IDLE_TIMEOUT = 0.1
+        closed = []
+        for c in ('a', 'b', 'c'):
+            pool.checkin('k', c, close=lambda c=c: closed.append(c))
+        # Only MAX_IDLE connections are kept, the oldest goes first
+        self.assertEqual(closed, ['a'])
+        time.sleep(0.2)
+        self.assertEqual(pool.checkout('k'), None)
+        self.assertEqual(sorted(closed), ['a', 'b', 'c'])
+        self.assertEqual(pool.stats()['expired'], 2)
+
+    def test_housekeeping(self):
+        closed = []
+        old_timeout = Master.pool.IDLE_TIMEOUT
+        try:
+            Master.pool.IDLE_TIMEOUT = 0.1
+            Master.pool.checkin('k', 'c', close=lambda: closed.append('c'))
+            time.sleep(0.2)
+
+            # Expired connections are closed by the periodic job, without
+            # waiting for the pool to be used again.
+            period, job = PluginManager.FAST_PERIODIC_JOBS['conn_pool']
+            job(self.mp._session)
+            self.assertEqual(closed, ['c'])
+        finally:
+            Master.pool.IDLE_TIMEOUT = old_timeout
+
+    def _start_server(self):
+        server = RecordingSMTPServer()
+        loop = threading.Thread(target=asyncore.loop,
+                                kwargs={'timeout': 0.1})
+        loop.daemon = True
+        loop.start()
+        return server
+
+    def _send(self, server, count):
+        route = {'protocol': 'smtp', 'host': 'localhost',
+                 'port': server.port}
+        for i in range(0, count):
+            msg = MIMEText('Hello pooled world %d' % i)
+            msg['From'] = 'a@example.com'
+            msg['To'] = 'b@example.com'
+            msg['Subject'] = 'Pooled %d' % i
+            SendMail(self.mp._session, None,
+                     [('a@example.com', ['b@example.com'], msg, [])],
+                     test_route=route)
+
+    def test_smtp_reuse(self):
+        server = self._start_server()
+        try:
+            self._send(server, 3)
+            self.assertEqual(len(server.messages), 3)
+
+            # The first message was delivered over a new connection (two
+            # in fact, as the STARTTLS attempt failed), the others reused
+            # its connection.
+            self.assertEqual(server.connections, 2)
+            latency = Master.latency.stats()[
+                'localhost:%d' % server.port]['connect']
+            self.assertEqual(latency['count'], 2)
+            self.assertTrue(latency['max'] >= latency['avg'] > 0)
+        finally:
+            Master.pool.close_idle()
+            server.close()
+
+    def test_smtp_dropped(self):
+        server = self._start_server()
+        server.drop_idle = True
+        unhealthy = Master.pool.stats()['unhealthy']
+        try:
+            self._send(server, 2)
+            self.assertEqual(len(server.messages), 2)
+
+            # The server hung up on the pooled connection, so the second
+            # message was sent over a new one.
+            self.assertEqual(server.connections, 4)
+            self.assertEqual(Master.pool.stats()['unhealthy'], unhealthy + 1)
+        finally:
+            Master.pool.close_idle()
+            server.close()
@@ -0,0 +1,191 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from mailpile.crypto.gpgi import GnuPG, GnuPGCoprocessPool, GNUPG_RESULTS
+
+
+class GnuPGTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.home = tempfile.mkdtemp()
+        os.chmod(cls.home, 0o700)
+        cls.fingerprint = cls.gen_key('test@example.com')
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.call(['gpgconf', '--homedir', cls.home,
+                         '--kill', 'gpg-agent'])
+        shutil.rmtree(cls.home)
+
+    @classmethod
+    def gpg(cls, args, data='', home=None):
+        proc = subprocess.Popen(['gpg', '--batch', '--quiet',
+                                 '--homedir', home or cls.home] + args,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        return proc.communicate(data)[0]
+
+    @classmethod
+    def gen_key(cls, email, home=None):
+        cls.gpg(['--passphrase', '', '--quick-gen-key', email,
+                 'ed25519', 'sign', 'never'], home=home)
+        fingerprint = cls.gpg(['--with-colons', '--list-keys', email],
+                              home=home).split('fpr:::::::::')[1][:40]
+        cls.gpg(['--passphrase', '', '--quick-add-key', fingerprint,
+                 'cv25519', 'encr', 'never'], home=home)
+        return fingerprint
+
+    def gnupg(self, coprocesses=None):
+        g = GnuPG(None)
+        g.set_home(self.home)
+        g.coprocesses = coprocesses
+        return g
+
+
+class TestGnuPGCoprocesses(GnuPGTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestGnuPGCoprocesses, cls).setUpClass()
+        cls.data = 'Hello, World\n'
+        cls.clearsigned = cls.gpg(['--clearsign'], cls.data)
+        cls.signature = cls.gpg(['--detach-sign', '--armor'], cls.data)
+        cls.encrypted = cls.gpg(['--encrypt', '--sign', '--armor',
+                                 '-r', 'test@example.com'], cls.data)
+
+    def test_pooled_results(self):
+        pool = GnuPGCoprocessPool(spares=1)
+        try:
+            for i in range(0, 3):
+                for g in (self.gnupg(), self.gnupg(pool)):
+                    GNUPG_RESULTS.clear()
+                    self.assertEqual(g.pooled(), g.coprocesses is not None)
+                    self.assertEqual(g.verify(self.clearsigned)['status'],
+                                     'verified')
+                    self.assertEqual(g.verify(self.data,
+                                              signature=self.signature
+                                              )['status'], 'verified')
+                    self.assertEqual(g.verify('Bogus', signature=self.signature
+                                              )['status'], 'invalid')
+                    sig, enc, text = g.decrypt(self.encrypted)
+                    self.assertEqual(text, self.data)
+                    self.assertEqual(enc['status'], 'decrypted')
+                    self.assertEqual(sig['status'], 'verified')
+            self.assertEqual(pool.stats['taken'], 12)
+        finally:
+            pool.close()
+        self.assertEqual(pool.pool, {})
+
+
+class TestGnuPGKeyringCache(GnuPGTestCase):
+
+    def test_keyring_cache(self):
+        g = self.gnupg()
+        cache = g.keyring_cache()
+        keys = g.list_keys()
+        self.assertEqual(keys.keys(), [self.fingerprint])
+        keys.clear()
+        self.assertEqual(g.list_keys().keys(), [self.fingerprint])
+        self.assertEqual(g.list_keys(['test@example.com']).keys(),
+                         [self.fingerprint])
+        self.assertEqual(g.list_secret_keys().keys(), [self.fingerprint])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # Imports and deletions update the listings we already have
+        other_home = tempfile.mkdtemp()
+        os.chmod(other_home, 0o700)
+        try:
+            other = self.gen_key('other@example.com', home=other_home)
+            key_data = self.gpg(['--export', '--armor', other],
+                                home=other_home)
+        finally:
+            subprocess.call(['gpgconf', '--homedir', other_home,
+                             '--kill', 'gpg-agent'])
+            shutil.rmtree(other_home)
+        g.import_keys(key_data)
+        self.assertEqual(sorted(g.list_keys().keys()),
+                         sorted([self.fingerprint, other]))
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(g.list_secret_keys().keys(), [self.fingerprint])
+        self.assertEqual(cache.misses, 4)
+
+        g.delete_key(other)
+        self.assertEqual(g.list_keys().keys(), [self.fingerprint])
+        self.assertEqual(cache.misses, 4)
+
+        # Changes made behind our back are noticed
+        self.gpg(['--import'], key_data)
+        self.assertEqual(sorted(g.list_keys().keys()),
+                         sorted([self.fingerprint, other]))
+        self.assertEqual(cache.misses, 5)
+
+
+    def test_keys_expiring(self):
+        g = self.gnupg()
+        cache = g.keyring_cache()
+        self.gpg(['--passphrase', '', '--quick-gen-key',
+                  'expiring@example.com', 'ed25519', 'sign', 'seconds=2'])
+        keys = g.list_keys(['expiring@example.com'])
+        try:
+            self.assertFalse(keys.values()[0]['expired'])
+            misses = cache.misses
+            g.list_keys(['expiring@example.com'])
+            self.assertEqual(cache.misses, misses)
+
+            # The keyring did not change, but the key expired
+            time.sleep(3)
+            keys = g.list_keys(['expiring@example.com'])
+            self.assertTrue(keys.values()[0]['expired'])
+            self.assertEqual(cache.misses, misses + 1)
+        finally:
+            self.gpg(['--yes', '--delete-secret-and-public-key',
+                      keys.keys()[0]])
+
+        # Nothing is trusted for longer than MAX_AGE
+        state = cache.keyring_state()
+        cache.MAX_AGE = 1
+        try:
+            time.sleep(1)
+            self.assertNotEqual(cache.keyring_state(), state)
+        finally:
+            del cache.MAX_AGE
+
+
+class TestGnuPGResultMemo(GnuPGTestCase):
+
+    def test_memoized_results(self):
+        data = 'Hello, memo\n'
+        signature = self.gpg(['--detach-sign', '--armor'], data)
+        encrypted = self.gpg(['--encrypt', '--armor',
+                              '-r', 'test@example.com'], data)
+        GNUPG_RESULTS.clear()
+
+        runs = []
+        g = self.gnupg()
+        real_run = g.run
+        g.run = lambda *args, **kwargs: (runs.append(args[0]) or
+                                         real_run(*args, **kwargs))
+        for i in range(0, 3):
+            si = g.verify(data, signature=signature)
+            self.assertEqual(si['status'], 'verified')
+            si['status'] = 'error'  # Results are copies, this is harmless
+            sig, enc, text = g.decrypt(encrypted)
+            self.assertEqual((enc['status'], text), ('decrypted', data))
+        self.assertEqual(len(runs), 2)
+
+        # Other data, or a changed keyring, means checking again
+        self.assertEqual(g.verify('Bogus', signature=signature)['status'],
+                         'invalid')
+        self.assertEqual(len(runs), 3)
+        self.gpg(['--quick-add-uid', self.fingerprint, 'new@example.com'])
+        g.verify(data, signature=signature)
+        self.assertEqual(len(runs), 4)
+
+        GNUPG_RESULTS.clear()
+        g.decrypt(encrypted)
+        self.assertEqual(len(runs), 5)
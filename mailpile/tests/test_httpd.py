@@ -0,0 +1,197 @@
+import cStringIO
+import gzip
+import httplib
+import mimetools
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from mailpile.httpd import HttpRequestHandler, STREAM_BLOCK_SIZE
+from mailpile.httpd import PooledHttpServer, HttpWorker
+from mailpile.tests import MailPileUnittest
+
+
+class FakeServer(object):
+    secret = 'sekrit'
+    session_cookie = 'test-session'
+
+
+class FakeUI(object):
+    html_variables = {}
+
+
+class FakeSession(object):
+    ui = FakeUI()
+
+
+class FakeConfig(object):
+    class sys(object):
+        class path(object):
+            @classmethod
+            def get(cls, host, what):
+                return 'theme'
+
+    def __init__(self, path):
+        self.path = path
+
+    def open_file(self, ftype, fpath):
+        fpath = os.path.join(self.path, fpath)
+        return fpath, open(fpath, 'rb'), None
+
+
+class FakeHandler(HttpRequestHandler):
+    def __init__(self, headers='', version='HTTP/1.1'):
+        self.headers = mimetools.Message(cStringIO.StringIO(headers))
+        self.request_version = version
+        self.server = FakeServer()
+        self.session = FakeSession()
+        self.wfile = cStringIO.StringIO()
+        self.close_connection = 0
+
+    def log_request(self, *args):
+        pass
+
+    def response(self):
+        head, body = self.wfile.getvalue().split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        headers = dict(l.split(': ', 1) for l in lines[1:])
+        if headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size, body = body.split('\r\n', 1)
+                size = int(size, 16)
+                if not size:
+                    break
+                chunks.append(body[:size])
+                body = body[size + 2:]
+            body = ''.join(chunks)
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=cStringIO.StringIO(body)).read()
+        return lines[0], headers, body
+
+
+class TestHttpResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.config = FakeConfig(self.tempdir)
+        self.big = ''.join('Line %d of a big file\n' % i
+                           for i in range(0, 2 * STREAM_BLOCK_SIZE // 10))
+        with open(os.path.join(self.tempdir, 'big.txt'), 'wb') as fd:
+            fd.write(self.big)
+
+    def test_streaming_response(self):
+        for version in ('HTTP/1.1', 'HTTP/1.0'):
+            h = FakeHandler('Accept-Encoding: gzip\r\n\r\n', version=version)
+            h.send_full_response(self.big, mimetype='text/plain')
+            status, headers, body = h.response()
+            self.assertEqual(body, self.big)
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(headers['X-Full-Size'], str(len(self.big)))
+            self.assertEqual('Transfer-Encoding' in headers,
+                             version == 'HTTP/1.1')
+            self.assertEqual(h.close_connection, version == 'HTTP/1.0')
+
+    def test_static_files(self):
+        h = FakeHandler()
+        h.send_file(self.config, 'big.txt')
+        status, headers, body = h.response()
+        self.assertEqual(body, self.big)
+        self.assertEqual(headers['Content-Length'], str(len(self.big)))
+
+        h = FakeHandler('If-None-Match: %s\r\n\r\n' % headers['ETag'])
+        h.send_file(self.config, 'big.txt')
+        status, headers, body = h.response()
+        self.assertTrue(status.endswith('304 Unmodified'))
+        self.assertEqual(body, '')
+
+        h = FakeHandler('Accept-Encoding: gzip\r\n\r\n')
+        h.send_file(self.config, 'big.txt')
+        status, headers, body = h.response()
+        self.assertEqual(body, self.big)
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+
+    def test_precompressed_static_files(self):
+        with gzip.GzipFile(os.path.join(self.tempdir, 'big.txt.gz'),
+                           'wb') as fd:
+            fd.write(self.big)
+        h = FakeHandler('Accept-Encoding: gzip\r\n\r\n')
+        h.send_file(self.config, 'big.txt')
+        status, headers, body = h.response()
+        self.assertEqual(body, self.big)
+        self.assertEqual(headers['Content-Length'], str(
+            os.path.getsize(os.path.join(self.tempdir, 'big.txt.gz'))))
+        self.assertFalse('Transfer-Encoding' in headers)
+
+
+class TestPooledHttpServer(MailPileUnittest):
+
+    def setUp(self):
+        self.config.sys.http_workers = 2
+        self.worker = HttpWorker(self.mp._session, ('localhost', 0, ''))
+        self.worker.start()
+        self.httpd = self.worker.httpd
+
+    def tearDown(self):
+        self.config.sys.http_workers = 0
+        self.worker.quit(join=True)
+        self.worker.join()
+
+    def test_classify(self):
+        for line, priority in (
+                ('GET /static/css/default.css HTTP/1.1', self.httpd.STATIC),
+                ('GET /api/0/cached/1234/ HTTP/1.1', self.httpd.BACKGROUND),
+                ('GET /api/0/logs/events/?wait=30 HTTP/1.1',
+                 self.httpd.BACKGROUND),
+                ('GET /api/0/search/?q=foo HTTP/1.1', self.httpd.INTERACTIVE),
+                ('POST /settings/set/ HTTP/1.1', self.httpd.INTERACTIVE),
+                ('BOGUS', self.httpd.INTERACTIVE)):
+            self.assertEqual(self.httpd.classify(line), priority)
+
+    def test_keepalive(self):
+        self.assertTrue(isinstance(self.httpd, PooledHttpServer))
+        conn = httplib.HTTPConnection('localhost', self.httpd.sspec[1],
+                                      timeout=10)
+        try:
+            for i in range(0, 3):
+                conn.request('GET', '/static/img/favicon.png')
+                response = conn.getresponse()
+                self.assertEqual(response.status, 200)
+                self.assertTrue(len(response.read()) > 0)
+        finally:
+            conn.close()
+        stats = self.httpd.stats()
+        # All three requests were served over a single connection
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['priorities']['static']['requests'], 3)
+        self.assertEqual(stats['workers'], 2)
+
+    def test_slow_clients(self):
+        self.httpd.HEADER_TIMEOUT = 1
+        slow = []
+        try:
+            # More slow clients than workers, none finishing their headers
+            for i in range(0, 3):
+                sock = socket.create_connection(
+                    ('localhost', self.httpd.sspec[1]), timeout=10)
+                sock.sendall('GET /static/img/favicon.png HTTP/1.1\r\n'
+                             'Host: localhost\r\n')
+                slow.append(sock)
+            time.sleep(0.2)
+            self.assertEqual(sum(self.httpd.stats()['busy'].values()), 0)
+
+            # ... do not keep anyone else waiting
+            conn = httplib.HTTPConnection('localhost', self.httpd.sspec[1],
+                                          timeout=5)
+            conn.request('GET', '/static/img/favicon.png')
+            self.assertEqual(conn.getresponse().status, 200)
+            conn.close()
+
+            # ... and get disconnected once they have taken too long.
+            for sock in slow:
+                self.assertEqual(sock.recv(1024), '')
+        finally:
+            for sock in slow:
+                sock.close()
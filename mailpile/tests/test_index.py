@@ -0,0 +1,675 @@
+import cStringIO
+import os
+import random
+import time
+import unittest
+
+from mailpile.index.columnar import ColumnarRows
+from mailpile.index.intset import IntSet
+from mailpile.index.mapped import CompactHashMap, MappedRows
+import mailpile.index.parallel
+from mailpile.index.parallel import ParallelMessageReader
+from mailpile.index.search import CachedSearchResultSet, SEARCH_RESULT_CACHE
+from mailpile.index.search import SEARCH_RESULT_CACHE_SERIAL
+from mailpile.index.segments import SegmentStore
+from mailpile.mailutils import MBX_ID_LEN
+from mailpile.mailutils.emails import ParseMessage
+from mailpile.postinglist import GlobalPostingList, PostingList
+from mailpile.postinglist import PLC_CACHE, PLC_CACHE_LOCK
+from mailpile.postinglist import PLC_CACHE_FlushAndClean
+from mailpile.search import MailIndex
+from mailpile.tests import MailPileUnittest, get_mailpile_root
+from mailpile.util import b36
+
+
+class TestColumnarIndex(MailPileUnittest):
+
+    def setUp(self):
+        self.config.sys.index_columnar = True
+        self.idx = self.config.index
+
+    def tearDown(self):
+        self.config.sys.index_columnar = False
+        try:
+            os.remove(self.idx.columnar_index_file())
+        except OSError:
+            pass
+
+    def _reload(self):
+        new_idx = MailIndex(self.config)
+        new_idx.load(self.session)
+        return new_idx
+
+    def test_snapshot_roundtrip(self):
+        self.idx.save(self.session)
+        self.assertTrue(os.path.exists(self.idx.columnar_index_file()))
+
+        new_idx = self._reload()
+        self.assertTrue(isinstance(new_idx.INDEX, ColumnarRows))
+        self.assertEqual(len(new_idx.INDEX), len(self.idx.INDEX))
+        for i in range(0, len(self.idx.INDEX)):
+            self.assertEqual(new_idx.get_msg_at_idx_pos(i),
+                             self.idx.get_msg_at_idx_pos(i))
+            self.assertEqual(new_idx.INDEX[i], self.idx.INDEX[i])
+        self.assertEqual(new_idx.INDEX_THR, self.idx.INDEX_THR)
+        self.assertEqual(new_idx.INDEX_SORT['date'],
+                         self.idx.INDEX_SORT['date'])
+        self.assertEqual(new_idx.MSGIDS, self.idx.MSGIDS)
+        self.assertEqual(new_idx.EMAILS, self.idx.EMAILS)
+        for tid, members in self.idx.TAGS.iteritems():
+            self.assertEqual(new_idx.TAGS.get(tid, set()), members)
+
+    def test_snapshot_replays_appended_changes(self):
+        self.idx.save(self.session)
+
+        msg_info = self.idx.get_msg_at_idx_pos(0)
+        subject = msg_info[self.idx.MSG_SUBJECT]
+        try:
+            msg_info[self.idx.MSG_SUBJECT] = u'Changed after the snapshot'
+            self.idx.set_msg_at_idx_pos(0, msg_info)
+            self.idx.save_changes(self.session)
+
+            new_idx = self._reload()
+            self.assertTrue(isinstance(new_idx.INDEX, ColumnarRows))
+            self.assertEqual(
+                new_idx.get_msg_at_idx_pos(0)[self.idx.MSG_SUBJECT],
+                u'Changed after the snapshot')
+        finally:
+            msg_info[self.idx.MSG_SUBJECT] = subject
+            self.idx.set_msg_at_idx_pos(0, msg_info)
+            self.idx.save_changes(self.session)
+
+
+class TestMappedIndex(MailPileUnittest):
+
+    def setUp(self):
+        self.config.sys.index_mapped = True
+        self.idx = self.config.index
+
+    def tearDown(self):
+        self.config.sys.index_mapped = False
+
+    def _reload(self):
+        new_idx = MailIndex(self.config)
+        new_idx.load(self.session)
+        return new_idx
+
+    def test_mapped_load(self):
+        self.idx.save(self.session)
+        new_idx = self._reload()
+        self.assertTrue(isinstance(new_idx.INDEX, MappedRows))
+        self.assertTrue(isinstance(new_idx.PTRS, CompactHashMap))
+        self.assertEqual(new_idx.INDEX.changed(), [])
+        self.assertEqual(list(new_idx.INDEX), list(self.idx.INDEX))
+        self.assertEqual(new_idx.INDEX_THR, self.idx.INDEX_THR)
+        self.assertEqual(new_idx.INDEX_SORT['date'],
+                         self.idx.INDEX_SORT['date'])
+        for tid, members in self.idx.TAGS.iteritems():
+            self.assertEqual(new_idx.TAGS.get(tid, set()), members)
+        self.assertEqual(len(new_idx.MSGIDS), len(self.idx.MSGIDS))
+        for msg_id, pos in self.idx.MSGIDS.iteritems():
+            self.assertEqual(new_idx.MSGIDS[msg_id], pos)
+
+        self.config.sys.index_mapped = False
+        plain_idx = self._reload()
+        for msg_ptr, pos in plain_idx.PTRS.iteritems():
+            self.assertEqual(new_idx.PTRS[msg_ptr], pos)
+        # Only pointers the rows still refer to can be listed
+        listed = list(new_idx.PTRS.iteritems())
+        self.assertTrue(listed)
+        for msg_ptr, pos in listed:
+            self.assertEqual(plain_idx.PTRS[msg_ptr], pos)
+
+    def test_mapped_changes(self):
+        self.idx.save(self.session)
+        new_idx = self._reload()
+        msg_info = new_idx.get_msg_at_idx_pos(0)
+        subject = msg_info[new_idx.MSG_SUBJECT]
+        try:
+            msg_info[new_idx.MSG_SUBJECT] = u'Changed after mapping'
+            new_idx.set_msg_at_idx_pos(0, msg_info)
+            new_idx.MODIFIED.add(0)
+            self.assertEqual(new_idx.INDEX.changed(), [0])
+            new_idx.save_changes(self.session)
+            self.assertEqual(
+                self._reload().get_msg_at_idx_pos(0)[new_idx.MSG_SUBJECT],
+                u'Changed after mapping')
+
+            # Writing a new index releases the changed rows
+            new_idx.save(self.session)
+            self.assertEqual(new_idx.INDEX.changed(), [])
+            self.assertEqual(new_idx.INDEX[0], new_idx.m2l(msg_info))
+        finally:
+            msg_info[new_idx.MSG_SUBJECT] = subject
+            new_idx.set_msg_at_idx_pos(0, msg_info)
+            new_idx.save(self.session)
+
+
+class TestCompactHashMap(unittest.TestCase):
+
+    def test_matches_dict(self):
+        chm, model = CompactHashMap(), {}
+        chm.MIN_PENDING = 50
+        chm.COPY_CHUNK = 7
+        rand = random.Random(4)
+        for i in range(0, 5000):
+            key = 'key-%d' % rand.randint(0, 1000)
+            if key in model and rand.random() < 0.3:
+                del chm[key]
+                del model[key]
+            else:
+                chm[key] = model[key] = rand.randint(0, 10000)
+            if i % 1000 == 0:
+                chm.compact()
+        chm.compact()
+        self.assertEqual(len(chm), len(model))
+        self.assertEqual(len(chm._hashes), len(model))
+        self.assertEqual(list(chm._hashes), sorted(chm._hashes))
+        for i in range(0, 1001):
+            key = 'key-%d' % i
+            self.assertEqual(chm.get(key), model.get(key))
+
+
+class TestIntSet(unittest.TestCase):
+
+    def test_operations(self):
+        rnd = random.Random(1)
+        for na, nb in ((1000, 1000), (1000, 20), (20, 1000), (0, 10)):
+            a = rnd.sample(xrange(0, 3000), na)
+            b = rnd.sample(xrange(0, 3000), nb)
+            ia, ib = IntSet(a), IntSet(b)
+            self.assertEqual(list(ia | ib), sorted(set(a) | set(b)))
+            self.assertEqual(list(ia & ib), sorted(set(a) & set(b)))
+            self.assertEqual(list(ia - ib), sorted(set(a) - set(b)))
+            self.assertEqual(list(ib - ia), sorted(set(b) - set(a)))
+
+    def test_large_and_small(self):
+        # Merging a small set into a big one used to insert (or delete)
+        # one element at a time, which took seconds at this size.
+        big = IntSet(xrange(0, 2000000, 2))
+        small = IntSet(random.Random(2).sample(xrange(0, 2000000), 60000))
+        t0 = time.time()
+        union, difference = big | small, big - small
+        self.assertTrue(time.time() - t0 < 1.5)
+        self.assertEqual(len(union) + len(difference),
+                         2 * len(big) + len(small) - 2 * len(big & small))
+        self.assertEqual(len(big & small), len(small) - len(small - big))
+
+
+class TestPostingLists(MailPileUnittest):
+
+    def test_compact_posting_lists_roundtrip(self):
+        words = ['brennan', 'subject:moderation', 'attachment:has']
+        before = dict((w, GlobalPostingList(self.session, w).hits())
+                      for w in words)
+        self.assertTrue(all(isinstance(h, IntSet) for h in before.values()))
+
+        # Migrate the journal to posting list containers, write them out
+        # and load them back in again from disk.
+        GlobalPostingList.Optimize(self.session, self.config.index,
+                                   force=True)
+        PLC_CACHE_FlushAndClean(self.session, keep=0)
+        with PLC_CACHE_LOCK:
+            PLC_CACHE.clear()
+
+        for w in words:
+            self.assertEqual(GlobalPostingList(self.session, w).hits(),
+                             before[w])
+            self.assertEqual(PostingList(self.session, w).hits(), before[w])
+
+    def test_estimate_without_loading(self):
+        words = ['brennan', 'subject:moderation', 'attachment:has']
+        GlobalPostingList.Optimize(self.session, self.config.index,
+                                   force=True)
+        PLC_CACHE_FlushAndClean(self.session, keep=0)
+        with PLC_CACHE_LOCK:
+            PLC_CACHE.clear()
+
+        # Estimates are upper bounds for each term (not the size of the
+        # whole container), and do not load any containers
+        estimates = dict((w, GlobalPostingList(self.session, w).estimate())
+                         for w in words + ['notawordatall'])
+        with PLC_CACHE_LOCK:
+            self.assertEqual(len(PLC_CACHE), 0)
+        self.assertEqual(estimates['notawordatall'], 0)
+        for w in words:
+            hits = GlobalPostingList(self.session, w).hits()
+            self.assertTrue(2 * len(hits) + 3 >= estimates[w] >= len(hits))
+
+        # Once a container is cached, its estimates are exact
+        for w in words:
+            self.assertEqual(GlobalPostingList(self.session, w).estimate(),
+                             len(GlobalPostingList(self.session, w).hits()))
+
+
+class TestSearchCache(MailPileUnittest):
+
+    def setUp(self):
+        self.idx = self.config.index
+        self.inbox = self.config.get_tag('Inbox')._key
+        self.new = self.config.get_tag('New')._key
+        CachedSearchResultSet.DropCaches()
+
+    def _search(self, terms):
+        return self.idx.search(self.session, terms[:]).as_set()
+
+    def _toggle(self, tag_id, msg_idx):
+        if msg_idx in self.idx.TAGS.get(tag_id, set()):
+            self.idx.remove_tag(self.session, tag_id, msg_idxs=[msg_idx])
+        else:
+            self.idx.add_tag(self.session, tag_id, msg_idxs=[msg_idx])
+
+    def test_granular_invalidation(self):
+        msg_idx = min(self._search(['all:mail']))
+        inbox = self._search(['in:inbox'])
+        stats = CachedSearchResultSet.CacheStats()
+        try:
+            # Changing an unrelated tag leaves the cached result alone
+            self._toggle(self.new, msg_idx)
+            self.assertEqual(self._search(['in:inbox']), inbox)
+            self.assertEqual(CachedSearchResultSet.CacheStats()['hits'],
+                             stats['hits'] + 1)
+
+            # Changing the tag we searched for does not
+            self._toggle(self.inbox, msg_idx)
+            self.assertEqual(self._search(['in:inbox']) ^ inbox,
+                             set([msg_idx]))
+            self.assertEqual(CachedSearchResultSet.CacheStats()['misses'],
+                             stats['misses'] + 1)
+        finally:
+            self._toggle(self.inbox, msg_idx)
+            self._toggle(self.new, msg_idx)
+        self.assertEqual(self._search(['in:inbox']), inbox)
+
+    def test_lru_eviction(self):
+        old_max = CachedSearchResultSet.MAX_ENTRIES
+        try:
+            CachedSearchResultSet.MAX_ENTRIES = 2
+            for term in ('brennan', 'twitter', 'agirorn'):
+                self._search([term])
+                time.sleep(0.01)
+            stats = CachedSearchResultSet.CacheStats()
+            self.assertEqual(stats['entries'], 2)
+            self.assertTrue(stats['evictions'] >= 1)
+            self.assertFalse(' brennan' in SEARCH_RESULT_CACHE)
+        finally:
+            CachedSearchResultSet.MAX_ENTRIES = old_max
+
+
+class TestMetadataCache(MailPileUnittest):
+
+    def setUp(self):
+        self.idx = self.config.index
+
+    def test_lru_and_stats(self):
+        cache = self.idx.CACHE
+        old_max = cache.max_entries
+        try:
+            cache.clear()
+            cache.resize(max_entries=2)
+            before = cache.stats()
+            for msg_idx in (0, 1, 0, 2):
+                self.idx.get_msg_at_idx_pos(msg_idx)
+            stats = cache.stats()
+            self.assertEqual(sorted(cache.keys()), [0, 2])
+            self.assertEqual(stats['hits'] - before['hits'], 1)
+            self.assertEqual(stats['misses'] - before['misses'], 3)
+            self.assertEqual(stats['evictions'] - before['evictions'], 1)
+            self.assertTrue(stats['bytes'] > 0)
+
+            result = self.mp.caches().as_dict()['result']
+            self.assertTrue('metadata' in [s['name'] for s in result])
+            self.assertTrue('parse' in [s['name'] for s in result])
+        finally:
+            cache.resize(max_entries=old_max)
+
+
+class TestBulkTagging(MailPileUnittest):
+
+    def setUp(self):
+        self.idx = self.config.index
+        self.inbox = self.config.get_tag('Inbox')._key
+        self.new = self.config.get_tag('New')._key
+
+    def _row_tags(self, msg_idx):
+        self.idx.CACHE.pop(msg_idx, None)
+        return set(self.idx.get_tags(msg_idx=msg_idx))
+
+    def test_conversation_expansion(self):
+        idx = self.idx
+        for msg_idx in range(0, len(idx.INDEX)):
+            looked_up = idx._conversation_msg_idxs([msg_idx])
+            idx.BULK_TAG_SCAN_THREADS = 0
+            try:
+                scanned = idx._conversation_msg_idxs([msg_idx])
+            finally:
+                del idx.BULK_TAG_SCAN_THREADS
+            self.assertTrue(msg_idx in looked_up)
+            self.assertEqual(looked_up, scanned)
+
+    def test_bulk_tag(self):
+        msg_idxs = set(range(0, len(self.idx.INDEX)))
+        inbox = set(self.idx.TAGS.get(self.inbox, set()))
+        new = set(self.idx.TAGS.get(self.new, set()))
+        serial = SEARCH_RESULT_CACHE_SERIAL[0]
+        try:
+            results = self.idx.bulk_tag(self.session, msg_idxs,
+                                        add_tags=[self.new],
+                                        remove_tags=[self.inbox])
+            self.assertEqual(results[self.new], (msg_idxs - new, set()))
+            self.assertEqual(results[self.inbox], (set(), inbox))
+            self.assertEqual(SEARCH_RESULT_CACHE_SERIAL[0], serial + 1)
+            self.assertEqual(self.idx.TAGS[self.new], msg_idxs)
+            self.assertEqual(self.idx.TAGS[self.inbox], set())
+
+            # Rows are rewritten lazily, on access or when saving
+            self.assertTrue(self.idx.STALE_TAG_ROWS)
+            for msg_idx in inbox:
+                tags = self._row_tags(msg_idx)
+                self.assertTrue(self.new in tags)
+                self.assertFalse(self.inbox in tags)
+            self.idx.save_changes(self.session)
+            self.assertFalse(self.idx.STALE_TAG_ROWS)
+            self.assertEqual(
+                self.idx.search(self.session, ['in:inbox']).as_set(), set())
+        finally:
+            self.idx.bulk_tag(self.session, msg_idxs - new,
+                              remove_tags=[self.new])
+            self.idx.bulk_tag(self.session, inbox, add_tags=[self.inbox])
+            self.idx.save_changes(self.session)
+        self.assertEqual(self.idx.TAGS[self.inbox], inbox)
+        self.assertEqual(self.idx.TAGS[self.new], new)
+        for msg_idx in msg_idxs:
+            self.assertEqual(self.inbox in self._row_tags(msg_idx),
+                             msg_idx in inbox)
+
+
+def _StallingParse(job):
+    time.sleep(30)
+
+
+class TestParallelScan(MailPileUnittest):
+
+    def setUp(self):
+        self.idx = self.config.index
+        self.maildir = os.path.join(get_mailpile_root(), 'mailpile', 'tests',
+                                    'data', 'Maildir', 'cur')
+
+    def _serial_read(self, data):
+        msg_fd = cStringIO.StringIO(data)
+        msg = ParseMessage(msg_fd, pgpmime='all', config=self.config)
+        return msg_fd.tell(), self.idx.read_message_parts(
+            self.session, 'new', self.idx.get_msg_id(msg, ''), msg)
+
+    def test_parallel_read_matches_serial(self):
+        jobs = []
+        for fn in sorted(os.listdir(self.maildir)):
+            if fn.startswith('.'):
+                continue
+            with open(os.path.join(self.maildir, fn), 'rb') as fd:
+                jobs.append((fn, fd.read()))
+
+        reader = ParallelMessageReader(self.session, self.idx, 2)
+        try:
+            results = reader.read(jobs)
+        finally:
+            reader.close()
+
+        self.assertEqual(sorted(results.keys()), [fn for fn, d in jobs])
+        for fn, data in jobs:
+            msg, msg_bytes, msg_parts = results[fn]
+            self.assertEqual((msg_bytes, msg_parts), self._serial_read(data))
+
+    def test_stalled_workers(self):
+        parse = mailpile.index.parallel._ParseAndRead
+        try:
+            # Workers are forked with whatever is in place at the time
+            mailpile.index.parallel._ParseAndRead = _StallingParse
+            reader = ParallelMessageReader(self.session, self.idx, 2)
+            reader.STALL_TIMEOUT = 0.5
+        finally:
+            mailpile.index.parallel._ParseAndRead = parse
+        try:
+            self.assertEqual(reader.read([('a', 'data'), ('b', 'data')]), {})
+            self.assertTrue(reader.stalled)
+            self.assertEqual(reader.read([('c', 'data')]), {})
+        finally:
+            reader.close()
+
+    def test_rescan_in_parallel(self):
+        msg_info = self.idx.get_msg_at_idx_pos(0)
+        original = msg_info[:]
+        mbx_id = msg_info[self.idx.MSG_PTRS].split(',')[0][:MBX_ID_LEN]
+        mbx_path = [fp for fid, fp, sc in self.config.get_mailboxes()
+                    if fid == mbx_id][0]
+        try:
+            self.config.sys.scan_processes = 2
+            msg_info[self.idx.MSG_BODY] = self.idx.MSG_BODY_GHOST
+            self.idx.set_msg_at_idx_pos(0, msg_info)
+
+            added = self.idx.scan_mailbox(self.session, mbx_id, mbx_path,
+                                          self.config.open_mailbox,
+                                          force=True)
+            self.assertEqual(added, 1)
+            self.assertEqual(
+                self.idx.get_msg_at_idx_pos(0)[self.idx.MSG_BODY],
+                original[self.idx.MSG_BODY])
+        finally:
+            self.config.sys.scan_processes = 0
+            self.idx.set_msg_at_idx_pos(0, original)
+
+    def test_rescan_with_crypto_batch(self):
+        msg_info = self.idx.get_msg_at_idx_pos(0)
+        original = msg_info[:]
+        mbx_id = msg_info[self.idx.MSG_PTRS].split(',')[0][:MBX_ID_LEN]
+        mbx_path = [fp for fid, fp, sc in self.config.get_mailboxes()
+                    if fid == mbx_id][0]
+        reads, mboxes = [], []
+
+        def opener(*args, **kwargs):
+            mbox = self.config.open_mailbox(*args, **kwargs)
+            get_file = mbox.get_file
+            def counting_get_file(key, *args, **kwargs):
+                reads.append(key)
+                return get_file(key, *args, **kwargs)
+            mbox.get_file = counting_get_file
+            mboxes.append(mbox)
+            return mbox
+
+        index_encrypted = self.config.prefs.index_encrypted
+        try:
+            self.config.prefs.index_encrypted = True
+            msg_info[self.idx.MSG_BODY] = self.idx.MSG_BODY_GHOST
+            self.idx.set_msg_at_idx_pos(0, msg_info)
+
+            added = self.idx.scan_mailbox(self.session, mbx_id, mbx_path,
+                                          opener, force=True)
+            self.assertEqual(added, 1)
+            self.assertEqual(
+                self.idx.get_msg_at_idx_pos(0)[self.idx.MSG_BODY],
+                original[self.idx.MSG_BODY])
+
+            # Messages checked ahead of time are only read once
+            self.assertTrue(reads)
+            self.assertEqual(len(reads), len(set(reads)))
+        finally:
+            for mbox in mboxes:
+                del mbox.get_file
+            self.config.prefs.index_encrypted = index_encrypted
+            self.idx.set_msg_at_idx_pos(0, original)
+
+
+class TestSegments(MailPileUnittest):
+
+    def setUp(self):
+        self.config.sys.index_segments = True
+
+    def tearDown(self):
+        self.config.sys.index_segments = False
+
+    def test_flush_and_merge_segments(self):
+        words = ['brennan', 'subject:moderation', 'attachment:has', 'twitter']
+        before = dict((w, GlobalPostingList(self.session, w).hits())
+                      for w in words)
+
+        GlobalPostingList.Optimize(self.session, self.config.index,
+                                   force=True)
+        store = SegmentStore.ForConfig(self.config)
+        self.assertTrue(store is not None)
+        self.assertTrue(store.stats()['segments'] >= 1)
+        for w in words:
+            sig = GlobalPostingList.WordSig(w, self.config)
+            self.assertFalse(GlobalPostingList(self.session, w).WORDS.get(sig))
+            self.assertEqual(GlobalPostingList(self.session, w).hits(),
+                             before[w])
+
+        # Pile up enough segments to trigger a merge
+        for i in range(0, store.fanout):
+            GlobalPostingList.Append(self.session, 'segmenttest', [b36(i)])
+            GlobalPostingList.Optimize(self.session, self.config.index,
+                                       force=True)
+        stats = store.stats()
+        self.assertTrue(stats['merges'] >= 1)
+        self.assertTrue(stats['write_amplification'] > 1.0)
+        self.assertTrue(stats['open_files'] <= store.max_open_files)
+        self.assertEqual(
+            list(GlobalPostingList(self.session, 'segmenttest').hits()),
+            range(0, store.fanout))
+        for w in words:
+            self.assertEqual(GlobalPostingList(self.session, w).hits(),
+                             before[w])
+
+
+class TestSorting(MailPileUnittest):
+
+    def setUp(self):
+        self.idx = self.config.index
+        self.new = self.config.get_tag('New')._key
+        self.all = range(0, len(self.idx.INDEX))
+
+    def _sorted(self, how):
+        results = self.all[:]
+        self.idx.sort_results(self.session, results, how)
+        return results
+
+    def test_sort_by_strings(self):
+        def subject(i):
+            return self.idx.SORT_STRINGS['subject'](
+                self.idx.get_msg_at_idx_pos(i)[self.idx.MSG_SUBJECT])
+        results = self._sorted('flat-subject')
+        self.assertEqual(sorted(results), self.all)
+        self.assertEqual([subject(i) for i in results],
+                         sorted(subject(i) for i in self.all))
+        self.assertEqual(self.idx.SORT_STRINGS['subject'](u'Re: FWD: Hi'),
+                         u'hi')
+
+        results = self._sorted('flat-from')
+        senders = [self.idx.SORT_STRINGS['from'](
+                       self.idx.get_msg_at_idx_pos(i)[self.idx.MSG_FROM])
+                   for i in results]
+        self.assertEqual(senders, sorted(senders))
+
+    def test_non_ascii_sort_strings(self):
+        def subject(idx, i):
+            ms = idx.get_msg_at_idx_pos(i)[idx.MSG_SUBJECT]
+            if isinstance(ms, str):
+                ms = ms.decode('utf-8')
+            return idx.SORT_STRINGS['subject'](ms)
+        infos = [self.idx.get_msg_at_idx_pos(i) for i in (0, 1)]
+        subjects = [mi[self.idx.MSG_SUBJECT] for mi in infos]
+        try:
+            infos[0][self.idx.MSG_SUBJECT] = u'\xc9clair recipes'
+            self.idx.set_msg_at_idx_pos(0, infos[0])
+            self.idx.save(self.session)
+
+            # Strings loaded from disk and strings set later must mix
+            for mapped in (False, True):
+                self.config.sys.index_mapped = mapped
+                new_idx = MailIndex(self.config)
+                new_idx.load(self.session)
+                infos[1][new_idx.MSG_SUBJECT] = u'\xe9clair \u2603'
+                new_idx.set_msg_at_idx_pos(1, infos[1])
+
+                paged = new_idx.sort_page(self.session, self.all[:],
+                                          'flat-subject', 2)
+                paged.sort_upto(len(paged))
+                self.assertEqual([subject(new_idx, i) for i in paged],
+                                 sorted(subject(new_idx, i)
+                                        for i in self.all))
+                self.assertEqual(
+                    new_idx.INDEX_SORT['subject'][0] + 1,
+                    new_idx.INDEX_SORT['subject'][1])
+        finally:
+            self.config.sys.index_mapped = False
+            for i, mi in enumerate(infos):
+                mi[self.idx.MSG_SUBJECT] = subjects[i]
+                self.idx.set_msg_at_idx_pos(i, mi)
+            self.idx.save(self.session)
+
+    def test_collapse_threads(self):
+        def slow_collapse(results, unread):
+            seen, collapsed = {}, []
+            for ri in results:
+                ti = self.idx.INDEX_THR[ri]
+                if ti not in seen:
+                    seen[ti] = len(collapsed)
+                    collapsed.append(ri)
+                elif ri in unread:
+                    collapsed[seen[ti]] = ri
+            return collapsed
+
+        results = self._sorted('flat-date')
+        unread = self.idx.unread_msg_idxs(self.session)
+        self.assertEqual(self._sorted('date'),
+                         slow_collapse(results, set()))
+        self.assertEqual(self.idx.collapse_threads(results[:], unread),
+                         slow_collapse(results, unread))
+
+    def test_sort_page(self):
+        dates = self.idx.INDEX_SORT['date']
+        for how in ('rev-date', 'flat-date', 'flat-rev-date', 'date'):
+            expected = self._sorted(how)
+            paged = self.idx.sort_page(self.session, self.all[:], how, 2)
+            self.assertTrue(paged.sorted_upto < len(paged))
+            self.assertEqual(len(paged), len(expected))
+            self.assertEqual(set(paged), set(expected))
+            page_two = paged[2:4]
+            self.assertTrue(paged.sorted_upto < len(paged))
+            self.assertEqual([dates[i] for i in paged[:2] + page_two],
+                             [dates[i] for i in expected[:4]])
+            self.assertEqual([dates[i] for i in paged[-1:]],
+                             [dates[i] for i in expected[-1:]])
+            self.assertEqual(paged.sorted_upto, len(paged))
+            self.assertEqual(
+                set(self.idx.INDEX_THR[i] for i in paged),
+                set(self.idx.INDEX_THR[i] for i in expected))
+
+    def test_resort_page(self):
+        # Order re-sorts session.results, which may be a partially
+        # sorted list from sort_page.
+        dates = self.idx.INDEX_SORT['date']
+        paged = self.idx.sort_page(self.session, self.all[:], 'flat-date', 2)
+        self.idx.sort_results(self.session, paged, 'rev-date')
+        expected = self._sorted('rev-date')
+        self.assertEqual([dates[i] for i in paged],
+                         [dates[i] for i in expected])
+
+    def test_unread_cache(self):
+        msg_idx = self.all[0]
+        unread = self.idx.unread_msg_idxs(self.session)
+        self.assertTrue(unread is self.idx.unread_msg_idxs(self.session))
+        was_unread = msg_idx in unread
+        try:
+            if was_unread:
+                self.idx.remove_tag(self.session, self.new, msg_idxs=[msg_idx])
+            else:
+                self.idx.add_tag(self.session, self.new, msg_idxs=[msg_idx])
+            self.assertNotEqual(
+                msg_idx in self.idx.unread_msg_idxs(self.session), was_unread)
+        finally:
+            if was_unread:
+                self.idx.add_tag(self.session, self.new, msg_idxs=[msg_idx])
+            else:
+                self.idx.remove_tag(self.session, self.new, msg_idxs=[msg_idx])
+        self.assertEqual(msg_idx in self.idx.unread_msg_idxs(self.session),
+                         was_unread)
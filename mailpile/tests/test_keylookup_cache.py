@@ -0,0 +1,139 @@
+import threading
+import time
+
+from mailpile.crypto.keyinfo import KeyUID, MailpileKeyInfo
+from mailpile.plugins.keylookup import KEY_LOOKUP_HANDLERS, LookupHandler
+from mailpile.plugins.keylookup import KeyLookupCache, lookup_crypto_keys
+from mailpile.plugins.keylookup import LoadKeyLookupCache
+from mailpile.plugins.keylookup import register_crypto_key_lookup_handler
+from mailpile.tests import MailPileUnittest
+from mailpile.util import TimedOut
+
+
+def _key(fingerprint, email):
+    return MailpileKeyInfo(fingerprint=fingerprint, capabilities='E',
+                           validity='-', keysize=4096, keytype_name='RSA',
+                           uids=[KeyUID(name=u'Stand-in', email=email)])
+
+
+class StandInLookupHandler(LookupHandler):
+    """Looks up keys in a dict, keeping track of how often it is asked."""
+    NAME = 'Stand-in keys'
+    SHORTNAME = 'standin'
+    LOCAL = True
+    PRIVACY_FRIENDLY = True
+    TIMEOUT = 5
+    CACHE_TTL = 60
+    NEGATIVE_TTL = 10
+
+    KEYS = {'alice@example.com': _key('A' * 40, 'alice@example.com')}
+    DELAY = 0
+    CALLS = []
+
+    def _score(self, key):
+        return (3, 'Found key in stand-in')
+
+    def _lookup(self, address, strict_email_match=False):
+        self.CALLS.append(address)
+        time.sleep(self.DELAY)
+        if address == 'broken@example.com':
+            raise ValueError('Stand-in failure')
+        key = self.KEYS.get(address)
+        return {key.fingerprint: MailpileKeyInfo(key)} if key else {}
+
+
+class SlowLookupHandler(StandInLookupHandler):
+    NAME = 'Slow stand-in keys'
+    SHORTNAME = 'slow'
+    DELAY = 0.3
+
+
+class TestKeyLookupCache(MailPileUnittest):
+
+    def setUp(self):
+        StandInLookupHandler.CALLS[:] = []
+        self.cache = KeyLookupCache()
+
+    def _lookup(self, address, handler=StandInLookupHandler, timeout=5):
+        return self.cache.lookup(handler(None, {}), address, timeout)
+
+    def test_positive_and_negative(self):
+        for i in range(0, 3):
+            found = self._lookup('alice@example.com')
+            self.assertEqual(found.keys(), ['A' * 40])
+            self.assertEqual(found['A' * 40].scores,
+                             {'Stand-in keys': [3, 'Found key in stand-in']})
+            found['A' * 40].origins.append('mangled')  # Copies, harmless
+            self.assertEqual(self._lookup('bob@example.com'), {})
+            if i == 0:
+                # Failures are reported once, then remembered as negatives
+                self.assertRaises(ValueError, self._lookup,
+                                  'broken@example.com')
+            else:
+                self.assertEqual(self._lookup('broken@example.com'), {})
+        self.assertEqual(StandInLookupHandler.CALLS, ['alice@example.com',
+                                                      'bob@example.com',
+                                                      'broken@example.com'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (6, 3))
+
+        # Negative results expire sooner than positive ones
+        now = time.time()
+        for (name, address, strict), (expires, results) in (
+                self.cache.entries.items()):
+            ttl = 60 if results else 10
+            self.assertTrue(now < expires <= now + ttl)
+            self.cache.entries[(name, address, strict)] = (now, results)
+        self.assertEqual(self._lookup('alice@example.com').keys(), ['A' * 40])
+        self.assertEqual(len(StandInLookupHandler.CALLS), 4)
+
+        self.cache.prune()
+        self.assertEqual(len(self.cache.entries), 1)
+
+    def test_concurrent_lookups(self):
+        results = []
+        def lookup():
+            results.append(self._lookup('alice@example.com',
+                                        handler=SlowLookupHandler))
+        threads = [threading.Thread(target=lookup) for i in range(0, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(StandInLookupHandler.CALLS, ['alice@example.com'])
+        self.assertEqual([r.keys() for r in results], [['A' * 40]] * 5)
+
+    def test_timeouts(self):
+        self.assertRaises(TimedOut, self._lookup, 'alice@example.com',
+                          handler=SlowLookupHandler, timeout=0.05)
+        # The lookup carries on in the background and is not repeated
+        self.assertRaises(TimedOut, self._lookup, 'alice@example.com',
+                          handler=SlowLookupHandler, timeout=0.05)
+        time.sleep(0.5)
+        self.assertEqual(self._lookup('alice@example.com',
+                                      handler=SlowLookupHandler).keys(),
+                         ['A' * 40])
+        self.assertEqual(StandInLookupHandler.CALLS, ['alice@example.com'])
+
+    def test_lookup_crypto_keys(self):
+        config = self.mp._session.config
+        register_crypto_key_lookup_handler(StandInLookupHandler)
+        try:
+            for i in range(0, 2):
+                keys = lookup_crypto_keys(self.mp._session,
+                                          'alice@example.com',
+                                          origins=['standin'])
+                self.assertEqual([k.fingerprint for k in keys], ['A' * 40])
+                self.assertEqual(keys[0].origins, ['Stand-in keys'])
+        finally:
+            KEY_LOOKUP_HANDLERS.remove(StandInLookupHandler)
+        self.assertEqual(StandInLookupHandler.CALLS, ['alice@example.com'])
+
+        # The cache was saved, and survives a restart
+        self.assertTrue(LoadKeyLookupCache(config) is config.keylookup_cache)
+        self.assertFalse(config.keylookup_cache.changed)
+        klc = KeyLookupCache(config.load_pickle(KeyLookupCache.PICKLE_NAME))
+        self.assertEqual(
+            klc.lookup(StandInLookupHandler(None, {}), 'alice@example.com',
+                       5).keys(),
+            ['A' * 40])
+        self.assertEqual(StandInLookupHandler.CALLS, ['alice@example.com'])
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import mailpile
 
@@ -65,3 +67,115 @@ class TestVCard(MailPileUnittest):
         self.assertEqual(res[0], "photo")
         self.assertEqual(res[1][0], ("thing", 'comma, semicolon; backslash\\'))
         self.assertEqual(res[2], "value")
+
+
+class TestVCardSearch(MailPileUnittest):
+
+    def setUp(self):
+        self.vcards = mailpile.vcard.VCardStore(self.config,
+                                                tempfile.mkdtemp())
+        VCL, VC = mailpile.vcard.VCardLine, mailpile.vcard.MailpileVCard
+        self.dude = VC(VCL('FN:Dude'), VCL('EMAIL:d@evil.com'))
+        self.guy = VC(VCL('FN:Guy Evilsson'), VCL('NICKNAME:Gee'),
+                      VCL('KIND:group'))
+        self.vcards.add_vcards(self.dude, self.guy)
+
+    def test_find_vcards(self):
+        find = self.vcards.find_vcards
+        self.assertEqual([c.fn for c in find(['evil'])], ['Dude', 'Guy Evilsson'])
+        self.assertEqual([c.fn for c in find(['evil'], kinds=['group'])],
+                         ['Guy Evilsson'])
+        self.assertEqual([c.fn for c in find(['gu'])], ['Guy Evilsson'])
+        self.assertEqual([c.fn for c in find(['ee'])], ['Guy Evilsson'])
+        self.assertEqual([c.fn for c in find(['d@'])], ['Dude'])
+        self.assertEqual(len(find([])), 2)
+
+        self.vcards.deindex_vcard(self.dude)
+        self.dude.add(mailpile.vcard.VCardLine('EMAIL:dude@example.com'))
+        self.vcards.index_vcard(self.dude)
+        self.assertEqual([c.fn for c in find(['example.com'])], ['Dude'])
+        self.vcards.del_vcards(self.dude)
+        self.assertEqual([c.fn for c in find(['evil'])], ['Guy Evilsson'])
+
+    def test_find_vcards_with_line(self):
+        found = self.vcards.find_vcards_with_line('nickname', 'Gee')
+        self.assertEqual([c.fn for c in found], ['Guy Evilsson'])
+        self.assertEqual(self.vcards.find_vcards_with_line('fn', 'Gu'), [])
+
+    def test_find_empty_term(self):
+        VCL, VC = mailpile.vcard.VCardLine, mailpile.vcard.MailpileVCard
+        self.vcards.add_vcards(*[VC(VCL('FN:Person %d' % i),
+                                    VCL('EMAIL:p%d@example%d.com' % (i, i)))
+                                 for i in range(0, 300)])
+        # Enough tokens for the vocabulary to get packed, both before
+        # and after it has been.
+        for attempt in range(0, 2):
+            self.assertEqual(len(self.vcards.find_vcards([''])), 302)
+            self.assertEqual(len(self.vcards.find_vcards(['', 'evil'])), 2)
+            self.assertEqual(len(self.vcards.find_vcards(['person 7'])), 11)
+
+    def test_load_snapshot(self):
+        VCL, VC = mailpile.vcard.VCardLine, mailpile.vcard.MailpileVCard
+        self.vcards.add_vcards(*[VC(VCL('FN:Person %d' % i),
+                                    VCL('EMAIL:p%d@example.com' % i))
+                                 for i in range(0, 30)])
+        snapshot = os.path.join(self.vcards.vcard_dir,
+                                self.vcards.SNAPSHOT_NAME)
+
+        def reload():
+            vcards = mailpile.vcard.VCardStore(self.config,
+                                               self.vcards.vcard_dir)
+            vcards.load_vcards()
+            return vcards
+
+        # The first load reads all the files (in parallel) and writes a
+        # snapshot, which later loads can use instead.
+        for loads in range(0, 2):
+            vcards = reload()
+            self.assertTrue(os.path.exists(snapshot))
+            self.assertEqual(len(vcards.find_vcards([])), 32)
+            self.assertEqual(vcards.get_vcard('p7@example.com').fn,
+                             'Person 7')
+
+        # Changed and deleted cards are noticed
+        os.remove(self.dude.filename)
+        self.guy.fn = 'Guy Changed'
+        self.guy.save()
+        os.utime(self.guy.filename, (1, 1))
+        vcards = reload()
+        self.assertEqual(len(vcards.find_vcards([])), 31)
+        self.assertEqual(vcards.find_vcards(['guy'])[0].fn, 'Guy Changed')
+        self.assertEqual(vcards.get_vcard('d@evil.com'), None)
+        self.assertEqual(vcards._load_snapshot().keys(),
+                         reload()._load_snapshot().keys())
+
+    def test_email_token_index(self):
+        index = self.mp._config.index
+        emails = index.email_token_index()
+        for term in ('bre', 'mailpile.is', 'example.com'):
+            self.assertEqual(sorted(emails.search([term])),
+                             [i for i, e in enumerate(index.EMAILS)
+                              if term in e.lower()])
+        eid = index.add_email('someone@token-test.example', 'Token Tester')
+        self.assertEqual(emails.search(['token-test']), set([eid]))
+
+    def test_edit_profile_reindexes(self):
+        from mailpile.plugins.contacts import EditProfile
+        vcards = self.config.vcards
+        self.mp.profiles_add('edit-test@example.com', '=', 'Edit Tester')
+        profile = vcards.get_vcard('edit-test@example.com')
+        edit = lambda name: EditProfile(self.mp._session, data={
+            '_method': 'POST', 'rid': [profile.random_uid],
+            'name': [name]}).run()
+        find = lambda term: [c.random_uid for c in
+                             vcards.find_vcards([term], kinds=['profile'])]
+        try:
+            self.assertEqual(find('tester'), [profile.random_uid])
+            edit('Renamed Profilesson')
+            self.assertEqual(find('profilesson'), [profile.random_uid])
+            self.assertEqual(find('tester'), [])
+            edit('Other Namesson')
+            self.assertEqual(find('namesson'), [profile.random_uid])
+            self.assertEqual(find('profilesson'), [])
+        finally:
+            vcards.del_vcards(profile)
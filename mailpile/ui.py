@@ -716,6 +716,7 @@ class CapturingUserInteraction(UserInteraction):
 
 
 class RawHttpResponder:
+    BLOCK_SIZE = 64 * 1024
 
     def __init__(self, request, attributes={}):
         self.raised = False
@@ -729,10 +730,7 @@ class RawHttpResponder:
                                   ).replace('"', '')
         disposition = attributes.get('disposition', 'attachment')
         length = attributes.get('length')
-        request.send_http_response(200, 'OK')
         headers = []
-        if length is not None:
-            headers.append(('Content-Length', '%s' % length))
         if disposition and filename:
             encfilename = urllib.quote(filename.encode("utf-8"))
             headers.append(('Content-Disposition',
@@ -740,15 +738,27 @@ class RawHttpResponder:
                                                            encfilename)))
         elif disposition:
             headers.append(('Content-Disposition', disposition))
-        request.send_standard_headers(header_list=headers,
-                                      mimetype=mimetype)
+        if length is not None:
+            headers.append(('Content-Length', '%s' % length))
+            request.send_http_response(200, 'OK')
+            request.send_standard_headers(header_list=headers,
+                                          mimetype=mimetype)
+            self.wfile = request.wfile
+        else:
+            # We don't know how much data is coming, so stream it.
+            self.wfile = request.start_streaming_response(
+                header_list=headers, mimetype=mimetype)
 
     def write(self, data):
-        self.request.wfile.write(data)
+        # Write in blocks, so large payloads don't become huge chunks
+        for i in range(0, len(data), self.BLOCK_SIZE):
+            self.wfile.write(data[i:i + self.BLOCK_SIZE])
 
     def close(self):
         if not self.raised:
             self.raised = True
+            if self.wfile is not self.request.wfile:
+                self.wfile.close()
             raise SuppressHtmlOutput()
 
 
@@ -1,13 +1,17 @@
 from __future__ import print_function
+import json
+import os
 import random
 import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 from markupsafe import escape
 
 import mailpile.util
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.tokens import TokenIndex
 from mailpile.util import *
 
 GLOBAL_VCARD_LOCK = VCardRLock()
@@ -877,15 +881,7 @@ class MailpileVCard(SimpleVCard):
         if data:
             pass
         elif filename:
-            from mailpile.crypto.streamer import DecryptingStreamer
-            self.filename = filename or self.filename
-            with open(self.filename, 'rb') as fd:
-                with DecryptingStreamer(fd,
-                                        mep_key=self.decryption_key_func(),
-                                        name='VCard/load(%s)' % self.filename
-                                        ) as streamer:
-                    data = streamer.read().decode('utf-8')
-                    streamer.verify(_raise=IOError)
+            data = self.read_file(filename)
         else:
             raise ValueError('Need data or a filename!')
 
@@ -905,6 +901,21 @@ class MailpileVCard(SimpleVCard):
 
         return self
 
+    def read_file(self, filename):
+        """
+        Read (and decrypt) the VCard data from a file on disk.
+        """
+        from mailpile.crypto.streamer import DecryptingStreamer
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            with DecryptingStreamer(fd,
+                                    mep_key=self.decryption_key_func(),
+                                    name='VCard/load(%s)' % filename
+                                    ) as streamer:
+                data = streamer.read().decode('utf-8')
+                streamer.verify(_raise=IOError)
+        return data
+
     def save(self, filename=None):
         filename = filename or self.filename
         if filename:
@@ -1230,6 +1241,10 @@ class VCardStore(dict):
     KINDS_ALL = ('individual', 'group', 'profile', 'internal')
     KINDS_PEOPLE = ('individual', 'profile', 'internal')
 
+    # Parsed cards are kept in a snapshot file, see load_vcards()
+    SNAPSHOT_NAME = 'snapshot.json'
+    SNAPSHOT_VERSION = 1
+
     def __init__(self, config, vcard_dir):
         dict.__init__(self)
         self.config = config
@@ -1237,6 +1252,8 @@ class VCardStore(dict):
         self.loading = False
         self.loaded = False
         self._lock = VCardRLock()
+        self._tokens = TokenIndex()  # Names, e-mails and nicknames
+        self._by_kind = {}           # kind -> set of random_uids
 
     def __enter__(self, *args, **kwargs):
         return GLOBAL_VCARD_LOCK.__enter__(*args, **kwargs)
@@ -1262,7 +1279,14 @@ class VCardStore(dict):
                                 pass  # Do not override existing cards
                         else:
                             self[key] = card
-            self[card.random_uid] = card
+            rid = card.random_uid
+            self[rid] = card
+            self._tokens.add(rid, card.fn, *[
+                vcl.value for vcl in (card.get_all('email') +
+                                      card.get_all('nickname'))])
+            for uids in self._by_kind.values():
+                uids.discard(rid)
+            self._by_kind.setdefault(card.kind, set()).add(rid)
 
     def deindex_vcard(self, card):
         attrs = (['email'] if (card.kind in self.KINDS_PEOPLE)
@@ -1274,10 +1298,78 @@ class VCardStore(dict):
                     indexed = self.get(key)
                     if indexed and indexed.random_uid == card.random_uid:
                         del self[key]
-            if card.random_uid in self:
-                del self[card.random_uid]
+            rid = card.random_uid
+            if rid in self:
+                del self[rid]
+            self._tokens.remove(rid)
+            for uids in self._by_kind.values():
+                uids.discard(rid)
+
+    def _snapshot_path(self):
+        return os.path.join(self.vcard_dir, self.SNAPSHOT_NAME)
+
+    def _load_snapshot(self):
+        """
+        Load the snapshot of our VCards, a dict mapping file names to
+        (mtime, size, VCard data) lists. Returns {} if none is found.
+        """
+        from mailpile.crypto.streamer import DecryptingStreamer
+        try:
+            with open(self._snapshot_path(), 'rb') as fd:
+                with DecryptingStreamer(fd,
+                                        mep_key=self.config.get_master_key(),
+                                        name='VCardStore/load_snapshot'
+                                        ) as streamer:
+                    data = streamer.read()
+                    streamer.verify(_raise=IOError)
+            snapshot = json.loads(data)
+            if snapshot.get('version') == self.SNAPSHOT_VERSION:
+                return snapshot['cards']
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+        return {}
+
+    def _save_snapshot(self, cards):
+        from mailpile.crypto.streamer import EncryptingStreamer
+        data = json.dumps({'version': self.SNAPSHOT_VERSION, 'cards': cards})
+        path = self._snapshot_path()
+        encryption_key = (self.config.prefs.encrypt_vcards and
+                          self.config.get_master_key())
+        if encryption_key:
+            with EncryptingStreamer(encryption_key,
+                                    delimited=False,
+                                    dir=self.config.tempfile_dir(),
+                                    header_data={
+                                        'subject': self.SNAPSHOT_NAME},
+                                    name='VCardStore/save_snapshot') as es:
+                es.write(data)
+                es.save(path)
+        else:
+            with open(path + '.tmp', 'wb') as fd:
+                fd.write(data)
+            os.rename(path + '.tmp', path)
+
+    def _read_vcard(self, job):
+        fn, path, stat = job
+        try:
+            c = MailpileVCard(config=self.config)
+            data = c.read_file(path)
+            return fn, c.load(data=data), data, None
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            return fn, None, None, e
 
     def load_vcards(self, session=None):
+        """
+        Load all the VCards from disk.
+
+        Decrypting and parsing thousands of individual files is slow, so
+        we keep a snapshot of their contents in a single (encrypted) file.
+        Cards whose files have changed since the snapshot was written
+        (judging by mtime and size) are read from disk, in parallel, and
+        the snapshot is then brought up to date.
+        """
         with self._lock:
             if self.loaded or self.loading:
                 return
@@ -1285,48 +1377,85 @@ class VCardStore(dict):
             self.loading = True
 
         try:
-            prfs = self.config.prefs
-            key_func = lambda: self.config.get_master_key()
             paths = [(fn, os.path.join(self.vcard_dir, fn))
                      for fn in os.listdir(self.vcard_dir)
                      if fn.endswith('.vcf')]
+            paths = [(fn, path, os.stat(path)) for fn, path in paths]
+
+            snapshot = self._load_snapshot()
+            loaded, stale = {}, []
+            for fn, path, stat in paths:
+                entry = snapshot.get(fn)
+                if entry and entry[:2] == [stat.st_mtime, stat.st_size]:
+                    try:
+                        c = MailpileVCard(config=self.config)
+                        c.load(data=entry[2])
+                        c.filename = path
+                        loaded[fn] = (c, entry[2], None)
+                        continue
+                    except ValueError:
+                        pass
+                stale.append((fn, path, stat))
+
+            threads = min(len(stale) // 10, self.config.sys.vcard_threads)
+            if threads > 1:
+                pool = ThreadPool(threads)
+                try:
+                    for fn, c, data, err in pool.imap_unordered(
+                            self._read_vcard, stale):
+                        loaded[fn] = (c, data, err)
+                        if mailpile.util.QUITTING:
+                            return
+                finally:
+                    pool.terminate()
+            else:
+                for job in stale:
+                    if mailpile.util.QUITTING:
+                        return
+                    fn, c, data, err = self._read_vcard(job)
+                    loaded[fn] = (c, data, err)
 
             # Due to the way the eclipsing cleaner works, we want to
             # load the most interesting VCards first - so we sort by
             # size as a rough approximation of that.
-            paths.sort(key=lambda k: -os.path.getsize(k[1]))
-            for fn, path in paths:
+            paths.sort(key=lambda k: -k[2].st_size)
+            cards = {}
+            for fn, path, stat in paths:
                 if mailpile.util.QUITTING:
                     return
-                try:
-                    c = MailpileVCard(config=self.config)
-                    c.load(path, config=self.config)
-                    try:
-                        def ccb(key, card):
-                            if card.kind == 'profile':
-                                return  # Deleting user input is never OK!
-                            if session:
-                                session.ui.error('DISABLING %s, eclipses %s'
-                                                 % (path, key))
-                            os.rename(path, path + '.bak')
-                            raise ValueError('Eclipsing')
-                        self.index_vcard(c, collision_callback=ccb)
-                        if session:
-                            session.ui.mark('Loaded %s from %s'
-                                            % (c.email, fn))
-                    except ValueError:
-                        pass
-                except KeyboardInterrupt:
-                    raise
-                except ValueError:
+                c, data, err = loaded[fn]
+                if isinstance(err, ValueError):
                     if fn.startswith('tmp'):
-                        safe_remove(os.path.join(self.vcard_dir, fn))
-                except:
+                        safe_remove(path)
+                    continue
+                elif err is not None:
                     if session:
                         if 'vcard' in self.config.sys.debug:
-                            import traceback
-                            traceback.print_exc()
+                            session.ui.debug('%s: %s' % (fn, err))
                         session.ui.warning('Failed to load vcard %s' % fn)
+                    continue
+                try:
+                    def ccb(key, card):
+                        if card.kind == 'profile':
+                            return  # Deleting user input is never OK!
+                        if session:
+                            session.ui.error('DISABLING %s, eclipses %s'
+                                             % (path, key))
+                        os.rename(path, path + '.bak')
+                        raise ValueError('Eclipsing')
+                    self.index_vcard(c, collision_callback=ccb)
+                    cards[fn] = [stat.st_mtime, stat.st_size, data]
+                    if session:
+                        session.ui.mark('Loaded %s from %s' % (c.email, fn))
+                except ValueError:
+                    pass
+
+            if stale or set(cards) != set(snapshot):
+                try:
+                    self._save_snapshot(cards)
+                except (IOError, OSError):
+                    if session:
+                        session.ui.warning('Failed to save vcard snapshot')
             self.loaded = True
         except (OSError, IOError):
             pass
@@ -1337,29 +1466,28 @@ class VCardStore(dict):
         return self.get(email.lower(), None)
 
     def find_vcards_with_line(vcards, name, value):
-        # FIXME: This is pretty slow. Can we do better?
-        vcards = [vc for vc in set(vcards.values())
+        if name.lower() in ('fn', 'email', 'nickname'):
+            # These are indexed, so we can narrow things down first
+            with vcards._lock:
+                candidates = [vcards[rid]
+                              for rid in vcards._tokens.search([value])
+                              if rid in vcards]
+        else:
+            candidates = set(vcards.values())
+        vcards = [vc for vc in candidates
                   if [vcl for vcl in vc.get_all(name) if vcl.value == value]]
         vcards.sort(key=lambda vc: (vc.fn, vc.email))
         return vcards
 
     def find_vcards(vcards, terms, kinds=None):
         kinds = kinds or vcards.KINDS_ALL
-        results = []
         with vcards._lock:
-            if not terms:
-                results = [set([vcards[k].random_uid for k in vcards
-                                if (vcards[k].kind in kinds) or not kinds])]
-            for term in terms:
-                term = term.lower()
-                results.append(set([vcards[k].random_uid for k in vcards
-                                    if (term in k or
-                                        term in vcards[k].fn.lower())
-                                    and ((vcards[k].kind in kinds) or
-                                         not kinds)]))
-            while len(results) > 1:
-                results[0] &= results.pop(-1)
-            results = [vcards[rid] for rid in results[0]]
+            rids = set()
+            for kind in kinds:
+                rids |= vcards._by_kind.get(kind, set())
+            if terms and rids:
+                rids &= vcards._tokens.search(terms)
+            results = [vcards[rid] for rid in rids if rid in vcards]
             results.sort(key=lambda card: card.fn)
             return results
 
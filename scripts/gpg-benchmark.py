@@ -0,0 +1,78 @@
+#!/usr/bin/env python2.7
+"""
+Compare the throughput of GnuPG operations, with and without a pool of
+pre-started gpg processes (sys.gpg_coprocesses).
+
+Usage:
+    gpg-benchmark.py [<iterations>] [<threads>]
+
+A throw-away GnuPG home directory and key are created for the test.
+"""
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from mailpile.crypto.gpgi import GnuPG, GnuPGCoprocessPool
+
+
+def gpg(home, args, data=''):
+    proc = subprocess.Popen(['gpg', '--batch', '--quiet', '--homedir', home]
+                            + args,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    return proc.communicate(data)[0]
+
+
+def benchmark(home, pool, op, iterations, threads):
+    def worker():
+        g = GnuPG(None)
+        g.set_home(home)
+        g.coprocesses = pool
+        for i in range(0, iterations):
+            op(g)
+
+    op(GnuPG(None))  # Warm up version checks etc.
+    t0 = time.time()
+    workers = [threading.Thread(target=worker) for i in range(0, threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return (iterations * threads) / (time.time() - t0)
+
+
+def main(iterations, threads):
+    home = tempfile.mkdtemp()
+    os.chmod(home, 0o700)
+    try:
+        gpg(home, ['--passphrase', '', '--quick-gen-key', 'bench@example.com',
+                   'ed25519', 'sign', 'never'])
+        data = 'Hello, World\n' * 100
+        signature = gpg(home, ['--detach-sign', '--armor'], data)
+        clearsigned = gpg(home, ['--clearsign'], data)
+
+        tests = (
+            ('verify detached', lambda g: g.verify(data, signature=signature)),
+            ('verify clearsigned', lambda g: g.verify(clearsigned)))
+        for name, op in tests:
+            forked = benchmark(home, None, op, iterations, threads)
+            pool = GnuPGCoprocessPool(spares=max(2, threads))
+            try:
+                pooled = benchmark(home, pool, op, iterations, threads)
+            finally:
+                pool.close()
+            print('%-20s fork-per-call: %6.1f/s  pooled: %6.1f/s  (%+.0f%%)'
+                  % (name, forked, pooled, 100 * (pooled - forked) / forked))
+    finally:
+        subprocess.call(['gpgconf', '--homedir', home, '--kill', 'gpg-agent'])
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1)